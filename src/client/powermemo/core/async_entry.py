@@ -2,7 +2,7 @@ import os
 import json
 import httpx
 from collections import defaultdict
-from typing import Optional
+from typing import Optional, Literal
 from pydantic import HttpUrl, ValidationError
 from dataclasses import dataclass
 from .blob import BlobData, Blob, BlobType, ChatBlob, OpenAICompatibleMessage
@@ -134,6 +134,19 @@ class AsyncUser:
         )
         return r.data["id"]
 
+    async def insert_many(self, blobs: list[Blob]) -> list[str]:
+        r = unpack_response(
+            await self.project_client.client.post(
+                "/blobs/insert_many",
+                json={
+                    "blobs": [
+                        {"user_id": self.user_id, **b.to_request()} for b in blobs
+                    ]
+                },
+            )
+        )
+        return r.data["ids"]
+
     async def get(self, blob_id: str) -> Blob:
         r = unpack_response(
             await self.project_client.client.get(f"/blobs/{self.user_id}/{blob_id}")
@@ -273,8 +286,14 @@ class AsyncUser:
         topk: int = 10,
         similarity_threshold: float = 0.5,
         time_range_in_days: int = 7,
+        ef_search: int = None,
+        search_mode: Literal["vector", "hybrid"] = None,
     ) -> list[UserEventData]:
         params = f"?query={query}&topk={topk}&similarity_threshold={similarity_threshold}&time_range_in_days={time_range_in_days}"
+        if ef_search is not None:
+            params += f"&ef_search={ef_search}"
+        if search_mode is not None:
+            params += f"&search_mode={search_mode}"
         r = unpack_response(
             await self.project_client.client.get(
                 f"/users/event/search/{self.user_id}{params}"
@@ -1,5 +1,6 @@
 import powermemo_server.env
 import os
+import asyncio
 
 # Done setting up env
 
@@ -13,6 +14,8 @@ from powermemo_server.connectors import (
 )
 from powermemo_server import api_layer
 from powermemo_server.env import LOG
+from powermemo_server.cache import run_invalidation_listener
+from powermemo_server.controllers.event import run_event_embedder
 from powermemo_server.llms.embeddings import check_embedding_sanity
 from uvicorn.config import LOGGING_CONFIG
 from api_docs import API_X_CODE_DOCS
@@ -22,8 +25,12 @@ from api_docs import API_X_CODE_DOCS
 async def lifespan(app: FastAPI):
     init_redis_pool()
     await check_embedding_sanity()
+    invalidation_listener = asyncio.create_task(run_invalidation_listener())
+    event_embedder = asyncio.create_task(run_event_embedder())
     LOG.info(f"Start Powermemo Server {powermemo_server.__version__} 🖼️")
     yield
+    invalidation_listener.cancel()
+    event_embedder.cancel()
     await close_connection()
 
 
@@ -165,6 +172,13 @@ router.post(
 )(api_layer.blob.insert_blob)
 
 
+router.post(
+    "/blobs/insert_many",
+    tags=["blob"],
+    openapi_extra=API_X_CODE_DOCS["POST /blobs/insert_many"],
+)(api_layer.blob.insert_blobs)
+
+
 router.get(
     "/blobs/{user_id}/{blob_id}",
     tags=["blob"],
@@ -214,6 +228,11 @@ router.post(
     openapi_extra=API_X_CODE_DOCS["POST /users/buffer/{user_id}/{buffer_type}"],
 )(api_layer.buffer.flush_buffer)
 
+router.get(
+    "/users/buffer/jobs/{user_id}/{job_id}",
+    tags=["buffer"],
+)(api_layer.buffer.get_flush_job)
+
 router.get(
     "/users/event/{user_id}",
     tags=["event"],
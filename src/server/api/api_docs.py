@@ -530,6 +530,44 @@ if err != nil {
     ]
 }
 
+API_X_CODE_DOCS["POST /blobs/insert_many"] = {
+    "x-code-samples": [
+        {
+            "lang": "Python",
+            "source": """# To use the Python SDK, install the package:
+# pip install powermemo
+
+from powermemo import Powermemo
+from powermemo import ChatBlob
+
+client = Powermemo(project_url='PROJECT_URL', api_key='PROJECT_TOKEN')
+
+bs = [
+    ChatBlob(messages=[
+        {
+            "role": "user",
+            "content": "Hi, I'm here again"
+        },
+        {
+            "role": "assistant",
+            "content": "Hi, Gus! How can I help you?"
+        }
+    ]),
+    ChatBlob(messages=[
+        {
+            "role": "user",
+            "content": "I'm going to Tokyo next week"
+        }
+    ]),
+]
+u = client.get_user(uid)
+bids = u.insert_many(bs)
+""",
+            "label": "Python",
+        },
+    ]
+}
+
 API_X_CODE_DOCS["GET /blobs/{user_id}/{blob_id}"] = {
     "x-code-samples": [
         {
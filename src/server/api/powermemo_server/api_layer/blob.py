@@ -1,6 +1,7 @@
 from fastapi import BackgroundTasks, Request
 from fastapi import Path, Body
 import traceback
+import pydantic
 
 from ..controllers import full as controllers
 
@@ -62,11 +63,64 @@ async def insert_blob(
     return res.BlobInsertResponse(
         data={
             **p.data().model_dump(),
-            "chat_results": pb.data(),
+            **pb.data().model_dump(),
         }
     )
 
 
+async def insert_blobs(
+    request: Request,
+    blobs_data: res.BlobsData = Body(..., description="The blobs to insert"),
+    background_tasks: BackgroundTasks = BackgroundTasks(),
+) -> res.BlobsInsertResponse:
+    project_id = request.state.powermemo_project_id
+    background_tasks.add_task(
+        capture_int_key,
+        TelemetryKeyName.insert_blob_request,
+        value=len(blobs_data.blobs),
+        project_id=project_id,
+    )
+
+    p = await controllers.billing.get_project_billing(project_id)
+    if not p.ok():
+        return p.to_response(res.BlobsInsertResponse)
+    billing = p.data()
+
+    if billing.token_left is not None and billing.token_left < 0:
+        return Promise.reject(
+            CODE.SERVICE_UNAVAILABLE,
+            f"Your project reaches Powermemo token limit, "
+            f"Left: {billing.token_left}, this project used: {billing.project_token_cost_month}. "
+            f"Your quota will be refilled on {billing.next_refill_at}. "
+            "\nhttps://www.powermemo.io/pricing for more information.",
+        ).to_response(res.BlobsInsertResponse)
+
+    try:
+        user_blobs = [(str(b.user_id), b.to_blob()) for b in blobs_data.blobs]
+    except pydantic.ValidationError as e:
+        return Promise.reject(
+            CODE.BAD_REQUEST, f"Unable to parse blob: {e}"
+        ).to_response(res.BlobsInsertResponse)
+
+    try:
+        p = await controllers.buffer.insert_blobs_to_buffer(project_id, user_blobs)
+        if not p.ok():
+            return p.to_response(res.BlobsInsertResponse)
+    except Exception as e:
+        LOG.error(f"Error inserting blobs: {e}, {traceback.format_exc()}")
+        return Promise.reject(
+            CODE.INTERNAL_SERVER_ERROR, f"Error inserting blobs: {e}"
+        ).to_response(res.BlobsInsertResponse)
+
+    background_tasks.add_task(
+        capture_int_key,
+        TelemetryKeyName.insert_blob_success_request,
+        value=len(user_blobs),
+        project_id=project_id,
+    )
+    return p.to_response(res.BlobsInsertResponse)
+
+
 async def get_blob(
     request: Request,
     user_id: str = Path(..., description="The ID of the user"),
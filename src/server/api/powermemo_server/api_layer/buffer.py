@@ -18,3 +18,14 @@ async def flush_buffer(
         user_id, project_id, buffer_type
     )
     return p.to_response(res.ChatModalAPIResponse)
+
+
+async def get_flush_job(
+    request: Request,
+    user_id: str = Path(..., description="The ID of the user"),
+    job_id: str = Path(..., description="The ID of the flush job"),
+) -> res.FlushJobResponse:
+    """Get the status and result of a queued buffer flush"""
+    project_id = request.state.powermemo_project_id
+    p = await controllers.buffer_queue.get_flush_job(user_id, project_id, job_id)
+    return p.to_response(res.FlushJobResponse)
@@ -1,3 +1,4 @@
+from typing import Literal
 from ..controllers import full as controllers
 from ..models import response as res
 from fastapi import Request
@@ -59,9 +60,26 @@ async def search_user_events(
         0.5, description="Similarity threshold, default is 0.5"
     ),
     time_range_in_days: int = Query(7, description="Time range in days, default is 7"),
+    ef_search: int = Query(
+        None,
+        ge=1,
+        le=1000,
+        description="Candidate list size of the vector index scan, larger is more accurate and slower, default is the server config",
+    ),
+    search_mode: Literal["vector", "hybrid"] = Query(
+        None,
+        description="`vector` ranks events by similarity, `hybrid` also matches the query words and fuses both rankings, default is the server config",
+    ),
 ) -> res.UserEventsDataResponse:
     project_id = request.state.powermemo_project_id
     p = await controllers.event.search_user_events(
-        user_id, project_id, query, topk, similarity_threshold, time_range_in_days
+        user_id,
+        project_id,
+        query,
+        topk,
+        similarity_threshold,
+        time_range_in_days,
+        ef_search,
+        search_mode,
     )
     return p.to_response(res.UserEventsDataResponse)
@@ -26,6 +26,7 @@ PATH_MAPPINGS = [
     "/api/v1/users/event",
     "/api/v1/users/context",
     "/api/v1/users",
+    "/api/v1/blobs/insert_many",
     "/api/v1/blobs/insert",
     "/api/v1/blobs",
 ]
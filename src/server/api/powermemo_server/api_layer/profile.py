@@ -53,7 +53,13 @@ async def get_user_profile(
         return Promise.reject(
             CODE.BAD_REQUEST, f"Invalid JSON requests: {e}"
         ).to_response(res.UserProfileResponse)
-    p = await controllers.profile.get_user_profiles(user_id, project_id)
+    p = await controllers.profile.get_user_profiles(
+        user_id,
+        project_id,
+        only_topics=only_topics,
+        max_subtopic_size=max_subtopic_size,
+        topic_limits=topic_limits,
+    )
     if not p.ok():
         return p.to_response(res.UserProfileResponse)
     total_profiles = p.data()
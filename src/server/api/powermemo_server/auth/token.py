@@ -7,6 +7,10 @@ from ..models.utils import Promise
 from ..models.response import CODE
 from ..connectors import get_redis_client
 from ..controllers import project
+from ..cache import get_local_cache, MISSING
+
+PROJECT_SECRET_CACHE = get_local_cache("project_secret")
+PROJECT_STATUS_CACHE = get_local_cache("project_status")
 
 
 def parse_project_id(secret_key: str) -> Promise[str]:
@@ -28,6 +32,9 @@ def project_status_redis_key(project_id: str) -> str:
 
 
 async def check_project_secret(project_id: str, secret_key: str) -> Promise[bool]:
+    secret = PROJECT_SECRET_CACHE.get(project_id)
+    if secret is not MISSING:
+        return Promise.resolve(secret == secret_key)
     async with get_redis_client() as client:
         secret = await client.get(token_redis_key(project_id))
         if secret is None:
@@ -36,10 +43,14 @@ async def check_project_secret(project_id: str, secret_key: str) -> Promise[bool
                 return Promise.reject(CODE.UNAUTHORIZED, "Your project is not exists!")
             secret = p.data()
             await client.set(token_redis_key(project_id), secret, ex=None)
+    PROJECT_SECRET_CACHE.set(project_id, secret)
     return Promise.resolve(secret == secret_key)
 
 
 async def get_project_status(project_id: str) -> Promise[str]:
+    status = PROJECT_STATUS_CACHE.get(project_id)
+    if status is not MISSING:
+        return Promise.resolve(status)
     async with get_redis_client() as client:
         status = await client.get(project_status_redis_key(project_id))
         if status is None:
@@ -50,4 +61,5 @@ async def get_project_status(project_id: str) -> Promise[str]:
             await client.set(
                 project_status_redis_key(project_id), status.strip(), ex=60 * 60
             )
+    PROJECT_STATUS_CACHE.set(project_id, status)
     return Promise.resolve(status)
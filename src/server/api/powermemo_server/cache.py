@@ -0,0 +1,96 @@
+"""
+In-process TTL/LRU caches for hot per-request lookups.
+
+Writers call `publish_invalidation` so every node drops its copy, the TTL
+bounds staleness if an invalidation message is lost.
+"""
+
+import json
+import time
+import asyncio
+from collections import OrderedDict
+from typing import Any
+import redis.exceptions
+from .env import CONFIG, LOG
+from .connectors import get_redis_client, PROJECT_ID
+
+INVALIDATION_CHANNEL = f"powermemo::local_cache::invalidate::{PROJECT_ID}"
+MISSING = object()
+
+
+class LocalCache:
+    def __init__(self, name: str, max_size: int, ttl: float):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.data: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+
+    def get(self, key: str) -> Any:
+        item = self.data.get(key)
+        if item is None:
+            return MISSING
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self.data[key]
+            return MISSING
+        self.data.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: Any) -> None:
+        self.data[key] = (time.monotonic() + self.ttl, value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.max_size:
+            self.data.popitem(last=False)
+
+    def invalidate(self, key: str) -> None:
+        self.data.pop(key, None)
+
+    def clear(self) -> None:
+        self.data.clear()
+
+
+LOCAL_CACHES: dict[str, LocalCache] = {}
+
+
+def get_local_cache(name: str) -> LocalCache:
+    if name not in LOCAL_CACHES:
+        LOCAL_CACHES[name] = LocalCache(
+            name, max_size=CONFIG.local_cache_max_size, ttl=CONFIG.local_cache_ttl
+        )
+    return LOCAL_CACHES[name]
+
+
+async def publish_invalidation(name: str, key: str) -> None:
+    get_local_cache(name).invalidate(key)
+    async with get_redis_client() as redis_client:
+        await redis_client.publish(INVALIDATION_CHANNEL, json.dumps([name, key]))
+
+
+def apply_invalidation(message: str) -> None:
+    try:
+        name, key = json.loads(message)
+    except (ValueError, TypeError):
+        LOG.warning(f"Invalid local cache invalidation: {message}")
+        return
+    if name in LOCAL_CACHES:
+        LOCAL_CACHES[name].invalidate(key)
+
+
+async def run_invalidation_listener(retry_interval: float = 5) -> None:
+    while True:
+        try:
+            async with get_redis_client() as redis_client:
+                async with redis_client.pubsub() as pubsub:
+                    await pubsub.subscribe(INVALIDATION_CHANNEL)
+                    LOG.info(
+                        f"Listening local cache invalidation on {INVALIDATION_CHANNEL}"
+                    )
+                    async for message in pubsub.listen():
+                        if message["type"] == "message":
+                            apply_invalidation(message["data"])
+        except redis.exceptions.RedisError as e:
+            LOG.error(f"Local cache invalidation listener disconnected: {e}")
+        # invalidations may be missed while disconnected
+        for cache in LOCAL_CACHES.values():
+            cache.clear()
+        await asyncio.sleep(retry_interval)
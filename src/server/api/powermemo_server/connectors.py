@@ -2,11 +2,12 @@ import os
 import asyncio
 import redis.exceptions
 import redis.asyncio as redis
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, text, make_url, URL
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from uuid import uuid4
-from .env import LOG
+from .env import LOG, CONFIG
 from .models.database import REG, Project, UserEvent
 
 DATABASE_URL = os.getenv("DATABASE_URL")
@@ -30,10 +31,79 @@ DB_ENGINE = create_engine(
     pool_timeout=30,  # Wait up to 30 seconds for available connection
 )
 REDIS_POOL = None
+# for values stored as raw bytes, e.g. cached embeddings
+REDIS_BINARY_POOL = None
 
 Session = sessionmaker(bind=DB_ENGINE)
 
 
+def async_database_url(database_url: str) -> URL:
+    # psycopg3 has a native asyncio driver and reads the same libpq url
+    return make_url(database_url).set(drivername="postgresql+psycopg")
+
+
+class BlockingAsyncSession:
+    """
+    Expose the sync `Session` with the `AsyncSession` API.
+
+    Every query still blocks the event loop, it's only kept so that
+    `use_async_database=False` can be benchmarked against the async engine.
+    """
+
+    def __init__(self):
+        self.session = Session(expire_on_commit=False)
+
+    async def __aenter__(self) -> "BlockingAsyncSession":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.session.close()
+
+    def add(self, instance):
+        self.session.add(instance)
+
+    def add_all(self, instances):
+        self.session.add_all(instances)
+
+    async def execute(self, *args, **kwargs):
+        return self.session.execute(*args, **kwargs)
+
+    async def scalar(self, *args, **kwargs):
+        return self.session.scalar(*args, **kwargs)
+
+    async def scalars(self, *args, **kwargs):
+        return self.session.scalars(*args, **kwargs)
+
+    async def delete(self, instance):
+        self.session.delete(instance)
+
+    async def flush(self):
+        self.session.flush()
+
+    async def commit(self):
+        self.session.commit()
+
+    async def rollback(self):
+        self.session.rollback()
+
+
+if CONFIG.use_async_database:
+    ASYNC_DB_ENGINE = create_async_engine(
+        async_database_url(DATABASE_URL),
+        pool_size=50,
+        max_overflow=30,
+        pool_recycle=600,
+        pool_pre_ping=True,
+        pool_timeout=30,
+    )
+    # objects are read after commit, and async sessions can't lazy-load them
+    AsyncSession = async_sessionmaker(bind=ASYNC_DB_ENGINE, expire_on_commit=False)
+else:
+    ASYNC_DB_ENGINE = None
+    AsyncSession = BlockingAsyncSession
+LOG.info(f"Async database: {CONFIG.use_async_database}")
+
+
 def create_tables():
     REG.metadata.create_all(DB_ENGINE)
     with Session() as session:
@@ -69,14 +139,19 @@ async def redis_health_check() -> bool:
 
 async def close_connection():
     DB_ENGINE.dispose()
+    if ASYNC_DB_ENGINE is not None:
+        await ASYNC_DB_ENGINE.dispose()
     if REDIS_POOL is not None:
         await REDIS_POOL.aclose()
+    if REDIS_BINARY_POOL is not None:
+        await REDIS_BINARY_POOL.aclose()
     LOG.info("Connections closed")
 
 
 def init_redis_pool():
-    global REDIS_POOL
+    global REDIS_POOL, REDIS_BINARY_POOL
     REDIS_POOL = redis.ConnectionPool.from_url(REDIS_URL, decode_responses=True)
+    REDIS_BINARY_POOL = redis.ConnectionPool.from_url(REDIS_URL)
 
 
 def get_redis_client() -> redis.Redis:
@@ -86,6 +161,13 @@ def get_redis_client() -> redis.Redis:
         return redis.Redis.from_url(REDIS_URL, decode_responses=True)
 
 
+def get_redis_binary_client() -> redis.Redis:
+    if REDIS_BINARY_POOL is not None:
+        return redis.Redis(connection_pool=REDIS_BINARY_POOL)
+    else:
+        return redis.Redis.from_url(REDIS_URL)
+
+
 if __name__ == "__main__":
 
     async def main():
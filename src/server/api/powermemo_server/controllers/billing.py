@@ -1,4 +1,5 @@
 from pydantic import ValidationError
+from sqlalchemy import select
 from ..models.utils import Promise
 from ..models.database import (
     ProjectBilling,
@@ -6,7 +7,7 @@ from ..models.database import (
     next_month_first_day,
 )
 from ..models.response import CODE, IdData, IdsData, UserProfilesData, BillingData
-from ..connectors import Session
+from ..connectors import AsyncSession
 from ..telemetry.capture_key import get_int_key, capture_int_key
 from ..env import (
     LOG,
@@ -20,18 +21,18 @@ from datetime import datetime, date
 
 
 async def get_project_billing(project_id: str) -> Promise[BillingData]:
-    with Session() as session:
-        billing = (
-            session.query(ProjectBilling)
-            .filter(ProjectBilling.project_id == project_id)
-            .first()
+    async with AsyncSession() as session:
+        billing = await session.scalar(
+            select(Billing)
+            .join(ProjectBilling, ProjectBilling.billing_id == Billing.id)
+            .where(ProjectBilling.project_id == project_id)
+            .limit(1)
         )
         if billing is None:
             return await fallback_billing_data(project_id)
             # return Promise.reject(CODE.NOT_FOUND, "Billing not found").to_response(
             #     BillingData
             # )
-        billing = billing.billing
 
         this_month_token_costs_in = await get_int_key(
             TelemetryKeyName.llm_input_tokens, project_id, in_month=True
@@ -53,7 +54,7 @@ async def get_project_billing(project_id: str) -> Promise[BillingData]:
 
             billing.next_refill_at = next_month_first_day()
             billing.usage_left = usage_left_this_billing
-            session.commit()
+            await session.commit()
     billing_data = BillingData(
         token_left=usage_left_this_billing,
         next_refill_at=next_refill_date,
@@ -112,17 +113,16 @@ async def project_cost_token_billing(
     await capture_int_key(
         TelemetryKeyName.llm_output_tokens, output_tokens, project_id=project_id
     )
-    with Session() as session:
-        _billing = (
-            session.query(ProjectBilling)
-            .filter(ProjectBilling.project_id == project_id)
-            .one_or_none()
+    async with AsyncSession() as session:
+        billing = await session.scalar(
+            select(Billing)
+            .join(ProjectBilling, ProjectBilling.billing_id == Billing.id)
+            .where(ProjectBilling.project_id == project_id)
         )
-        if _billing is None:
+        if billing is None:
             return Promise.reject(CODE.NOT_FOUND, "Billing not found")
-        billing = _billing.billing
 
         if billing.usage_left is not None:
             billing.usage_left -= input_tokens + output_tokens
-            session.commit()
+            await session.commit()
     return Promise.resolve(None)
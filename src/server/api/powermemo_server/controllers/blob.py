@@ -1,9 +1,11 @@
 import pydantic
+from sqlalchemy import select
 from ..models.utils import Promise
 from ..models.database import GeneralBlob, DEFAULT_PROJECT_ID
 from ..models.response import CODE, BlobData, IdData
 from ..models.blob import ChatBlob, DocBlob, BlobType
-from ..connectors import Session
+from ..connectors import AsyncSession
+from .buffer import reset_buffer_state
 
 
 async def insert_blob(user_id: str, project_id: str, blob: BlobData) -> Promise[IdData]:
@@ -11,7 +13,7 @@ async def insert_blob(user_id: str, project_id: str, blob: BlobData) -> Promise[
         blob_parsed = blob.to_blob()
     except pydantic.ValidationError as e:
         return Promise.reject(CODE.BAD_REQUEST, f"Unable to parse blob: {e}")
-    with Session() as session:
+    async with AsyncSession() as session:
         blob_db = GeneralBlob(
             blob_type=blob_parsed.type,
             blob_data=blob_parsed.get_blob_data(),
@@ -20,17 +22,17 @@ async def insert_blob(user_id: str, project_id: str, blob: BlobData) -> Promise[
             project_id=project_id,
         )
         session.add(blob_db)
-        session.commit()
+        await session.commit()
         b_id = blob_db.id
     return Promise.resolve(IdData(id=b_id))
 
 
 async def get_blob(user_id: str, project_id: str, blob_id: str) -> Promise[BlobData]:
-    with Session() as session:
-        blob_db = (
-            session.query(GeneralBlob)
-            .filter_by(id=blob_id, user_id=user_id, project_id=project_id)
-            .one_or_none()
+    async with AsyncSession() as session:
+        blob_db = await session.scalar(
+            select(GeneralBlob).filter_by(
+                id=blob_id, user_id=user_id, project_id=project_id
+            )
         )
         if not blob_db:
             return Promise.reject(
@@ -47,15 +49,18 @@ async def get_blob(user_id: str, project_id: str, blob_id: str) -> Promise[BlobD
 
 
 async def remove_blob(user_id: str, project_id: str, blob_id: str) -> Promise[None]:
-    with Session() as session:
-        blob_db = (
-            session.query(GeneralBlob)
-            .filter_by(id=blob_id, user_id=user_id, project_id=project_id)
-            .one_or_none()
+    async with AsyncSession() as session:
+        blob_db = await session.scalar(
+            select(GeneralBlob).filter_by(
+                id=blob_id, user_id=user_id, project_id=project_id
+            )
         )
         if not blob_db:
             return Promise.resolve(None)
         else:
-            session.delete(blob_db)
-            session.commit()
+            blob_type = BlobType(blob_db.blob_type)
+            await session.delete(blob_db)
+            await session.commit()
+    # the buffer row of this blob is deleted by cascade
+    await reset_buffer_state(user_id, project_id, blob_type)
     return Promise.resolve(None)
@@ -1,49 +1,352 @@
-from sqlalchemy import func
+import time
+import asyncio
+from typing import Callable, Awaitable
+from collections import defaultdict
+from contextlib import AsyncExitStack
+from uuid import UUID, uuid4
+from datetime import timedelta
+from dataclasses import dataclass
+from sqlalchemy import func, select, update, delete, or_, Row
 from pydantic import BaseModel
 from ..env import CONFIG, LOG
 from ..utils import (
     get_blob_token_size,
+    get_blob_str,
     pack_blob_from_db,
-    seconds_from_now,
     user_id_lock,
+    acquire_user_id_lock,
 )
 from ..models.utils import Promise
-from ..models.response import CODE, ChatModalResponse
+from ..models.response import (
+    CODE,
+    ChatModalResponse,
+    BufferFlushData,
+    BlobsInsertData,
+)
 from ..models.database import BufferZone, GeneralBlob
 from ..models.blob import BlobType, Blob
-from ..connectors import Session
+from ..connectors import AsyncSession, get_redis_client, PROJECT_ID
+from ..tokenizer import count_tokens_batch
 from .modal import BLOBS_PROCESS
+from .buffer_queue import (
+    enqueue_flush_job,
+    flush_deadline_member,
+    FLUSH_DEADLINES_KEY,
+)
+
+
+BUFFER_STATE_TTL = 60 * 60 * 24 * 7  # 7 days
+
+# Only bump counters that are already built, a missing state is rebuilt from DB
+INCR_BUFFER_STATE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('HINCRBY', KEYS[1], 'token_size', ARGV[1])
+redis.call('HINCRBY', KEYS[1], 'blob_count', ARGV[2])
+redis.call('HSET', KEYS[1], 'last_insert_at', ARGV[3])
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+redis.call('ZADD', KEYS[2], ARGV[3] + ARGV[5], ARGV[6])
+return 1
+"""
+
+
+# Take the rows a flush claimed out of the counters, an emptied buffer drops
+# its state and deadline. A missing state is rebuilt from the unleased rows
+DECR_BUFFER_STATE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+local blob_count = redis.call('HINCRBY', KEYS[1], 'blob_count', -tonumber(ARGV[2]))
+if blob_count <= 0 then
+    redis.call('DEL', KEYS[1])
+    redis.call('ZREM', KEYS[2], ARGV[3])
+    return 1
+end
+if redis.call('HINCRBY', KEYS[1], 'token_size', -tonumber(ARGV[1])) < 0 then
+    redis.call('HSET', KEYS[1], 'token_size', 0)
+end
+return 1
+"""
+
+
+@dataclass
+class BufferState:
+    token_size: int = 0
+    blob_count: int = 0
+    last_insert_at: float | None = None
+
+
+def buffer_state_key(user_id: str, project_id: str, blob_type: BlobType) -> str:
+    return f"powermemo::buffer::state::{PROJECT_ID}::{project_id}::{user_id}::{blob_type}"
+
+
+async def rebuild_buffer_state(
+    user_id: str, project_id: str, blob_type: BlobType
+) -> BufferState:
+    async with AsyncSession() as session:
+        token_size, blob_count, last_created_at = (
+            await session.execute(
+                select(
+                    func.sum(BufferZone.token_size),
+                    func.count(BufferZone.id),
+                    func.max(BufferZone.created_at),
+                )
+                .filter_by(
+                    user_id=user_id, blob_type=str(blob_type), project_id=project_id
+                )
+                .where(
+                    or_(
+                        BufferZone.flush_lease_expires_at.is_(None),
+                        BufferZone.flush_lease_expires_at < func.now(),
+                    )
+                )
+            )
+        ).one()
+    state = BufferState(
+        token_size=token_size or 0,
+        blob_count=blob_count or 0,
+        last_insert_at=last_created_at.timestamp() if last_created_at else None,
+    )
+    mapping = {"token_size": state.token_size, "blob_count": state.blob_count}
+    if state.last_insert_at is not None:
+        mapping["last_insert_at"] = state.last_insert_at
+    key = buffer_state_key(user_id, project_id, blob_type)
+    member = flush_deadline_member(user_id, project_id, blob_type)
+    async with get_redis_client() as redis_client:
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.delete(key)
+            pipe.hset(key, mapping=mapping)
+            pipe.expire(key, BUFFER_STATE_TTL)
+            if state.blob_count and state.last_insert_at is not None:
+                pipe.zadd(
+                    FLUSH_DEADLINES_KEY,
+                    {member: state.last_insert_at + CONFIG.buffer_flush_interval},
+                )
+            else:
+                pipe.zrem(FLUSH_DEADLINES_KEY, member)
+            await pipe.execute()
+    return state
+
+
+async def get_buffer_state(
+    user_id: str, project_id: str, blob_type: BlobType
+) -> BufferState:
+    async with get_redis_client() as redis_client:
+        state = await redis_client.hgetall(
+            buffer_state_key(user_id, project_id, blob_type)
+        )
+    if not state:
+        return await rebuild_buffer_state(user_id, project_id, blob_type)
+    last_insert_at = state.get("last_insert_at")
+    return BufferState(
+        token_size=int(state.get("token_size", 0)),
+        blob_count=int(state.get("blob_count", 0)),
+        last_insert_at=float(last_insert_at) if last_insert_at else None,
+    )
+
+
+async def incr_buffer_state(
+    user_id: str,
+    project_id: str,
+    blob_type: BlobType,
+    token_size: int,
+    blob_count: int = 1,
+) -> None:
+    async with get_redis_client() as redis_client:
+        updated = await redis_client.eval(
+            INCR_BUFFER_STATE_SCRIPT,
+            2,
+            buffer_state_key(user_id, project_id, blob_type),
+            FLUSH_DEADLINES_KEY,
+            token_size,
+            blob_count,
+            time.time(),
+            BUFFER_STATE_TTL,
+            CONFIG.buffer_flush_interval,
+            flush_deadline_member(user_id, project_id, blob_type),
+        )
+    if not updated:
+        # the new buffer row is already committed, so the rebuild counts it
+        await rebuild_buffer_state(user_id, project_id, blob_type)
+
+
+async def decr_buffer_state(
+    user_id: str,
+    project_id: str,
+    blob_type: BlobType,
+    token_size: int,
+    blob_count: int,
+) -> None:
+    async with get_redis_client() as redis_client:
+        await redis_client.eval(
+            DECR_BUFFER_STATE_SCRIPT,
+            2,
+            buffer_state_key(user_id, project_id, blob_type),
+            FLUSH_DEADLINES_KEY,
+            token_size,
+            blob_count,
+            flush_deadline_member(user_id, project_id, blob_type),
+        )
+
+
+async def reset_buffer_state(
+    user_id: str, project_id: str, blob_type: BlobType
+) -> None:
+    async with get_redis_client() as redis_client:
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.delete(buffer_state_key(user_id, project_id, blob_type))
+            pipe.zrem(
+                FLUSH_DEADLINES_KEY,
+                flush_deadline_member(user_id, project_id, blob_type),
+            )
+            await pipe.execute()
 
 
 @user_id_lock("insert_blob_to_buffer")
 async def insert_blob_to_buffer(
     user_id: str, project_id: str, blob_id: str, blob_data: Blob
-) -> Promise[list[ChatModalResponse]]:
-    results = []
+) -> Promise[BufferFlushData]:
+    results = BufferFlushData(chat_results=[], flush_job_ids=[])
     p = await detect_buffer_idle_or_not(user_id, project_id, blob_data.type)
     if not p.ok():
         return p
-    if p.data() is not None:
-        results.append(p.data())
-    with Session() as session:
+    if p.data():
+        p = await trigger_buffer_flush(user_id, project_id, blob_data.type, results)
+        if not p.ok():
+            return p
+    token_size = await get_blob_token_size(blob_data)
+    async with AsyncSession() as session:
         buffer = BufferZone(
             user_id=user_id,
             blob_id=blob_id,
             blob_type=blob_data.type,
-            token_size=get_blob_token_size(blob_data),
+            token_size=token_size,
             project_id=project_id,
         )
         session.add(buffer)
-        session.commit()
+        await session.commit()
+    await incr_buffer_state(user_id, project_id, blob_data.type, token_size)
 
     p = await detect_buffer_full_or_not(user_id, project_id, blob_data.type)
     if not p.ok():
         return p
-    if p.data() is not None:
-        results.append(p.data())
+    if p.data():
+        p = await trigger_buffer_flush(user_id, project_id, blob_data.type, results)
+        if not p.ok():
+            return p
     return Promise.resolve(results)
 
 
+async def trigger_buffer_flush(
+    user_id: str, project_id: str, blob_type: BlobType, results: BufferFlushData
+) -> Promise[None]:
+    if CONFIG.use_buffer_flush_queue:
+        p = await enqueue_flush_job(user_id, project_id, blob_type)
+        if not p.ok():
+            return p
+        if p.data() not in results.flush_job_ids:
+            results.flush_job_ids.append(p.data())
+        return Promise.resolve(None)
+    p = await flush_buffer(user_id, project_id, blob_type)
+    if not p.ok():
+        return p
+    if p.data() is not None:
+        results.chat_results.append(p.data())
+    return Promise.resolve(None)
+
+
+async def insert_blobs_to_buffer(
+    project_id: str, user_blobs: list[tuple[str, Blob]]
+) -> Promise[BlobsInsertData]:
+    results = BufferFlushData(chat_results=[], flush_job_ids=[])
+    token_sizes = await count_tokens_batch([get_blob_str(b) for _, b in user_blobs])
+    buffer_keys = list(dict.fromkeys((u, blob.type) for u, blob in user_blobs))
+    async with AsyncExitStack() as stack:
+        # lock users in a stable order so concurrent batches can't deadlock
+        for user_id in sorted({u for u, _ in user_blobs}):
+            await stack.enter_async_context(
+                acquire_user_id_lock("insert_blob_to_buffer", user_id)
+            )
+
+        p = await flush_detected_buffers(
+            project_id, buffer_keys, detect_buffer_idle_or_not, results
+        )
+        if not p.ok():
+            return p
+
+        async with AsyncSession() as session:
+            db_blobs = [
+                GeneralBlob(
+                    blob_type=blob.type,
+                    blob_data=blob.get_blob_data(),
+                    additional_fields=blob.fields,
+                    user_id=user_id,
+                    project_id=project_id,
+                )
+                for user_id, blob in user_blobs
+            ]
+            session.add_all(db_blobs)
+            await session.flush()
+            session.add_all(
+                [
+                    BufferZone(
+                        user_id=user_id,
+                        blob_id=db_blob.id,
+                        blob_type=blob.type,
+                        token_size=token_size,
+                        project_id=project_id,
+                    )
+                    for (user_id, blob), db_blob, token_size in zip(
+                        user_blobs, db_blobs, token_sizes
+                    )
+                ]
+            )
+            await session.commit()
+            blob_ids = [db_blob.id for db_blob in db_blobs]
+
+        buffer_deltas = defaultdict(lambda: [0, 0])
+        for (user_id, blob), token_size in zip(user_blobs, token_sizes):
+            buffer_deltas[(user_id, blob.type)][0] += token_size
+            buffer_deltas[(user_id, blob.type)][1] += 1
+        for (user_id, blob_type), (token_size, blob_count) in buffer_deltas.items():
+            await incr_buffer_state(
+                user_id, project_id, blob_type, token_size, blob_count=blob_count
+            )
+
+        p = await flush_detected_buffers(
+            project_id, buffer_keys, detect_buffer_full_or_not, results
+        )
+        if not p.ok():
+            return p
+    return Promise.resolve(BlobsInsertData(ids=blob_ids, **results.model_dump()))
+
+
+async def flush_detected_buffers(
+    project_id: str,
+    buffer_keys: list[tuple[str, BlobType]],
+    detect_func: Callable[[str, str, BlobType], Awaitable[Promise[bool]]],
+    results: BufferFlushData,
+) -> Promise[None]:
+    ps = await asyncio.gather(
+        *[detect_func(u, project_id, blob_type) for u, blob_type in buffer_keys]
+    )
+    for p in ps:
+        if not p.ok():
+            return p
+    ps = await asyncio.gather(
+        *[
+            trigger_buffer_flush(u, project_id, blob_type, results)
+            for (u, blob_type), p in zip(buffer_keys, ps)
+            if p.data()
+        ]
+    )
+    for p in ps:
+        if not p.ok():
+            return p
+    return Promise.resolve(None)
+
+
 # If there're ongoing insert, wait for them to finish then flush
 @user_id_lock("insert_blob_to_buffer")
 async def wait_insert_done_then_flush(
@@ -60,89 +363,111 @@ async def wait_insert_done_then_flush(
 async def get_buffer_capacity(
     user_id: str, project_id: str, blob_type: BlobType
 ) -> Promise[int]:
-    with Session() as session:
-        buffer_count = (
-            session.query(BufferZone)
-            .filter_by(user_id=user_id, blob_type=str(blob_type), project_id=project_id)
-            .count()
-        )
-    return Promise.resolve(buffer_count)
+    state = await get_buffer_state(user_id, project_id, blob_type)
+    return Promise.resolve(state.blob_count)
 
 
 async def detect_buffer_full_or_not(
     user_id: str, project_id: str, blob_type: BlobType
-) -> Promise[ChatModalResponse | None]:
-    with Session() as session:
-        # 1. if buffer size reach maximum, flush it
-        buffer_size = (
-            session.query(func.sum(BufferZone.token_size))
-            .filter_by(user_id=user_id, blob_type=str(blob_type), project_id=project_id)
-            .scalar()
+) -> Promise[bool]:
+    # 1. if buffer size reach maximum, flush it
+    state = await get_buffer_state(user_id, project_id, blob_type)
+    if state.token_size > CONFIG.max_chat_blob_buffer_token_size:
+        LOG.info(
+            f"Flush {blob_type} buffer for user {user_id} due to reach maximum token size({state.token_size} > {CONFIG.max_chat_blob_buffer_token_size})"
         )
-        if buffer_size and buffer_size > CONFIG.max_chat_blob_buffer_token_size:
-            LOG.info(
-                f"Flush {blob_type} buffer for user {user_id} due to reach maximum token size({buffer_size} > {CONFIG.max_chat_blob_buffer_token_size})"
-            )
-            p = await flush_buffer(user_id, project_id, blob_type)
-            return p
-    return Promise.resolve(None)
+        return Promise.resolve(True)
+    return Promise.resolve(False)
 
 
 async def detect_buffer_idle_or_not(
     user_id: str, project_id: str, blob_type: BlobType
-) -> Promise[ChatModalResponse | None]:
-    with Session() as session:
-        # if buffer is idle for a long time, flush it
-        last_buffer_update = (
-            session.query(func.max(BufferZone.created_at))
-            .filter_by(user_id=user_id, blob_type=str(blob_type), project_id=project_id)
-            .scalar()
+) -> Promise[bool]:
+    # if buffer is idle for a long time, flush it
+    state = await get_buffer_state(user_id, project_id, blob_type)
+    if (
+        state.blob_count
+        and state.last_insert_at is not None
+        and time.time() - state.last_insert_at > CONFIG.buffer_flush_interval
+    ):
+        LOG.info(
+            f"Flush {blob_type} buffer for user {user_id} due to idle for a long time"
         )
-        if (
-            last_buffer_update
-            and seconds_from_now(last_buffer_update) > CONFIG.buffer_flush_interval
-        ):
-            LOG.info(
-                f"Flush {blob_type} buffer for user {user_id} due to idle for a long time"
+        return Promise.resolve(True)
+    return Promise.resolve(False)
+
+
+async def claim_buffer_rows(
+    user_id: str, project_id: str, blob_type: BlobType, lease_id: UUID
+) -> list[Row]:
+    claimable = (
+        select(BufferZone.id)
+        .filter_by(user_id=user_id, blob_type=str(blob_type), project_id=project_id)
+        .where(
+            or_(
+                BufferZone.flush_lease_expires_at.is_(None),
+                BufferZone.flush_lease_expires_at < func.now(),
             )
-            p = await flush_buffer(user_id, project_id, blob_type)
-            return p
-    return Promise.resolve(None)
+        )
+        .with_for_update(skip_locked=True)
+    )
+    stmt = (
+        update(BufferZone)
+        .where(BufferZone.id.in_(claimable), BufferZone.project_id == project_id)
+        .values(
+            flush_lease_id=lease_id,
+            flush_lease_expires_at=func.now()
+            + timedelta(seconds=CONFIG.buffer_flush_lease_seconds),
+        )
+        .returning(
+            BufferZone.id,
+            BufferZone.blob_id,
+            BufferZone.token_size,
+            BufferZone.created_at,
+        )
+        .execution_options(synchronize_session=False)
+    )
+    async with AsyncSession() as session:
+        rows = (await session.execute(stmt)).all()
+        await session.commit()
+    return sorted(rows, key=lambda r: r.created_at)
 
 
 async def flush_buffer(
     user_id: str, project_id: str, blob_type: BlobType
 ) -> Promise[ChatModalResponse]:
-    # FIXME: parallel calling will cause duplicated flush
     if blob_type not in BLOBS_PROCESS:
         return Promise.reject(CODE.BAD_REQUEST, f"Blob type {blob_type} not supported")
-    with Session() as session:
-        blob_buffers_trans = session.query(BufferZone).filter_by(
-            user_id=user_id, blob_type=str(blob_type), project_id=project_id
-        )
-
-        # Move this outside try-finally to ensure we have the data before proceeding
-        blob_buffers = blob_buffers_trans.order_by(BufferZone.created_at).all()
-        if not blob_buffers:
-            LOG.info(f"No {blob_type} buffer to flush for user {user_id}")
-            return Promise.resolve(None)
+    lease_id = uuid4()
+    blob_buffers = await claim_buffer_rows(user_id, project_id, blob_type, lease_id)
+    if not blob_buffers:
+        LOG.info(f"No {blob_type} buffer to flush for user {user_id}")
+        return Promise.resolve(None)
 
-        blob_ids = [b.blob_id for b in blob_buffers]
-        total_token_size = sum(b.token_size for b in blob_buffers)
-        LOG.info(
-            f"Flush {blob_type} buffer for user {user_id} with {len(blob_buffers)} blobs and total token size({total_token_size})"
-        )
+    blob_ids = [b.blob_id for b in blob_buffers]
+    total_token_size = sum(b.token_size for b in blob_buffers)
+    # only the claimed rows leave the buffer, blobs inserted while this flush
+    # runs keep their counts and idle deadline
+    await decr_buffer_state(
+        user_id, project_id, blob_type, total_token_size, len(blob_buffers)
+    )
+    LOG.info(
+        f"Flush {blob_type} buffer for user {user_id} with {len(blob_buffers)} blobs and total token size({total_token_size})"
+    )
 
     try:
-        with Session() as session:
+        async with AsyncSession() as session:
             # Get and process blob data
             blob_data = (
-                session.query(GeneralBlob.created_at, GeneralBlob.blob_data)
-                .filter(
-                    GeneralBlob.id.in_(blob_ids), GeneralBlob.project_id == project_id
+                await session.execute(
+                    select(GeneralBlob.created_at, GeneralBlob.blob_data)
+                    .where(
+                        GeneralBlob.id.in_(blob_ids),
+                        GeneralBlob.project_id == project_id,
+                    )
+                    .order_by(GeneralBlob.created_at)
                 )
-                .all()
-            )
+            ).all()
             blobs = [pack_blob_from_db(bd, blob_type) for bd in blob_data]
 
         # Process blobs first (moved outside the session)
@@ -156,23 +481,29 @@ async def flush_buffer(
         raise e
 
     finally:
-        with Session() as session:
+        async with AsyncSession() as session:
             try:
-                # Delete buffers and blobs regardless of processing outcome
-
-                session.query(BufferZone).filter_by(
-                    user_id=user_id, blob_type=str(blob_type), project_id=project_id
-                ).delete(synchronize_session=False)
+                # Delete claimed buffers and blobs regardless of processing outcome,
+                # blobs inserted during the flush stay for the next batch
+                await session.execute(
+                    delete(BufferZone)
+                    .filter_by(flush_lease_id=lease_id, project_id=project_id)
+                    .execution_options(synchronize_session=False)
+                )
                 if blob_type == BlobType.chat and not CONFIG.persistent_chat_blobs:
-                    session.query(GeneralBlob).filter(
-                        GeneralBlob.id.in_(blob_ids),
-                        GeneralBlob.project_id == project_id,
-                    ).delete(synchronize_session=False)
-                session.commit()
+                    await session.execute(
+                        delete(GeneralBlob)
+                        .where(
+                            GeneralBlob.id.in_(blob_ids),
+                            GeneralBlob.project_id == project_id,
+                        )
+                        .execution_options(synchronize_session=False)
+                    )
+                await session.commit()
                 LOG.info(
                     f"Flushed {blob_type} buffer(size: {len(blob_buffers)}) for user {user_id}"
                 )
             except Exception as e:
-                session.rollback()
+                await session.rollback()
                 LOG.error(f"Error while deleting buffers/blobs: {e}")
                 raise e
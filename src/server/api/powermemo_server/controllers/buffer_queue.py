@@ -0,0 +1,337 @@
+import json
+import time
+import asyncio
+import traceback
+from uuid import uuid4
+from datetime import datetime
+import redis.exceptions
+from ..env import CONFIG, LOG
+from ..models.utils import Promise
+from ..models.response import CODE, ChatModalResponse, FlushJobData
+from ..models.blob import BlobType
+from ..connectors import get_redis_client, PROJECT_ID
+from ..telemetry import telemetry_manager, HistogramMetricName
+
+FLUSH_STREAM_KEY = f"powermemo::buffer::flush_stream::{PROJECT_ID}"
+FLUSH_GROUP_NAME = "powermemo_flush_workers"
+FLUSH_STREAM_MAXLEN = 100_000
+# un-acked jobs idle longer than this are reclaimed from crashed workers,
+# running jobs reset their idle time every heartbeat so they are never reclaimed
+FLUSH_JOB_RECLAIM_MS = 10 * 60 * 1000
+FLUSH_JOB_HEARTBEAT_SECONDS = FLUSH_JOB_RECLAIM_MS / 1000 / 4
+# seconds to wait after the worker loop hits an error
+FLUSH_WORKER_ERROR_BACKOFF_SECONDS = 5
+
+# sorted set of buffers scored by the time they become idle
+FLUSH_DEADLINES_KEY = f"powermemo::buffer::flush_deadlines::{PROJECT_ID}"
+FLUSH_DEADLINES_BATCH = 100
+# a failed idle flush is swept again after 30s, 60s, ... up to 30 minutes
+FLUSH_RETRY_BASE_SECONDS = 30
+FLUSH_RETRY_MAX_SECONDS = 30 * 60
+
+# Pop expired deadlines atomically, so each idle buffer is swept by one node
+CLAIM_EXPIRED_DEADLINES_SCRIPT = """
+local members = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'WITHSCORES', 'LIMIT', 0, ARGV[2])
+for i = 1, #members, 2 do
+    redis.call('ZREM', KEYS[1], members[i])
+end
+return members
+"""
+
+
+def flush_job_key(job_id: str) -> str:
+    return f"powermemo::buffer::flush_job::{PROJECT_ID}::{job_id}"
+
+
+def flush_deadline_member(user_id: str, project_id: str, blob_type: BlobType) -> str:
+    return json.dumps([project_id, str(user_id), str(blob_type)])
+
+
+def flush_pending_key(user_id: str, project_id: str, blob_type: BlobType) -> str:
+    return f"powermemo::buffer::flush_pending::{PROJECT_ID}::{project_id}::{user_id}::{blob_type}"
+
+
+async def enqueue_flush_job(
+    user_id: str, project_id: str, blob_type: BlobType
+) -> Promise[str]:
+    job_id = str(uuid4())
+    pending_key = flush_pending_key(user_id, project_id, blob_type)
+    now = datetime.now().astimezone().isoformat()
+    async with get_redis_client() as redis_client:
+        # One queued job per buffer is enough, the worker flushes the whole buffer
+        queued = await redis_client.set(
+            pending_key, job_id, nx=True, ex=CONFIG.buffer_flush_job_ttl
+        )
+        if not queued:
+            pending_job_id = await redis_client.get(pending_key)
+            if pending_job_id is not None:
+                return Promise.resolve(pending_job_id)
+            await redis_client.set(pending_key, job_id, ex=CONFIG.buffer_flush_job_ttl)
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.hset(
+                flush_job_key(job_id),
+                mapping={
+                    "status": "pending",
+                    "user_id": user_id,
+                    "project_id": project_id,
+                    "blob_type": str(blob_type),
+                    "created_at": now,
+                    "updated_at": now,
+                },
+            )
+            pipe.expire(flush_job_key(job_id), CONFIG.buffer_flush_job_ttl)
+            pipe.xadd(
+                FLUSH_STREAM_KEY,
+                {"job_id": job_id},
+                maxlen=FLUSH_STREAM_MAXLEN,
+                approximate=True,
+            )
+            await pipe.execute()
+    LOG.info(f"Queued {blob_type} buffer flush job {job_id} for user {user_id}")
+    return Promise.resolve(job_id)
+
+
+async def get_flush_job(
+    user_id: str, project_id: str, job_id: str
+) -> Promise[FlushJobData]:
+    async with get_redis_client() as redis_client:
+        job = await redis_client.hgetall(flush_job_key(job_id))
+    if (
+        not job
+        or job.get("project_id") != project_id
+        or job.get("user_id") != str(user_id)
+    ):
+        return Promise.reject(
+            CODE.NOT_FOUND, f"Flush job {job_id} of user {user_id} not found"
+        )
+    result = job.get("result")
+    return Promise.resolve(
+        FlushJobData(
+            id=job_id,
+            status=job["status"],
+            blob_type=job["blob_type"],
+            result=ChatModalResponse.model_validate_json(result) if result else None,
+            errmsg=job.get("errmsg") or None,
+            created_at=job.get("created_at"),
+            updated_at=job.get("updated_at"),
+        )
+    )
+
+
+async def update_flush_job(job_id: str, **fields) -> None:
+    fields["updated_at"] = datetime.now().astimezone().isoformat()
+    async with get_redis_client() as redis_client:
+        await redis_client.hset(flush_job_key(job_id), mapping=fields)
+        await redis_client.expire(flush_job_key(job_id), CONFIG.buffer_flush_job_ttl)
+
+
+async def process_flush_job(job_id: str) -> None:
+    from .buffer import flush_buffer
+
+    async with get_redis_client() as redis_client:
+        job = await redis_client.hgetall(flush_job_key(job_id))
+        if not job:
+            LOG.warning(f"Flush job {job_id} expired before processing")
+            return
+        user_id, project_id = job["user_id"], job["project_id"]
+        blob_type = BlobType(job["blob_type"])
+        # Inserts from now on must queue a new job, this one may miss their blobs
+        pending_key = flush_pending_key(user_id, project_id, blob_type)
+        if await redis_client.get(pending_key) == job_id:
+            await redis_client.delete(pending_key)
+    await update_flush_job(job_id, status="processing")
+
+    try:
+        # no insert lock, the claimed rows are leased so inserts keep going
+        p = await flush_buffer(user_id, project_id, blob_type)
+    except Exception as e:
+        LOG.error(f"Error in flush job {job_id}: {e}, {traceback.format_exc()}")
+        await update_flush_job(job_id, status="failed", errmsg=str(e))
+        return
+    if not p.ok():
+        await update_flush_job(job_id, status="failed", errmsg=p.msg())
+        return
+    result = p.data()
+    await update_flush_job(
+        job_id,
+        status="done",
+        result=result.model_dump_json() if result is not None else "",
+    )
+
+
+async def ensure_flush_group() -> None:
+    async with get_redis_client() as redis_client:
+        try:
+            await redis_client.xgroup_create(
+                FLUSH_STREAM_KEY, FLUSH_GROUP_NAME, id="0", mkstream=True
+            )
+        except redis.exceptions.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise e
+
+
+async def keep_flush_job_claimed(consumer_name: str, message_id: str) -> None:
+    while True:
+        await asyncio.sleep(FLUSH_JOB_HEARTBEAT_SECONDS)
+        try:
+            async with get_redis_client() as redis_client:
+                # claiming our own message resets its idle time
+                await redis_client.xclaim(
+                    FLUSH_STREAM_KEY,
+                    FLUSH_GROUP_NAME,
+                    consumer_name,
+                    min_idle_time=0,
+                    message_ids=[message_id],
+                    justid=True,
+                )
+        except redis.exceptions.RedisError as e:
+            LOG.warning(f"Failed to keep flush job {message_id} claimed: {e}")
+
+
+async def read_flush_jobs(consumer_name: str, block_ms: int) -> list:
+    async with get_redis_client() as redis_client:
+        claimed = await redis_client.xautoclaim(
+            FLUSH_STREAM_KEY,
+            FLUSH_GROUP_NAME,
+            consumer_name,
+            min_idle_time=FLUSH_JOB_RECLAIM_MS,
+            start_id="0-0",
+            count=CONFIG.buffer_flush_worker_concurrency,
+        )
+        if claimed[1]:
+            messages = claimed[1]
+        else:
+            streams = await redis_client.xreadgroup(
+                FLUSH_GROUP_NAME,
+                consumer_name,
+                {FLUSH_STREAM_KEY: ">"},
+                count=CONFIG.buffer_flush_worker_concurrency,
+                block=block_ms,
+            )
+            messages = streams[0][1] if streams else []
+        return messages
+
+
+async def run_flush_worker(consumer_name: str, block_ms: int = 5000) -> None:
+    semaphore = asyncio.Semaphore(CONFIG.buffer_flush_worker_concurrency)
+    running: set[asyncio.Task] = set()
+
+    async def consume(message_id: str, job_id: str):
+        heartbeat = asyncio.create_task(
+            keep_flush_job_claimed(consumer_name, message_id)
+        )
+        try:
+            try:
+                await process_flush_job(job_id)
+            except Exception as e:
+                LOG.error(f"Error in flush job {job_id}: {e}, {traceback.format_exc()}")
+                # a job must end up done or failed before it's acked
+                await update_flush_job(job_id, status="failed", errmsg=str(e))
+            async with get_redis_client() as redis_client:
+                await redis_client.xack(FLUSH_STREAM_KEY, FLUSH_GROUP_NAME, message_id)
+        except Exception as e:
+            # left un-acked, it's reclaimed and run again after the reclaim time
+            LOG.error(f"Failed to finish flush job {job_id}: {e}")
+        finally:
+            heartbeat.cancel()
+            semaphore.release()
+
+    group_ready = False
+    LOG.info(f"Flush worker {consumer_name} is consuming {FLUSH_STREAM_KEY}")
+    while True:
+        try:
+            if not group_ready:
+                await ensure_flush_group()
+                group_ready = True
+            messages = await read_flush_jobs(consumer_name, block_ms)
+        except Exception as e:
+            # keep consuming once Redis is back, don't take the worker down
+            LOG.error(f"Error reading flush jobs: {e}, {traceback.format_exc()}")
+            # the group is gone with the stream if its key was deleted
+            group_ready = False
+            await asyncio.sleep(FLUSH_WORKER_ERROR_BACKOFF_SECONDS)
+            continue
+        for message_id, fields in messages:
+            if not fields:
+                # trimmed from the stream before being reclaimed
+                continue
+            await semaphore.acquire()
+            task = asyncio.create_task(consume(message_id, fields["job_id"]))
+            running.add(task)
+            task.add_done_callback(running.discard)
+
+
+async def claim_expired_deadlines() -> list[tuple[str, float]]:
+    async with get_redis_client() as redis_client:
+        members = await redis_client.eval(
+            CLAIM_EXPIRED_DEADLINES_SCRIPT,
+            1,
+            FLUSH_DEADLINES_KEY,
+            time.time(),
+            FLUSH_DEADLINES_BATCH,
+        )
+    return [(members[i], float(members[i + 1])) for i in range(0, len(members), 2)]
+
+
+async def run_idle_flush_sweeper(poll_interval: float = 5) -> None:
+    from .buffer import flush_buffer
+
+    semaphore = asyncio.Semaphore(CONFIG.buffer_idle_flush_concurrency)
+    running: set[asyncio.Task] = set()
+    # failed flushes of each buffer on this node, for the retry backoff
+    failures: dict[str, int] = {}
+
+    async def reschedule(member: str):
+        failures[member] = failures.get(member, 0) + 1
+        delay = min(
+            FLUSH_RETRY_BASE_SECONDS * 2 ** (failures[member] - 1),
+            FLUSH_RETRY_MAX_SECONDS,
+        )
+        try:
+            async with get_redis_client() as redis_client:
+                # a newer insert may have scheduled the buffer already
+                await redis_client.zadd(
+                    FLUSH_DEADLINES_KEY, {member: time.time() + delay}, nx=True
+                )
+        except redis.exceptions.RedisError as e:
+            LOG.error(f"Failed to reschedule idle buffer {member}: {e}")
+
+    async def sweep(member: str, deadline: float):
+        try:
+            project_id, user_id, blob_type = json.loads(member)
+            telemetry_manager.record_histogram_metric(
+                HistogramMetricName.BUFFER_FLUSH_LAG_MS,
+                (time.time() - deadline) * 1000,
+                {"project_id": project_id},
+            )
+            LOG.info(
+                f"Flush {blob_type} buffer for user {user_id} due to idle for a long time"
+            )
+            p = await flush_buffer(user_id, project_id, BlobType(blob_type))
+            if not p.ok():
+                LOG.error(f"Failed to flush idle buffer {member}: {p.msg()}")
+                await reschedule(member)
+            else:
+                failures.pop(member, None)
+        except Exception as e:
+            LOG.error(f"Error flushing idle buffer {member}: {e}, {traceback.format_exc()}")
+            await reschedule(member)
+        finally:
+            semaphore.release()
+
+    LOG.info(f"Idle flush sweeper is watching {FLUSH_DEADLINES_KEY}")
+    while True:
+        try:
+            claimed = await claim_expired_deadlines()
+        except Exception as e:
+            # keep sweeping once Redis is back, don't take the worker down
+            LOG.error(f"Error claiming idle buffers: {e}, {traceback.format_exc()}")
+            claimed = []
+        if not claimed:
+            await asyncio.sleep(poll_interval)
+            continue
+        for member, deadline in claimed:
+            await semaphore.acquire()
+            task = asyncio.create_task(sweep(member, deadline))
+            running.add(task)
+            task.add_done_callback(running.discard)
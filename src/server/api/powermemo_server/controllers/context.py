@@ -1,13 +1,17 @@
 from ..models.utils import Promise
 from ..models.response import ContextData, OpenAICompatibleMessage
 from ..prompts.chat_context_pack import CONTEXT_PROMPT_PACK
-from ..utils import get_encoded_tokens, event_str_repr
+from ..utils import event_str_repr
+from ..utils import profile_str_repr
 from ..env import CONFIG, LOG
 from .project import get_project_profile_config
 from .profile import get_user_profiles, truncate_profiles
 from .post_process.profile import filter_profiles_with_chats
 from .event import get_user_events, search_user_events, truncate_events
 
+PROFILE_SEPARATOR_TOKENS = 2
+EVENT_SEPARATOR_TOKENS = 3
+
 
 async def get_user_context(
     user_id: str,
@@ -33,7 +37,13 @@ async def get_user_context(
     use_language = profile_config.language or CONFIG.language
     context_prompt_func = CONTEXT_PROMPT_PACK[use_language]
 
-    p = await get_user_profiles(user_id, project_id)
+    p = await get_user_profiles(
+        user_id,
+        project_id,
+        only_topics=only_topics,
+        max_subtopic_size=max_subtopic_size,
+        topic_limits=topic_limits,
+    )
     if not p.ok():
         return p
     total_profiles = p.data()
@@ -62,15 +72,16 @@ async def get_user_context(
         use_profiles = use_profiles.data().profiles
 
         profile_section = "- " + "\n- ".join(
-            [
-                f"{p.attributes.get('topic')}::{p.attributes.get('sub_topic')}: {p.content}"
-                for p in use_profiles
-            ]
+            [profile_str_repr(p.attributes, p.content) for p in use_profiles]
         )
+        # token sizes are stored with the profiles, "- " and "\n- " cost 1~2 tokens
+        profile_section_tokens = sum(
+            p.token_size or 0 for p in use_profiles
+        ) + PROFILE_SEPARATOR_TOKENS * len(use_profiles)
     else:
         profile_section = ""
+        profile_section_tokens = 0
 
-    profile_section_tokens = len(get_encoded_tokens(profile_section))
     max_event_token_size = max_token_size - profile_section_tokens
     if max_event_token_size <= 0:
         return Promise.resolve(
@@ -102,7 +113,10 @@ async def get_user_context(
         return p
     user_events = p.data()
     event_section = "\n---\n".join([event_str_repr(ed) for ed in user_events.events])
-    event_section_tokens = len(get_encoded_tokens(event_section))
+    # token sizes are stored with the events, "\n---\n" costs ~3 tokens
+    event_section_tokens = sum(
+        e.token_size or 0 for e in user_events.events
+    ) + EVENT_SEPARATOR_TOKENS * max(len(user_events.events) - 1, 0)
     LOG.info(
         f"Retrived {len(use_profiles)} profiles({profile_section_tokens} tokens), {len(user_events.events)} events({event_section_tokens} tokens)"
     )
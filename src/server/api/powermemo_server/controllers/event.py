@@ -1,46 +1,70 @@
+import re
+import asyncio
+import traceback
+from itertools import groupby, accumulate
+from bisect import bisect_right
 from pydantic import ValidationError
 from ..models.database import UserEvent
 from ..models.response import UserEventData, UserEventsData, EventData
 from ..models.utils import Promise, CODE
-from ..connectors import Session
-from ..utils import get_encoded_tokens, event_str_repr, event_embedding_str
+from ..connectors import AsyncSession
+from ..utils import event_str_repr, event_data_str_repr, event_embedding_str
+from ..tokenizer import count_tokens, count_tokens_batch
 
 from ..llms.embeddings import get_embedding
 from datetime import timedelta
-from sqlalchemy import desc, select
+from typing import Literal
+from sqlalchemy import select, update, union_all, literal, or_, bindparam
+from sqlalchemy.orm import aliased
+from sqlalchemy.dialects.postgresql import REGCONFIG
 from sqlalchemy.sql import func
 from ..env import LOG, CONFIG
 
 
+def pack_event_data(user_event: UserEvent, similarity: float = None) -> UserEventData:
+    return UserEventData(
+        id=user_event.id,
+        event_data=user_event.event_data,
+        created_at=user_event.created_at,
+        updated_at=user_event.updated_at,
+        similarity=similarity,
+        token_size=user_event.token_size,
+        event_str=user_event.event_str,
+    )
+
+
+async def fill_events_token_size(events: list[UserEventData]) -> None:
+    missing = [e for e in events if e.token_size is None]
+    if not missing:
+        return
+    token_sizes = await count_tokens_batch([event_str_repr(e) for e in missing])
+    for e, token_size in zip(missing, token_sizes):
+        e.token_size = token_size
+
+
 async def get_user_events(
     user_id: str,
     project_id: str,
     topk: int = 10,
     need_summary: bool = False,
 ) -> Promise[UserEventsData]:
-    with Session() as session:
-        query = session.query(UserEvent).filter_by(
-            user_id=user_id, project_id=project_id
-        )
+    async with AsyncSession() as session:
+        query = select(UserEvent).filter_by(user_id=user_id, project_id=project_id)
         if need_summary:
             query = query.filter(
                 UserEvent.event_data.contains({"event_tip": None}).is_(False)
             ).filter(UserEvent.event_data.has_key("event_tip"))
-        user_events = query.order_by(UserEvent.created_at.desc()).limit(topk).all()
+        user_events = (
+            await session.scalars(
+                query.order_by(UserEvent.created_at.desc()).limit(topk)
+            )
+        ).all()
         if user_events is None:
             return Promise.reject(
                 CODE.NOT_FOUND,
                 f"No user events found for user {user_id}",
             )
-        results = [
-            {
-                "id": ue.id,
-                "event_data": ue.event_data,
-                "created_at": ue.created_at,
-                "updated_at": ue.updated_at,
-            }
-            for ue in user_events
-        ]
+        results = [pack_event_data(ue) for ue in user_events]
     events = UserEventsData(events=results)
     return Promise.resolve(events)
 
@@ -51,17 +75,32 @@ async def truncate_events(
 ) -> Promise[UserEventsData]:
     if max_token_size is None:
         return Promise.resolve(events)
-    c_tokens = 0
-    truncated_results = []
-    for r in events.events:
-        c_tokens += len(get_encoded_tokens(event_str_repr(r)))
-        if c_tokens > max_token_size:
-            break
-        truncated_results.append(r)
-    events.events = truncated_results
+    await fill_events_token_size(events.events)
+    prefix_sizes = list(accumulate(e.token_size for e in events.events))
+    events.events = events.events[: bisect_right(prefix_sizes, max_token_size)]
     return Promise.resolve(events)
 
 
+async def embed_events(project_id: str, events: list[EventData]) -> list:
+    p = await get_embedding(
+        project_id,
+        [event_embedding_str(e) for e in events],
+        phase="document",
+        model=CONFIG.embedding_model,
+    )
+    if not p.ok():
+        LOG.error(f"Failed to get embeddings: {p.msg()}")
+        return [None] * len(events)
+    embeddings = p.data()
+    embedding_dim_current = embeddings.shape[-1]
+    if embedding_dim_current != CONFIG.embedding_dim:
+        LOG.error(
+            f"Embedding dimension mismatch! Expected {CONFIG.embedding_dim}, got {embedding_dim_current}."
+        )
+        return [None] * len(events)
+    return list(embeddings)
+
+
 async def append_user_event(
     user_id: str, project_id: str, event_data: dict
 ) -> Promise[str]:
@@ -74,37 +113,25 @@ async def append_user_event(
             f"Invalid event data: {str(e)}",
         )
 
-    if CONFIG.enable_event_embedding:
-        event_data_str = event_embedding_str(validated_event)
-        embedding = await get_embedding(
-            project_id,
-            [event_data_str],
-            phase="document",
-            model=CONFIG.embedding_model,
-        )
-        if not embedding.ok():
-            LOG.error(f"Failed to get embeddings: {embedding.msg()}")
-            embedding = [None]
-        else:
-            embedding = embedding.data()
-            embedding_dim_current = embedding.shape[-1]
-            if embedding_dim_current != CONFIG.embedding_dim:
-                LOG.error(
-                    f"Embedding dimension mismatch! Expected {CONFIG.embedding_dim}, got {embedding_dim_current}."
-                )
-                embedding = [None]
+    event_str = event_data_str_repr(validated_event)
+    token_size = await count_tokens(event_str)
+    if CONFIG.enable_event_embedding and not CONFIG.defer_event_embedding:
+        # a failed embedding is left NULL and retried by the background embedder
+        embedding = await embed_events(project_id, [validated_event])
     else:
         embedding = [None]
 
-    with Session() as session:
+    async with AsyncSession() as session:
         user_event = UserEvent(
             user_id=user_id,
             project_id=project_id,
             event_data=validated_event.model_dump(),
             embedding=embedding[0],
+            event_str=event_str,
+            token_size=token_size,
         )
         session.add(user_event)
-        session.commit()
+        await session.commit()
         eid = user_event.id
     return Promise.resolve(eid)
 
@@ -112,19 +139,19 @@ async def append_user_event(
 async def delete_user_event(
     user_id: str, project_id: str, event_id: str
 ) -> Promise[None]:
-    with Session() as session:
-        user_event = (
-            session.query(UserEvent)
-            .filter_by(user_id=user_id, project_id=project_id, id=event_id)
-            .first()
+    async with AsyncSession() as session:
+        user_event = await session.scalar(
+            select(UserEvent).filter_by(
+                user_id=user_id, project_id=project_id, id=event_id
+            )
         )
         if user_event is None:
             return Promise.reject(
                 CODE.NOT_FOUND,
                 f"User event {event_id} not found",
             )
-        session.delete(user_event)
-        session.commit()
+        await session.delete(user_event)
+        await session.commit()
     return Promise.resolve(None)
 
 
@@ -139,11 +166,11 @@ async def update_user_event(
             f"Invalid event data: {str(e)}",
         )
     need_to_update = {k: v for k, v in event_data.items() if v is not None}
-    with Session() as session:
-        user_event = (
-            session.query(UserEvent)
-            .filter_by(user_id=user_id, project_id=project_id, id=event_id)
-            .first()
+    async with AsyncSession() as session:
+        user_event = await session.scalar(
+            select(UserEvent).filter_by(
+                user_id=user_id, project_id=project_id, id=event_id
+            )
         )
         if user_event is None:
             return Promise.reject(
@@ -152,12 +179,102 @@ async def update_user_event(
             )
         new_events = dict(user_event.event_data)
         new_events.update(need_to_update)
+        try:
+            event_str = event_data_str_repr(EventData(**new_events))
+        except ValidationError as e:
+            return Promise.reject(
+                CODE.INTERNAL_SERVER_ERROR,
+                f"Invalid event data: {str(e)}",
+            )
 
         user_event.event_data = new_events
-        session.commit()
+        user_event.event_str = event_str
+        user_event.token_size = await count_tokens(event_str)
+        await session.commit()
     return Promise.resolve(None)
 
 
+# seconds an embedder holds the events it claimed
+EVENT_EMBEDDING_LEASE_SECONDS = 300
+
+# RRF score of a rank is 1 / (k + rank), k=60 is the usual choice
+RRF_K = 60
+HYBRID_CANDIDATES_FACTOR = 4
+# pgvector rejects a larger hnsw.ef_search
+MAX_EF_SEARCH = 1000
+
+
+def lexical_or_query(query: str) -> str:
+    # match any of the words, plain/websearch tsquery would require all of them
+    return " | ".join(f"'{w}'" for w in re.findall(r"\w+", query.lower()))
+
+
+def vector_search_source(conditions):
+    """Return the events the vector search reads from and the conditions left to
+    apply on them"""
+    if CONFIG.event_search_iterative_scan:
+        return UserEvent, conditions
+    # the HNSW index covers the events of every user and the conditions only
+    # filter the `ef_search` rows it returns, so a user could get few or no
+    # events. Without iterative scan, scan the events of the user exactly.
+    # The CTE must not be named after the table, the lexical arm and the final
+    # select of the hybrid search read the table itself to use its indexes
+    candidates = (
+        select(UserEvent.__table__)
+        .where(*conditions)
+        .cte("user_event_candidates")
+        .prefix_with("MATERIALIZED")
+    )
+    return aliased(UserEvent, candidates), ()
+
+
+def hybrid_search_stmt(conditions, query_embedding, query, topk, similarity_threshold):
+    candidates = topk * HYBRID_CANDIDATES_FACTOR
+    events, vector_conditions = vector_search_source(conditions)
+    vector_distance = events.embedding.cosine_distance(query_embedding)
+    vector_ranks = (
+        select(
+            events.id.label("id"),
+            func.row_number().over(order_by=vector_distance).label("rank"),
+        )
+        .where(
+            *vector_conditions,
+            events.embedding.is_not(None),
+            vector_distance < 1 - similarity_threshold,
+        )
+        .order_by(vector_distance)
+        .limit(candidates)
+    )
+    ranks = [vector_ranks]
+    or_query = lexical_or_query(query)
+    if or_query:
+        ts_query = func.to_tsquery(literal("simple").cast(REGCONFIG), or_query)
+        ts_rank = func.ts_rank_cd(UserEvent.search_vector, ts_query)
+        ranks.append(
+            select(
+                UserEvent.id.label("id"),
+                func.row_number().over(order_by=ts_rank.desc()).label("rank"),
+            )
+            .where(*conditions, UserEvent.search_vector.op("@@")(ts_query))
+            .order_by(ts_rank.desc())
+            .limit(candidates)
+        )
+    fused = union_all(*ranks).subquery("ranks")
+    scores = (
+        select(fused.c.id, func.sum(1.0 / (RRF_K + fused.c.rank)).label("score"))
+        .group_by(fused.c.id)
+        .subquery("scores")
+    )
+    distance = UserEvent.embedding.cosine_distance(query_embedding)
+    return (
+        select(UserEvent, distance.label("distance"))
+        .join(scores, UserEvent.id == scores.c.id)
+        .where(*conditions)
+        .order_by(scores.c.score.desc())
+        .limit(topk)
+    )
+
+
 async def search_user_events(
     user_id: str,
     project_id: str,
@@ -165,6 +282,8 @@ async def search_user_events(
     topk: int = 10,
     similarity_threshold: float = 0.6,
     time_range_in_days: int = 21,
+    ef_search: int = None,
+    search_mode: Literal["vector", "hybrid"] = None,
 ) -> Promise[UserEventsData]:
     if not CONFIG.enable_event_embedding:
         return Promise.reject(
@@ -180,42 +299,176 @@ async def search_user_events(
         return query_embeddings
     query_embedding = query_embeddings.data()[0]
 
-    stmt = (
-        select(
-            UserEvent,
-            (1 - UserEvent.embedding.cosine_distance(query_embedding)).label(
-                "similarity"
-            ),
+    search_mode = search_mode or CONFIG.event_search_mode
+    conditions = (
+        UserEvent.user_id == user_id,
+        UserEvent.project_id == project_id,
+        UserEvent.created_at > func.now() - timedelta(days=time_range_in_days),
+    )
+    if search_mode == "hybrid":
+        stmt = hybrid_search_stmt(
+            conditions, query_embedding, query, topk, similarity_threshold
         )
-        .where(UserEvent.user_id == user_id, UserEvent.project_id == project_id)
-        .where(UserEvent.created_at > func.now() - timedelta(days=time_range_in_days))
-        .where(
-            (1 - UserEvent.embedding.cosine_distance(query_embedding))
-            > similarity_threshold
+        candidates = topk * HYBRID_CANDIDATES_FACTOR
+    else:
+        # order by the bare distance so the HNSW index can be used, the
+        # threshold is applied to the top k rows afterwards
+        events, vector_conditions = vector_search_source(conditions)
+        distance = events.embedding.cosine_distance(query_embedding)
+        stmt = (
+            select(events, distance.label("distance"))
+            .where(*vector_conditions, events.embedding.is_not(None))
+            .order_by(distance)
+            .limit(topk)
         )
-        .order_by(desc("similarity"))
-        .limit(topk)
+        candidates = topk
+    # an index scan returns at most `ef_search` rows
+    ef_search = min(
+        max(ef_search or CONFIG.event_search_ef_search, candidates), MAX_EF_SEARCH
     )
 
-    with Session() as session:
+    async with AsyncSession() as session:
+        await session.execute(
+            select(func.set_config("hnsw.ef_search", str(ef_search), True))
+        )
+        if CONFIG.event_search_iterative_scan:
+            await session.execute(
+                select(
+                    func.set_config(
+                        "hnsw.iterative_scan", CONFIG.event_search_iterative_scan, True
+                    )
+                )
+            )
         # Use .all() instead of .scalars().all() to get both columns
-        result = session.execute(stmt).all()
+        result = (await session.execute(stmt)).all()
         user_events: list[UserEventData] = []
         for row in result:
             user_event: UserEvent = row[0]  # UserEvent object
-            similarity: float = row[1]  # similarity value
-            user_events.append(
-                UserEventData(
-                    id=user_event.id,
-                    event_data=user_event.event_data,
-                    created_at=user_event.created_at,
-                    updated_at=user_event.updated_at,
-                    similarity=similarity,
-                )
-            )
+            # lexical only matches of hybrid search may have no embedding
+            similarity = 1 - row[1] if row[1] is not None else None
+            if search_mode == "vector" and similarity <= similarity_threshold:
+                break
+            user_events.append(pack_event_data(user_event, similarity))
 
         # Create UserEventsData with the events
         user_events_data = UserEventsData(events=user_events)
         LOG.info(f"Event Query: {query}")
 
     return Promise.resolve(user_events_data)
+
+
+async def claim_pending_events(batch_size: int) -> list[tuple[str, str, dict]]:
+    """Lease a batch of events whose embedding is NULL to this embedder"""
+    async with AsyncSession() as session:
+        # rows locked by other embedders are skipped, so nodes don't collide
+        pending_ids = (
+            select(UserEvent.id)
+            .where(
+                UserEvent.embedding.is_(None),
+                UserEvent.embedding_attempts < CONFIG.event_embedding_max_attempts,
+                or_(
+                    UserEvent.embedding_leased_until.is_(None),
+                    UserEvent.embedding_leased_until < func.now(),
+                ),
+            )
+            .order_by(UserEvent.created_at.desc())
+            .limit(batch_size)
+            .with_for_update(skip_locked=True)
+            .scalar_subquery()
+        )
+        # the attempt is counted when it starts, an embedder that dies keeps
+        # the lease until it expires and the event is retried afterwards
+        claimed = (
+            await session.execute(
+                update(UserEvent)
+                .where(UserEvent.id.in_(pending_ids))
+                .values(
+                    embedding_attempts=UserEvent.embedding_attempts + 1,
+                    embedding_leased_until=func.now()
+                    + timedelta(seconds=EVENT_EMBEDDING_LEASE_SECONDS),
+                    # bookkeeping of the embedder, the event didn't change
+                    updated_at=UserEvent.updated_at,
+                )
+                .returning(UserEvent.id, UserEvent.project_id, UserEvent.event_data)
+                .execution_options(synchronize_session=False)
+            )
+        ).all()
+        await session.commit()
+    return [tuple(row) for row in claimed]
+
+
+async def embed_pending_events(batch_size: int) -> int:
+    """Embed a batch of events whose embedding is NULL, returns the batch size"""
+    # no transaction is open while the embeddings are requested
+    claimed = await claim_pending_events(batch_size)
+    if not claimed:
+        return 0
+
+    valid_events: list[tuple[str, str, EventData]] = []
+    invalid_ids = []
+    for event_id, project_id, event_data in claimed:
+        try:
+            valid_events.append((event_id, project_id, EventData(**event_data)))
+        except ValidationError as e:
+            LOG.error(f"Invalid event data of {event_id}: {e}")
+            invalid_ids.append(event_id)
+    # embedding tokens are recorded per project
+    valid_events.sort(key=lambda item: item[1])
+    groups = [
+        list(group) for _, group in groupby(valid_events, key=lambda item: item[1])
+    ]
+    results = await asyncio.gather(
+        *[embed_events(group[0][1], [e for _, _, e in group]) for group in groups]
+    )
+    embedded = [
+        {"event_id": event_id, "event_embedding": embedding}
+        for group, embeddings in zip(groups, results)
+        for (event_id, _, _), embedding in zip(group, embeddings)
+        if embedding is not None
+    ]
+
+    async with AsyncSession() as session:
+        if embedded:
+            # failed events keep their lease and are retried once it expires
+            # executemany on the table, the ORM bulk update takes no WHERE
+            events_table = UserEvent.__table__
+            await session.execute(
+                update(events_table)
+                .where(
+                    events_table.c.id == bindparam("event_id"),
+                    events_table.c.embedding.is_(None),
+                )
+                .values(
+                    embedding=bindparam("event_embedding"),
+                    embedding_leased_until=None,
+                    updated_at=events_table.c.updated_at,
+                ),
+                embedded,
+            )
+        if invalid_ids:
+            await session.execute(
+                update(UserEvent)
+                .where(UserEvent.id.in_(invalid_ids))
+                .values(
+                    embedding_attempts=CONFIG.event_embedding_max_attempts,
+                    updated_at=UserEvent.updated_at,
+                )
+                .execution_options(synchronize_session=False)
+            )
+        await session.commit()
+    return len(claimed)
+
+
+async def run_event_embedder(poll_interval: float = 5) -> None:
+    if not CONFIG.enable_event_embedding:
+        return
+    LOG.info("Event embedder is watching events without embeddings")
+    while True:
+        try:
+            embedded = await embed_pending_events(CONFIG.event_embedding_batch_size)
+        except Exception as e:
+            LOG.error(f"Error embedding pending events: {e}, {traceback.format_exc()}")
+            embedded = 0
+        # keep going while there is a backlog
+        if embedded < CONFIG.event_embedding_batch_size:
+            await asyncio.sleep(poll_interval)
@@ -1,6 +1,7 @@
 from . import user
 from . import blob
 from . import buffer
+from . import buffer_queue
 from . import profile
 from . import project
 from . import event
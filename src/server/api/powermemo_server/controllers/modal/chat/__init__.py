@@ -1,33 +1,35 @@
 import asyncio
+from sqlalchemy.ext.asyncio import AsyncSession as SQLAsyncSession
 
 from ....env import LOG, ProfileConfig
 from ....models.blob import Blob
 from ....models.utils import Promise
-from ....models.response import IdsData, ChatModalResponse
-from ...profile import add_user_profiles, update_user_profiles, delete_user_profiles
+from ....models.response import IdsData, ChatModalResponse, ProfileData
+from ....connectors import AsyncSession
+from ...profile import (
+    prepare_profile_writes,
+    insert_profiles,
+    bulk_update_profiles,
+    bulk_delete_profiles,
+    patch_profiles_cache,
+)
 from ...event import append_user_event
-from .extract import extract_topics
 from .merge import merge_or_valid_new_memos
 from .summary import re_summary
 from .organize import organize_profiles
 from .types import MergeAddResult
 from .event_summary import tag_event
-from .entry_summary import entry_summary
+from .summary_extract import summary_and_extract
 
 
 async def process_blobs(
     user_id: str, project_id: str, blob_ids: list[str], blobs: list[Blob]
 ) -> Promise[ChatModalResponse]:
     # 1. Extract patch profiles
-    p = await entry_summary(user_id, project_id, blobs)
+    p = await summary_and_extract(user_id, project_id, blobs)
     if not p.ok():
         return p
-    user_memo_str = p.data()
-
-    p = await extract_topics(user_id, project_id, user_memo_str)
-    if not p.ok():
-        return p
-    extracted_data = p.data()
+    user_memo_str, extracted_data = p.data()
 
     # 2. Merge it to thw whole profile
     p = await merge_or_valid_new_memos(
@@ -74,19 +76,46 @@ async def process_blobs(
     if not p.ok():
         LOG.error(f"Failed to re-summary profiles: {p.msg()}")
 
-    # DB commit
-    p = await exe_user_profile_add(user_id, project_id, profile_options)
-    if not p.ok():
-        return p
-    add_profile_ids = p.data().ids
-    p = await exe_user_profile_update(user_id, project_id, profile_options)
-    if not p.ok():
-        return p
-    update_profile_ids = p.data().ids
-    p = await exe_user_profile_delete(user_id, project_id, profile_options)
-    if not p.ok():
-        return p
-    delete_profile_ids = p.data().ids
+    # embed before the transaction, it only writes
+    add_prepared = await prepare_profile_writes(
+        project_id,
+        [ap["content"] for ap in profile_options["add"]],
+        [ap["attributes"] for ap in profile_options["add"]],
+    )
+    update_prepared = await prepare_profile_writes(
+        project_id,
+        [up["content"] for up in profile_options["update"]],
+        [up["attributes"] for up in profile_options["update"]],
+    )
+    # DB commit, all profile changes land in one transaction
+    async with AsyncSession() as session:
+        p = await exe_user_profile_add(
+            session, user_id, project_id, profile_options, add_prepared
+        )
+        if not p.ok():
+            return p
+        add_profiles = p.data()
+        p = await exe_user_profile_update(
+            session, user_id, project_id, profile_options, update_prepared
+        )
+        if not p.ok():
+            return p
+        update_profiles = p.data()
+        p = await exe_user_profile_delete(
+            session, user_id, project_id, profile_options
+        )
+        if not p.ok():
+            return p
+        delete_profile_ids = p.data().ids
+        await session.commit()
+    await patch_profiles_cache(
+        user_id,
+        project_id,
+        upserts=add_profiles + update_profiles,
+        deletes=delete_profile_ids,
+    )
+    add_profile_ids = [ap.id for ap in add_profiles]
+    update_profile_ids = [up.id for up in update_profiles]
     return Promise.resolve(
         ChatModalResponse(
             event_id=eid,
@@ -126,43 +155,56 @@ async def handle_session_event(
 
 
 async def exe_user_profile_add(
-    user_id: str, project_id: str, profile_options: MergeAddResult
-) -> Promise[IdsData]:
+    session: SQLAsyncSession,
+    user_id: str,
+    project_id: str,
+    profile_options: MergeAddResult,
+    prepared: tuple[list[int | None], list],
+) -> Promise[list[ProfileData]]:
     if not len(profile_options["add"]):
-        return Promise.resolve(IdsData(ids=[]))
+        return Promise.resolve([])
     LOG.info(f"Adding {len(profile_options['add'])} profiles for user {user_id}")
-    task_add = await add_user_profiles(
+    added = await insert_profiles(
+        session,
         user_id,
         project_id,
         [ap["content"] for ap in profile_options["add"]],
         [ap["attributes"] for ap in profile_options["add"]],
+        *prepared,
     )
-    return task_add
+    return Promise.resolve(added)
 
 
 async def exe_user_profile_update(
-    user_id: str, project_id: str, profile_options: MergeAddResult
-) -> Promise[IdsData]:
+    session: SQLAsyncSession,
+    user_id: str,
+    project_id: str,
+    profile_options: MergeAddResult,
+    prepared: tuple[list[int | None], list],
+) -> Promise[list[ProfileData]]:
     if not len(profile_options["update"]):
-        return Promise.resolve(IdsData(ids=[]))
+        return Promise.resolve([])
     LOG.info(f"Updating {len(profile_options['update'])} profiles for user {user_id}")
-    task_update = await update_user_profiles(
+    updated = await bulk_update_profiles(
+        session,
         user_id,
         project_id,
         [up["profile_id"] for up in profile_options["update"]],
         [up["content"] for up in profile_options["update"]],
         [up["attributes"] for up in profile_options["update"]],
+        *prepared,
     )
-    return task_update
+    return Promise.resolve(updated)
 
 
 async def exe_user_profile_delete(
-    user_id: str, project_id: str, profile_options: MergeAddResult
-) -> Promise[None]:
+    session: SQLAsyncSession,
+    user_id: str,
+    project_id: str,
+    profile_options: MergeAddResult,
+) -> Promise[IdsData]:
     if not len(profile_options["delete"]):
         return Promise.resolve(IdsData(ids=[]))
     LOG.info(f"Deleting {len(profile_options['delete'])} profiles for user {user_id}")
-    task_delete = await delete_user_profiles(
-        user_id, project_id, profile_options["delete"]
-    )
-    return task_delete
+    await bulk_delete_profiles(session, user_id, project_id, profile_options["delete"])
+    return Promise.resolve(IdsData(ids=profile_options["delete"]))
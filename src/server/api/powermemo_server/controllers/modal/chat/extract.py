@@ -29,9 +29,7 @@ def merge_by_topic_sub_topics(new_facts: list[FactResponse]):
     return list(topic_subtopic.values())
 
 
-async def extract_topics(
-    user_id: str, project_id: str, user_memo: str
-) -> Promise[dict]:
+async def get_extract_context(user_id: str, project_id: str) -> Promise[dict]:
     p = await get_user_profiles(user_id, project_id)
     if not p.ok():
         return p
@@ -50,8 +48,8 @@ async def extract_topics(
     project_profiles_slots = read_out_profile_config(
         project_profiles, PROMPTS[USE_LANGUAGE]["profile"].CANDIDATE_PROFILE_TOPICS
     )
+    allowed_topic_subtopics = set()
     if STRICT_MODE:
-        allowed_topic_subtopics = set()
         for p in project_profiles_slots:
             for st in p.sub_topics:
                 allowed_topic_subtopics.add(
@@ -84,16 +82,37 @@ async def extract_topics(
         )
     else:
         already_topics_prompt = ""
+    return Promise.resolve(
+        {
+            "profiles": profiles,
+            "config": project_profiles,
+            "total_profiles": project_profiles_slots,
+            "language": USE_LANGUAGE,
+            "strict_mode": STRICT_MODE,
+            "allowed_topic_subtopics": allowed_topic_subtopics,
+            "already_topics_prompt": already_topics_prompt,
+        }
+    )
+
+
+async def extract_topics(
+    user_id: str, project_id: str, user_memo: str
+) -> Promise[dict]:
+    p = await get_extract_context(user_id, project_id)
+    if not p.ok():
+        return p
+    context = p.data()
+    USE_LANGUAGE = context["language"]
 
     p = await llm_complete(
         project_id,
         PROMPTS[USE_LANGUAGE]["extract"].pack_input(
-            already_topics_prompt,
+            context["already_topics_prompt"],
             user_memo,
-            strict_mode=STRICT_MODE,
+            strict_mode=context["strict_mode"],
         ),
         system_prompt=PROMPTS[USE_LANGUAGE]["extract"].get_prompt(
-            PROMPTS[USE_LANGUAGE]["profile"].get_prompt(project_profiles_slots)
+            PROMPTS[USE_LANGUAGE]["profile"].get_prompt(context["total_profiles"])
         ),
         temperature=0.2,  # precise
         **PROMPTS[USE_LANGUAGE]["extract"].get_kwargs(),
@@ -101,22 +120,25 @@ async def extract_topics(
     if not p.ok():
         return p
     results = p.data()
-    # print(user_memo)
-    # print("-------------------------------")
-    # print(results)
     parsed_facts: AIUserProfiles = parse_string_into_profiles(results)
+    return Promise.resolve(pack_extracted_facts(user_id, parsed_facts, context))
+
+
+def pack_extracted_facts(
+    user_id: str, parsed_facts: AIUserProfiles, context: dict
+) -> dict:
+    STRICT_MODE = context["strict_mode"]
+    allowed_topic_subtopics = context["allowed_topic_subtopics"]
     new_facts: list[FactResponse] = parsed_facts.model_dump()["facts"]
     if not len(new_facts):
         LOG.info(f"No new facts extracted {user_id}")
-        return Promise.resolve(
-            {
-                "fact_contents": [],
-                "fact_attributes": [],
-                "profiles": profiles,
-                "config": project_profiles,
-                "total_profiles": project_profiles_slots,
-            }
-        )
+        return {
+            "fact_contents": [],
+            "fact_attributes": [],
+            "profiles": context["profiles"],
+            "config": context["config"],
+            "total_profiles": context["total_profiles"],
+        }
 
     for nf in new_facts:
         nf[ContanstTable.topic] = attribute_unify(nf[ContanstTable.topic])
@@ -140,12 +162,10 @@ async def extract_topics(
                 ContanstTable.sub_topic: nf[ContanstTable.sub_topic],
             }
         )
-    return Promise.resolve(
-        {
-            "fact_contents": fact_contents,
-            "fact_attributes": fact_attributes,
-            "profiles": profiles,
-            "config": project_profiles,
-            "total_profiles": project_profiles_slots,
-        }
-    )
+    return {
+        "fact_contents": fact_contents,
+        "fact_attributes": fact_attributes,
+        "profiles": context["profiles"],
+        "config": context["config"],
+        "total_profiles": context["total_profiles"],
+    }
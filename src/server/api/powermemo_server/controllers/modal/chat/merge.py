@@ -6,6 +6,7 @@ from ....env import ProfileConfig, ContanstTable
 from ....llms import llm_complete
 from ....prompts.utils import (
     parse_string_into_merge_action,
+    parse_string_into_merge_actions,
 )
 from ....prompts.profile_init_utils import UserProfileTopic
 from ....types import SubTopic
@@ -38,8 +39,18 @@ async def merge_or_valid_new_memos(
         "update_delta": [],
         "before_profiles": profiles,
     }
+    facts = list(zip(fact_contents, fact_attributes))
+    if CONFIG.batch_profile_merge:
+        facts = await batch_merge_or_valid(
+            project_id,
+            facts,
+            config,
+            RUNTIME_MAPS,
+            DEFINE_MAPS,
+            profile_session_results,
+        )
     tasks = []
-    for f_c, f_a in zip(fact_contents, fact_attributes):
+    for f_c, f_a in facts:
         task = handle_profile_merge_or_valid(
             project_id,
             f_a,
@@ -68,19 +79,10 @@ async def handle_profile_merge_or_valid(
         profile_attributes[ContanstTable.sub_topic],
     )
     USE_LANGUAGE = config.language or CONFIG.language
-    PROFILE_VALIDATE_MODE = (
-        config.profile_validate_mode
-        if config.profile_validate_mode is not None
-        else CONFIG.profile_validate_mode
-    )
     runtime_profile = profile_runtime_maps.get(KEY, None)
     define_sub_topic = profile_define_maps.get(KEY, SubTopic(name=""))
 
-    if (
-        not PROFILE_VALIDATE_MODE
-        and not define_sub_topic.validate_value
-        and runtime_profile is None
-    ):
+    if skip_validation(config, define_sub_topic, runtime_profile):
         LOG.info(f"Skip validation: {KEY}")
         session_merge_validate_results["add"].append(
             {
@@ -113,6 +115,41 @@ async def handle_profile_merge_or_valid(
         return Promise.reject(
             CODE.SERVER_PARSE_ERROR, "Failed to parse merge action of Powermemo"
         )
+    return apply_merge_action(
+        KEY,
+        update_response,
+        profile_attributes,
+        profile_content,
+        runtime_profile,
+        session_merge_validate_results,
+    )
+
+
+def skip_validation(
+    config: ProfileConfig,
+    define_sub_topic: SubTopic,
+    runtime_profile: ProfileData | None,
+) -> bool:
+    PROFILE_VALIDATE_MODE = (
+        config.profile_validate_mode
+        if config.profile_validate_mode is not None
+        else CONFIG.profile_validate_mode
+    )
+    return (
+        not PROFILE_VALIDATE_MODE
+        and not define_sub_topic.validate_value
+        and runtime_profile is None
+    )
+
+
+def apply_merge_action(
+    KEY: tuple[str, str],
+    update_response: UpdateResponse,
+    profile_attributes: dict,
+    profile_content: str,
+    runtime_profile: ProfileData | None,
+    session_merge_validate_results: MergeAddResult,
+) -> Promise[None]:
     if update_response["action"] == "UPDATE":
         if runtime_profile is None:
             session_merge_validate_results["add"].append(
@@ -154,3 +191,102 @@ async def handle_profile_merge_or_valid(
             CODE.SERVER_PARSE_ERROR, "Failed to parse merge action of Powermemo"
         )
     return Promise.resolve(None)
+
+
+async def batch_merge_or_valid(
+    project_id: str,
+    facts: list[tuple[str, dict]],
+    config: ProfileConfig,
+    profile_runtime_maps: dict[tuple[str, str], ProfileData],
+    profile_define_maps: dict[tuple[str, str], SubTopic],
+    session_merge_validate_results: MergeAddResult,
+) -> list[tuple[str, dict]]:
+    """Merge the facts in one LLM call, return the facts left to merge one by one"""
+    USE_LANGUAGE = config.language or CONFIG.language
+    pending = []
+    for profile_content, profile_attributes in facts:
+        KEY = (
+            profile_attributes[ContanstTable.topic],
+            profile_attributes[ContanstTable.sub_topic],
+        )
+        runtime_profile = profile_runtime_maps.get(KEY, None)
+        define_sub_topic = profile_define_maps.get(KEY, SubTopic(name=""))
+        if skip_validation(config, define_sub_topic, runtime_profile):
+            LOG.info(f"Skip validation: {KEY}")
+            session_merge_validate_results["add"].append(
+                {
+                    "content": profile_content,
+                    "attributes": profile_attributes,
+                }
+            )
+            continue
+        pending.append(
+            (
+                KEY,
+                profile_content,
+                profile_attributes,
+                runtime_profile,
+                define_sub_topic,
+            )
+        )
+    if len(pending) <= 1:
+        return [(p[1], p[2]) for p in pending]
+
+    r = await llm_complete(
+        project_id,
+        PROMPTS[USE_LANGUAGE]["merge"].get_batch_input(
+            [
+                {
+                    "topic": KEY[0],
+                    "subtopic": KEY[1],
+                    "old_memo": runtime_profile.content if runtime_profile else None,
+                    "new_memo": profile_content,
+                    "update_instruction": define_sub_topic.update_description,
+                    "topic_description": define_sub_topic.description,
+                }
+                for (
+                    KEY,
+                    profile_content,
+                    _,
+                    runtime_profile,
+                    define_sub_topic,
+                ) in pending
+            ]
+        ),
+        system_prompt=PROMPTS[USE_LANGUAGE]["merge"].get_batch_prompt(),
+        temperature=0.2,  # precise
+        **PROMPTS[USE_LANGUAGE]["merge"].get_batch_kwargs(),
+    )
+    if not r.ok():
+        LOG.warning(f"Failed to batch merge profiles: {r.msg()}")
+        return [(p[1], p[2]) for p in pending]
+    update_responses = parse_string_into_merge_actions(r.data())
+
+    left_facts = []
+    for index, (
+        KEY,
+        profile_content,
+        profile_attributes,
+        runtime_profile,
+        _,
+    ) in enumerate(pending):
+        update_response = update_responses.get(index)
+        if update_response is None or update_response["action"] not in (
+            "UPDATE",
+            "ABORT",
+        ):
+            left_facts.append((profile_content, profile_attributes))
+            continue
+        apply_merge_action(
+            KEY,
+            update_response,
+            profile_attributes,
+            profile_content,
+            runtime_profile,
+            session_merge_validate_results,
+        )
+    if left_facts:
+        LOG.warning(
+            f"Failed to parse {len(left_facts)}/{len(pending)} batch merge actions, merge them one by one"
+        )
+    return left_facts
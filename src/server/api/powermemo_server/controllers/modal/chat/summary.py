@@ -1,7 +1,8 @@
 import asyncio
 from ....models.utils import Promise
 from ....env import CONFIG, LOG
-from ....utils import get_blob_str, get_encoded_tokens, truncate_string
+from ....utils import get_blob_str, truncate_string
+from ....tokenizer import count_tokens
 from ....llms import llm_complete
 from ....prompts import (
     summary_profile,
@@ -25,7 +26,7 @@ async def re_summary(
 
 async def summary_memo(project_id: str, content_pack: dict) -> Promise[None]:
     content = content_pack["content"]
-    if len(get_encoded_tokens(content)) <= CONFIG.max_pre_profile_token_size:
+    if await count_tokens(content) <= CONFIG.max_pre_profile_token_size:
         return Promise.resolve(None)
     r = await llm_complete(
         project_id,
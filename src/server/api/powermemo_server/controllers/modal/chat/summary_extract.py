@@ -0,0 +1,82 @@
+from ....env import CONFIG, LOG
+from ....models.utils import Promise, CODE
+from ....models.blob import Blob, BlobType
+from ....llms import llm_complete
+from ....prompts.profile_init_utils import read_out_event_tags
+from ....prompts.utils import (
+    tag_chat_blobs_in_order_xml,
+    parse_string_into_memo_and_profiles,
+)
+from ...project import get_project_profile_config
+from .entry_summary import entry_summary
+from .extract import extract_topics, get_extract_context, pack_extracted_facts
+from .types import PROMPTS
+
+
+async def summary_and_extract(
+    user_id: str, project_id: str, blobs: list[Blob]
+) -> Promise[tuple[str, dict]]:
+    p = await get_project_profile_config(project_id)
+    if not p.ok():
+        return p
+    project_profiles = p.data()
+    EXTRACT_PIPELINE_MODE = (
+        project_profiles.extract_pipeline_mode or CONFIG.extract_pipeline_mode
+    )
+    if EXTRACT_PIPELINE_MODE == "fused":
+        p = await fused_summary_extract(user_id, project_id, blobs)
+        if p.ok():
+            return p
+        LOG.warning(f"Fused summary and extraction failed, use two stages: {p.msg()}")
+
+    p = await entry_summary(user_id, project_id, blobs)
+    if not p.ok():
+        return p
+    user_memo_str = p.data()
+
+    p = await extract_topics(user_id, project_id, user_memo_str)
+    if not p.ok():
+        return p
+    return Promise.resolve((user_memo_str, p.data()))
+
+
+async def fused_summary_extract(
+    user_id: str, project_id: str, blobs: list[Blob]
+) -> Promise[tuple[str, dict]]:
+    assert all(b.type == BlobType.chat for b in blobs), "All blobs must be chat blobs"
+    p = await get_extract_context(user_id, project_id)
+    if not p.ok():
+        return p
+    context = p.data()
+    USE_LANGUAGE = context["language"]
+    prompt = PROMPTS[USE_LANGUAGE]["summary_extract"]
+    event_tags = read_out_event_tags(context["config"])
+    event_attriubtes_str = "\n".join(
+        [f"- {et.name}({et.description})" for et in event_tags]
+    )
+    profile_topics_str = PROMPTS[USE_LANGUAGE]["profile"].get_prompt(
+        context["total_profiles"]
+    )
+    blob_strs = tag_chat_blobs_in_order_xml(blobs)
+    r = await llm_complete(
+        project_id,
+        prompt.pack_input(
+            context["already_topics_prompt"],
+            blob_strs,
+            strict_mode=context["strict_mode"],
+        ),
+        system_prompt=prompt.get_prompt(profile_topics_str, event_attriubtes_str),
+        temperature=0.2,  # precise
+        **prompt.get_kwargs(),
+    )
+    if not r.ok():
+        return r
+    parsed = parse_string_into_memo_and_profiles(r.data())
+    if parsed is None:
+        return Promise.reject(
+            CODE.SERVER_PARSE_ERROR, "Failed to parse the memo of fused extraction"
+        )
+    user_memo_str, parsed_facts = parsed
+    return Promise.resolve(
+        (user_memo_str, pack_extracted_facts(user_id, parsed_facts, context))
+    )
@@ -5,10 +5,12 @@ from ....prompts import (
     merge_profile,
     organize_profile,
     summary_entry_chats,
+    summary_extract_chats,
     zh_user_profile_topics,
     zh_extract_profile,
     zh_merge_profile,
     zh_summary_entry_chats,
+    zh_summary_extract_chats,
 )
 from ....models.response import ProfileData
 
@@ -36,6 +38,7 @@ MergeAddResult = TypedDict(
 PROMPTS = {
     "en": {
         "entry_summary": summary_entry_chats,
+        "summary_extract": summary_extract_chats,
         "profile": user_profile_topics,
         "extract": extract_profile,
         "merge": merge_profile,
@@ -43,6 +46,7 @@ PROMPTS = {
     },
     "zh": {
         "entry_summary": zh_summary_entry_chats,
+        "summary_extract": zh_summary_extract_chats,
         "profile": zh_user_profile_topics,
         "extract": zh_extract_profile,
         "merge": zh_merge_profile,
@@ -1,12 +1,18 @@
+import asyncio
+import numpy as np
 from pydantic import ValidationError
+from sqlalchemy import select
 from ...models.utils import Promise
 from ...models.database import GeneralBlob, UserProfile
 from ...models.blob import OpenAICompatibleMessage
-from ...models.response import CODE, IdData, IdsData, UserProfilesData
-from ...utils import truncate_string, find_list_int_or_none
+from ...models.response import CODE, IdData, IdsData, UserProfilesData, ProfileData
+from ...connectors import AsyncSession
+from ...utils import truncate_string, find_list_int_or_none, profile_str_repr
 from ...env import LOG, CONFIG
 from ...prompts import pick_related_profiles as pick_prompt
 from ...llms import llm_complete
+from ...llms.embeddings import get_embedding
+from ..profile import save_profile_embeddings
 
 
 async def filter_profiles_with_chats(
@@ -21,6 +27,15 @@ async def filter_profiles_with_chats(
     """Filter profiles with chats"""
     if not len(chats) or not len(profiles.profiles):
         return Promise.reject(CODE.BAD_REQUEST, "No chats or profiles to filter")
+    if CONFIG.profile_filter_mode == "embedding":
+        return await filter_profiles_with_embedding(
+            project_id,
+            profiles,
+            chats,
+            only_topics=only_topics,
+            max_previous_chats=max_previous_chats,
+            max_filter_num=max_filter_num,
+        )
     chats = chats[-(max_previous_chats + 1) :]
     if only_topics:
         only_topics = [t.strip() for t in only_topics]
@@ -29,12 +44,13 @@ async def filter_profiles_with_chats(
     topics_index = [
         {
             "index": i,
-            "topic": p.attributes["topic"],
-            "sub_topic": p.attributes["sub_topic"],
+            "topic": p.attributes.get("topic", ""),
+            "sub_topic": p.attributes.get("sub_topic", ""),
             "content": truncate_string(p.content, max_value_token_size),
         }
         for i, p in enumerate(profiles.profiles)
-        if only_topics is None or p.attributes["topic"].strip() in only_topics
+        if only_topics is None
+        or p.attributes.get("topic", "").strip() in only_topics
     ]
 
     topics_index = sorted(topics_index, key=lambda x: (x["topic"], x["sub_topic"]))
@@ -46,6 +62,8 @@ async def filter_profiles_with_chats(
         system_prompt=system_prompt,
         temperature=0.2,  # precise
         model=CONFIG.summary_llm_model,
+        # on the read path of `/users/profile` and `/users/context`
+        priority="interactive",
         **pick_prompt.get_kwargs(),
     )
     if not r.ok():
@@ -61,3 +79,78 @@ async def filter_profiles_with_chats(
     ids = [i for i in found_ids if i < len(topics_index)]
     profiles = [profiles.profiles[topics_index[i]["index"]] for i in ids]
     return Promise.resolve(profiles)
+
+
+async def filter_profiles_with_embedding(
+    project_id: str,
+    profiles: UserProfilesData,
+    chats: list[OpenAICompatibleMessage],
+    only_topics: list[str] | None = None,
+    max_previous_chats: int = 4,
+    max_filter_num: int = 10,
+) -> Promise[list[ProfileData]]:
+    """Rank profiles by cosine similarity to the latest chats"""
+    chats = chats[-(max_previous_chats + 1) :]
+    if only_topics:
+        only_topics = {t.strip() for t in only_topics}
+    candidates = [
+        p
+        for p in profiles.profiles
+        if not only_topics or p.attributes.get("topic", "").strip() in only_topics
+    ]
+    if not candidates:
+        return Promise.resolve([])
+
+    async with AsyncSession() as session:
+        rows = (
+            await session.execute(
+                select(UserProfile.id, UserProfile.embedding).where(
+                    UserProfile.project_id == project_id,
+                    UserProfile.id.in_([p.id for p in candidates]),
+                    UserProfile.embedding.is_not(None),
+                )
+            )
+        ).all()
+    stored = {str(pid): embedding for pid, embedding in rows}
+    # profiles written before embedding was enabled, or whose embedding failed
+    missing = [p for p in candidates if str(p.id) not in stored]
+
+    query = "\n".join(f"{c.role}: {c.content}" for c in chats)
+    requests = [get_embedding(project_id, [query], phase="query")]
+    if missing:
+        requests.append(
+            get_embedding(
+                project_id,
+                [profile_str_repr(p.attributes, p.content) for p in missing],
+                phase="document",
+            )
+        )
+    results = await asyncio.gather(*requests)
+    for r in results:
+        if not r.ok():
+            LOG.error(f"Failed to embed profiles or chats: {r.msg()}")
+            return r
+    if missing:
+        missing_embeddings = list(results[1].data())
+        stored.update(
+            {str(p.id): embedding for p, embedding in zip(missing, missing_embeddings)}
+        )
+        # embed each profile once, profiles written before embedding was
+        # enabled are backfilled as they are filtered
+        await save_profile_embeddings(project_id, missing, missing_embeddings)
+
+    query_embedding = results[0].data()[0]
+    profile_embeddings = np.array([stored[str(p.id)] for p in candidates])
+    similarities = (profile_embeddings @ query_embedding) / (
+        np.linalg.norm(profile_embeddings, axis=1) * np.linalg.norm(query_embedding)
+        + 1e-12
+    )
+    ranks = np.argsort(-similarities)[:max_filter_num]
+    # unrelated profiles are dropped even if fewer than `max_filter_num` are left
+    return Promise.resolve(
+        [
+            candidates[i]
+            for i in ranks
+            if similarities[i] >= CONFIG.profile_filter_similarity_threshold
+        ]
+    )
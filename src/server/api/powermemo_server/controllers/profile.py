@@ -1,12 +1,201 @@
+import uuid
 from pydantic import ValidationError
+from sqlalchemy import (
+    select,
+    delete,
+    update,
+    values,
+    column,
+    func,
+    case,
+    literal,
+    or_,
+    Integer,
+    TEXT,
+)
+from sqlalchemy.orm import aliased
+from sqlalchemy.dialects.postgresql import JSONB, UUID
+from sqlalchemy.ext.asyncio import AsyncSession as SQLAsyncSession
+from pgvector.sqlalchemy import Vector
 from ..models.utils import Promise
 from ..models.database import GeneralBlob, UserProfile
-from ..models.response import CODE, IdData, IdsData, UserProfilesData
-from ..connectors import Session, get_redis_client
-from ..utils import get_encoded_tokens
+from ..models.response import CODE, IdData, IdsData, UserProfilesData, ProfileData
+from ..connectors import AsyncSession, get_redis_client, PROJECT_ID
+from bisect import bisect_right
+from itertools import accumulate
+from ..utils import profile_str_repr
+from ..tokenizer import count_tokens_batch
+from ..llms.embeddings import get_embedding
 from ..env import LOG, CONFIG
 
 
+# marks a filled cache, so users without profiles are cached too
+PROFILES_CACHE_LOADED_FIELD = "__loaded__"
+
+# Only patch a filled cache, a partial hash would hide the other profiles
+PATCH_PROFILES_CACHE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+local n = tonumber(ARGV[2])
+for i = 0, n - 1 do
+    redis.call('HSET', KEYS[1], ARGV[3 + i * 2], ARGV[4 + i * 2])
+end
+for i = 3 + n * 2, #ARGV do
+    redis.call('HDEL', KEYS[1], ARGV[i])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+"""
+
+
+def profiles_cache_key(user_id: str, project_id: str) -> str:
+    return f"powermemo::user_profiles::{PROJECT_ID}::{project_id}::{user_id}"
+
+
+def pack_profile_data(db_profile: UserProfile) -> ProfileData:
+    return ProfileData(
+        id=db_profile.id,
+        content=db_profile.content,
+        attributes=db_profile.attributes,
+        created_at=db_profile.created_at,
+        updated_at=db_profile.updated_at,
+        token_size=db_profile.token_size,
+    )
+
+
+async def fill_profiles_token_size(profiles: list[ProfileData]) -> None:
+    missing = [p for p in profiles if p.token_size is None]
+    if not missing:
+        return
+    token_sizes = await count_tokens_batch(
+        [profile_str_repr(p.attributes, p.content) for p in missing]
+    )
+    for p, token_size in zip(missing, token_sizes):
+        p.token_size = token_size
+
+
+async def embed_profiles(project_id: str, texts: list[str]) -> list:
+    if not CONFIG.enable_profile_embedding or not texts:
+        return [None] * len(texts)
+    p = await get_embedding(project_id, texts, phase="document")
+    if not p.ok():
+        # profiles without embeddings are embedded again when they are filtered
+        LOG.error(f"Failed to get profile embeddings: {p.msg()}")
+        return [None] * len(texts)
+    embeddings = p.data()
+    if embeddings.shape[-1] != CONFIG.embedding_dim:
+        LOG.error(
+            f"Embedding dimension mismatch! Expected {CONFIG.embedding_dim}, got {embeddings.shape[-1]}."
+        )
+        return [None] * len(texts)
+    return list(embeddings)
+
+
+async def save_profile_embeddings(
+    project_id: str, profiles: list[ProfileData], embeddings: list
+) -> None:
+    """Store embeddings computed on the fly for profiles that had none"""
+    rows = [
+        (
+            uuid.UUID(str(p.id)),
+            p.content,
+            p.attributes.get("topic"),
+            p.attributes.get("sub_topic"),
+            embedding,
+        )
+        for p, embedding in zip(profiles, embeddings)
+        if embedding is not None and len(embedding) == CONFIG.embedding_dim
+    ]
+    if not rows:
+        return
+    embedded = values(
+        column("id", UUID(as_uuid=True)),
+        column("content", TEXT),
+        column("topic", TEXT),
+        column("sub_topic", TEXT),
+        column("embedding", Vector(CONFIG.embedding_dim)),
+        name="embedded",
+    ).data(rows)
+    try:
+        async with AsyncSession() as session:
+            await session.execute(
+                update(UserProfile)
+                .where(
+                    UserProfile.id == embedded.c.id,
+                    UserProfile.project_id == project_id,
+                    UserProfile.embedding.is_(None),
+                    # the profile may have changed since it was read
+                    UserProfile.content == embedded.c.content,
+                    UserProfile.topic == embedded.c.topic,
+                    UserProfile.sub_topic == embedded.c.sub_topic,
+                )
+                # a read path backfill, the profile itself didn't change
+                .values(
+                    embedding=embedded.c.embedding,
+                    updated_at=UserProfile.updated_at,
+                )
+                .execution_options(synchronize_session=False)
+            )
+            await session.commit()
+    except Exception as e:
+        # they are embedded again on the next filter
+        LOG.error(f"Failed to save profile embeddings: {e}")
+
+
+async def get_cached_profiles(
+    user_id: str, project_id: str
+) -> UserProfilesData | None:
+    key = profiles_cache_key(user_id, project_id)
+    async with get_redis_client() as redis_client:
+        cached = await redis_client.hgetall(key)
+        if cached.pop(PROFILES_CACHE_LOADED_FIELD, None) is None:
+            return None
+        try:
+            profiles = [ProfileData.model_validate_json(v) for v in cached.values()]
+        except ValidationError as e:
+            LOG.error(f"Invalid user profiles: {e}")
+            await redis_client.delete(key)
+            return None
+    profiles.sort(key=lambda p: p.updated_at, reverse=True)
+    return UserProfilesData(profiles=profiles)
+
+
+async def fill_profiles_cache(
+    user_id: str, project_id: str, profiles: UserProfilesData
+) -> None:
+    key = profiles_cache_key(user_id, project_id)
+    mapping = {str(p.id): p.model_dump_json() for p in profiles.profiles}
+    mapping[PROFILES_CACHE_LOADED_FIELD] = 1
+    async with get_redis_client() as redis_client:
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.delete(key)
+            pipe.hset(key, mapping=mapping)
+            pipe.expire(key, CONFIG.cache_user_profiles_ttl)
+            await pipe.execute()
+
+
+async def patch_profiles_cache(
+    user_id: str,
+    project_id: str,
+    upserts: list[ProfileData] = [],
+    deletes: list[str] = [],
+) -> None:
+    if not upserts and not deletes:
+        return
+    args = [CONFIG.cache_user_profiles_ttl, len(upserts)]
+    for p in upserts:
+        args.extend([str(p.id), p.model_dump_json()])
+    args.extend(str(pid) for pid in deletes)
+    async with get_redis_client() as redis_client:
+        await redis_client.eval(
+            PATCH_PROFILES_CACHE_SCRIPT,
+            1,
+            profiles_cache_key(user_id, project_id),
+            *args,
+        )
+
+
 async def truncate_profiles(
     profiles: UserProfilesData,
     prefer_topics: list[str] = None,
@@ -60,59 +249,239 @@ async def truncate_profiles(
     if topk:
         profiles.profiles = profiles.profiles[:topk]
     if max_token_size:
-        current_length = 0
-        use_index = 0
-        for max_i, p in enumerate(profiles.profiles):
-            single_p = f"{p.attributes.get('topic')}::{p.attributes.get('sub_topic')}: {p.content}"
-            current_length += len(get_encoded_tokens(single_p))
-            if current_length > max_token_size:
-                break
-            use_index = max_i
-        profiles.profiles = profiles.profiles[: use_index + 1]
+        await fill_profiles_token_size(profiles.profiles)
+        prefix_sizes = list(accumulate(p.token_size for p in profiles.profiles))
+        # keep at least one profile even if it exceeds the budget
+        use_size = max(bisect_right(prefix_sizes, max_token_size), 1)
+        profiles.profiles = profiles.profiles[:use_size]
     return Promise.resolve(profiles)
 
 
-async def get_user_profiles(user_id: str, project_id: str) -> Promise[UserProfilesData]:
-    async with get_redis_client() as redis_client:
-        user_profiles = await redis_client.get(
-            f"user_profiles::{project_id}::{user_id}"
+async def get_user_profiles(
+    user_id: str,
+    project_id: str,
+    only_topics: list[str] = None,
+    max_subtopic_size: int = None,
+    topic_limits: dict[str, int] = None,
+) -> Promise[UserProfilesData]:
+    cached_profiles = await get_cached_profiles(user_id, project_id)
+    if cached_profiles is not None:
+        # filters are applied later by `truncate_profiles`
+        return Promise.resolve(cached_profiles)
+    if only_topics or max_subtopic_size or topic_limits:
+        # don't load the whole profile set just to filter most of it out
+        return await filter_user_profiles(
+            user_id, project_id, only_topics, max_subtopic_size, topic_limits
         )
-        if user_profiles:
-            try:
-                return Promise.resolve(
-                    UserProfilesData.model_validate_json(user_profiles)
-                )
-            except ValidationError as e:
-                LOG.error(f"Invalid user profiles: {e}")
-                await redis_client.delete(f"user_profiles::{project_id}::{user_id}")
-    with Session() as session:
+    async with AsyncSession() as session:
         user_profiles = (
-            session.query(UserProfile)
-            .filter_by(user_id=user_id, project_id=project_id)
-            .order_by(UserProfile.updated_at.desc())
-            .all()
-        )
-        results = []
-        for up in user_profiles:
-            results.append(
-                {
-                    "id": up.id,
-                    "content": up.content,
-                    "attributes": up.attributes,
-                    "created_at": up.created_at,
-                    "updated_at": up.updated_at,
-                }
+            await session.scalars(
+                select(UserProfile)
+                .filter_by(user_id=user_id, project_id=project_id)
+                .order_by(UserProfile.updated_at.desc())
             )
+        ).all()
+        results = [pack_profile_data(up) for up in user_profiles]
+    await fill_profiles_token_size(results)
     return_profiles = UserProfilesData(profiles=results)
-    async with get_redis_client() as redis_client:
-        await redis_client.set(
-            f"user_profiles::{project_id}::{user_id}",
-            return_profiles.model_dump_json(),
-            ex=CONFIG.cache_user_profiles_ttl,
-        )
+    await fill_profiles_cache(user_id, project_id, return_profiles)
     return Promise.resolve(return_profiles)
 
 
+async def filter_user_profiles(
+    user_id: str,
+    project_id: str,
+    only_topics: list[str] = None,
+    max_subtopic_size: int = None,
+    topic_limits: dict[str, int] = None,
+) -> Promise[UserProfilesData]:
+    query = select(UserProfile).filter_by(user_id=user_id, project_id=project_id)
+    if only_topics:
+        query = query.where(
+            func.trim(UserProfile.topic).in_([t.strip() for t in only_topics])
+        )
+    if max_subtopic_size or topic_limits:
+        # same rule as `truncate_profiles`, a negative limit means unlimited
+        default_limit = max_subtopic_size or -1
+        topic_limit = (
+            case(topic_limits, value=UserProfile.topic, else_=default_limit)
+            if topic_limits
+            else literal(default_limit)
+        ).label("topic_limit")
+        rank = (
+            func.row_number()
+            .over(
+                partition_by=UserProfile.topic,
+                order_by=UserProfile.updated_at.desc(),
+            )
+            .label("topic_rank")
+        )
+        ranked = query.add_columns(rank, topic_limit).subquery()
+        profile_alias = aliased(UserProfile, ranked)
+        query = select(profile_alias).where(
+            or_(
+                ranked.c.topic_limit < 0,
+                ranked.c.topic_rank <= ranked.c.topic_limit,
+            )
+        )
+        order_column = profile_alias.updated_at
+    else:
+        order_column = UserProfile.updated_at
+    async with AsyncSession() as session:
+        user_profiles = (
+            await session.scalars(query.order_by(order_column.desc()))
+        ).all()
+        results = [pack_profile_data(up) for up in user_profiles]
+    await fill_profiles_token_size(results)
+    return Promise.resolve(UserProfilesData(profiles=results))
+
+
+async def prepare_profile_writes(
+    project_id: str, contents: list[str], attributes: list[dict | None]
+) -> tuple[list[int | None], list]:
+    """Token sizes and embeddings of profiles to write, call it before opening
+    the transaction that writes them. Profiles without attributes get None, they
+    are sized after the update and embedded when they are filtered"""
+    known = [i for i, attr in enumerate(attributes) if attr is not None]
+    known_texts = [profile_str_repr(attributes[i], contents[i]) for i in known]
+    token_sizes = [None] * len(contents)
+    embeddings = [None] * len(contents)
+    for i, token_size, embedding in zip(
+        known,
+        await count_tokens_batch(known_texts),
+        await embed_profiles(project_id, known_texts),
+    ):
+        token_sizes[i] = token_size
+        embeddings[i] = embedding
+    return token_sizes, embeddings
+
+
+async def insert_profiles(
+    session: SQLAsyncSession,
+    user_id: str,
+    project_id: str,
+    profiles: list[str],
+    attributes: list[dict],
+    token_sizes: list[int],
+    embeddings: list,
+) -> list[ProfileData]:
+    db_profiles = [
+        UserProfile(
+            user_id=user_id,
+            project_id=project_id,
+            content=content,
+            attributes=attr,
+            token_size=token_size,
+            embedding=embedding,
+        )
+        for content, attr, token_size, embedding in zip(
+            profiles, attributes, token_sizes, embeddings
+        )
+    ]
+    session.add_all(db_profiles)
+    await session.flush()
+    return [pack_profile_data(profile) for profile in db_profiles]
+
+
+async def bulk_update_profiles(
+    session: SQLAsyncSession,
+    user_id: str,
+    project_id: str,
+    profile_ids: list[str],
+    contents: list[str],
+    attributes: list[dict | None],
+    token_sizes: list[int | None],
+    embeddings: list,
+) -> list[ProfileData]:
+    if not profile_ids:
+        return []
+    # attributes=None keeps the old ones, their token sizes are set afterwards
+    # and their embeddings when they are filtered
+    rows = [
+        (uuid.UUID(str(pid)), content, attr, token_size, embedding)
+        for pid, content, attr, token_size, embedding in zip(
+            profile_ids, contents, attributes, token_sizes, embeddings
+        )
+    ]
+    deltas = values(
+        column("id", UUID(as_uuid=True)),
+        column("content", TEXT),
+        # a missing attributes must bind as SQL NULL for the coalesce below,
+        # not as a JSON null
+        column("attributes", JSONB(none_as_null=True)),
+        column("token_size", Integer),
+        column("embedding", Vector(CONFIG.embedding_dim)),
+        name="deltas",
+    ).data(rows)
+    returning_columns = (
+        UserProfile.id,
+        UserProfile.content,
+        UserProfile.attributes,
+        UserProfile.created_at,
+        UserProfile.updated_at,
+        UserProfile.token_size,
+    )
+    result = await session.execute(
+        update(UserProfile)
+        .where(
+            UserProfile.id == deltas.c.id,
+            UserProfile.user_id == user_id,
+            UserProfile.project_id == project_id,
+        )
+        .values(
+            content=deltas.c.content,
+            attributes=func.coalesce(deltas.c.attributes, UserProfile.attributes),
+            token_size=deltas.c.token_size,
+            # a stale embedding is worse than none
+            embedding=deltas.c.embedding,
+        )
+        .returning(*returning_columns)
+        .execution_options(synchronize_session=False)
+    )
+    updated = [ProfileData(**row._asdict()) for row in result.all()]
+
+    unsized = [p for p in updated if p.token_size is None]
+    if unsized:
+        # no network calls while the rows are locked, tokens are counted locally
+        await fill_profiles_token_size(unsized)
+        sizes = values(
+            column("id", UUID(as_uuid=True)),
+            column("token_size", Integer),
+            name="sizes",
+        ).data([(p.id, p.token_size) for p in unsized])
+        await session.execute(
+            update(UserProfile)
+            .where(
+                UserProfile.id == sizes.c.id,
+                UserProfile.project_id == project_id,
+            )
+            .values(token_size=sizes.c.token_size)
+            .execution_options(synchronize_session=False)
+        )
+
+    found_ids = {str(p.id) for p in updated}
+    for pid in profile_ids:
+        if str(pid) not in found_ids:
+            LOG.error(f"Profile {pid} not found for user {user_id}")
+    return updated
+
+
+async def bulk_delete_profiles(
+    session: SQLAsyncSession, user_id: str, project_id: str, profile_ids: list[str]
+) -> None:
+    if not profile_ids:
+        return
+    await session.execute(
+        delete(UserProfile)
+        .where(
+            UserProfile.id.in_(profile_ids),
+            UserProfile.user_id == user_id,
+            UserProfile.project_id == project_id,
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+
 async def add_user_profiles(
     user_id: str,
     project_id: str,
@@ -122,19 +491,16 @@ async def add_user_profiles(
     assert len(profiles) == len(
         attributes
     ), "Length of profiles, attributes must be equal"
-    with Session() as session:
-        db_profiles = [
-            UserProfile(
-                user_id=user_id, project_id=project_id, content=content, attributes=attr
-            )
-            for content, attr in zip(profiles, attributes)
-        ]
-        session.add_all(db_profiles)
-        session.commit()
-        profile_ids = [profile.id for profile in db_profiles]
-    async with get_redis_client() as redis_client:
-        await redis_client.delete(f"user_profiles::{project_id}::{user_id}")
-    return Promise.resolve(IdsData(ids=profile_ids))
+    token_sizes, embeddings = await prepare_profile_writes(
+        project_id, profiles, attributes
+    )
+    async with AsyncSession() as session:
+        upserts = await insert_profiles(
+            session, user_id, project_id, profiles, attributes, token_sizes, embeddings
+        )
+        await session.commit()
+    await patch_profiles_cache(user_id, project_id, upserts=upserts)
+    return Promise.resolve(IdsData(ids=[p.id for p in upserts]))
 
 
 async def update_user_profiles(
@@ -150,57 +516,49 @@ async def update_user_profiles(
     assert len(profile_ids) == len(
         attributes
     ), "Length of profile_ids, attributes must be equal"
-    with Session() as session:
-        db_profiles = []
-        for profile_id, content, attribute in zip(profile_ids, contents, attributes):
-            db_profile = (
-                session.query(UserProfile)
-                .filter_by(id=profile_id, user_id=user_id, project_id=project_id)
-                .one_or_none()
-            )
-            if db_profile is None:
-                LOG.error(f"Profile {profile_id} not found for user {user_id}")
-                continue
-            db_profile.content = content
-            if attribute is not None:
-                db_profile.attributes = attribute
-            db_profiles.append(profile_id)
-        session.commit()
-    async with get_redis_client() as redis_client:
-        await redis_client.delete(f"user_profiles::{project_id}::{user_id}")
-    return Promise.resolve(IdsData(ids=db_profiles))
+    token_sizes, embeddings = await prepare_profile_writes(
+        project_id, contents, attributes
+    )
+    async with AsyncSession() as session:
+        upserts = await bulk_update_profiles(
+            session,
+            user_id,
+            project_id,
+            profile_ids,
+            contents,
+            attributes,
+            token_sizes,
+            embeddings,
+        )
+        await session.commit()
+    await patch_profiles_cache(user_id, project_id, upserts=upserts)
+    return Promise.resolve(IdsData(ids=[p.id for p in upserts]))
 
 
 async def delete_user_profile(
     user_id: str, project_id: str, profile_id: str
 ) -> Promise[None]:
-    with Session() as session:
-        db_profile = (
-            session.query(UserProfile)
-            .filter_by(id=profile_id, user_id=user_id, project_id=project_id)
-            .one_or_none()
+    async with AsyncSession() as session:
+        db_profile = await session.scalar(
+            select(UserProfile).filter_by(
+                id=profile_id, user_id=user_id, project_id=project_id
+            )
         )
         if db_profile is None:
             return Promise.reject(
                 CODE.NOT_FOUND, f"Profile {profile_id} not found for user {user_id}"
             )
-        session.delete(db_profile)
-        session.commit()
-    async with get_redis_client() as redis_client:
-        await redis_client.delete(f"user_profiles::{project_id}::{user_id}")
+        await session.delete(db_profile)
+        await session.commit()
+    await patch_profiles_cache(user_id, project_id, deletes=[profile_id])
     return Promise.resolve(None)
 
 
 async def delete_user_profiles(
     user_id: str, project_id: str, profile_ids: list[str]
 ) -> Promise[IdsData]:
-    with Session() as session:
-        session.query(UserProfile).filter(
-            UserProfile.id.in_(profile_ids),
-            UserProfile.user_id == user_id,
-            UserProfile.project_id == project_id,
-        ).delete(synchronize_session=False)
-        session.commit()
-    async with get_redis_client() as redis_client:
-        await redis_client.delete(f"user_profiles::{project_id}::{user_id}")
+    async with AsyncSession() as session:
+        await bulk_delete_profiles(session, user_id, project_id, profile_ids)
+        await session.commit()
+    await patch_profiles_cache(user_id, project_id, deletes=profile_ids)
     return Promise.resolve(IdsData(ids=profile_ids))
@@ -1,16 +1,19 @@
+from sqlalchemy import select
 from ..models.database import Project
 from ..models.utils import Promise, CODE
 from ..models.response import IdData, ProfileConfigData
-from ..connectors import Session
+from ..connectors import AsyncSession
 from ..env import ProfileConfig
+from ..cache import get_local_cache, publish_invalidation, MISSING
+
+# parsed configs are shared between requests, treat them as read-only
+PROFILE_CONFIG_CACHE = get_local_cache("project_profile_config")
 
 
 async def get_project_secret(project_id: str) -> Promise[str]:
-    with Session() as session:
-        p = (
-            session.query(Project)
-            .filter(Project.project_id == project_id)
-            .one_or_none()
+    async with AsyncSession() as session:
+        p = await session.scalar(
+            select(Project).where(Project.project_id == project_id)
         )
         if not p:
             return Promise.reject(CODE.NOT_FOUND, "Project not found")
@@ -18,57 +21,61 @@ async def get_project_secret(project_id: str) -> Promise[str]:
 
 
 async def get_project_status(project_id: str) -> Promise[str]:
-    with Session() as session:
+    async with AsyncSession() as session:
         p = (
-            session.query(Project.status)
-            .filter(Project.project_id == project_id)
-            .one_or_none()
-        )
+            await session.execute(
+                select(Project.status).where(Project.project_id == project_id)
+            )
+        ).one_or_none()
         if not p:
             return Promise.reject(CODE.NOT_FOUND, "Project not found")
         return Promise.resolve(p.status)
 
 
 async def get_project_profile_config(project_id: str) -> Promise[ProfileConfig]:
-    with Session() as session:
+    p_parse = PROFILE_CONFIG_CACHE.get(project_id)
+    if p_parse is not MISSING:
+        return Promise.resolve(p_parse)
+    async with AsyncSession() as session:
         p = (
-            session.query(Project.profile_config)
-            .filter(Project.project_id == project_id)
-            .one_or_none()
-        )
+            await session.execute(
+                select(Project.profile_config).where(Project.project_id == project_id)
+            )
+        ).one_or_none()
         if not p:
             return Promise.reject(CODE.NOT_FOUND, "Project not found")
         if not p.profile_config:
-            return Promise.resolve(ProfileConfig())
-        p_parse = ProfileConfig.load_config_string(p.profile_config)
+            p_parse = ProfileConfig()
+        else:
+            p_parse = ProfileConfig.load_config_string(p.profile_config)
+    PROFILE_CONFIG_CACHE.set(project_id, p_parse)
     return Promise.resolve(p_parse)
 
 
 async def update_project_profile_config(
     project_id: str, profile_config: str | None
 ) -> Promise[None]:
-    with Session() as session:
-        p = (
-            session.query(Project)
-            .filter(Project.project_id == project_id)
-            .one_or_none()
+    async with AsyncSession() as session:
+        p = await session.scalar(
+            select(Project).where(Project.project_id == project_id)
         )
         if not p:
             return Promise.reject(CODE.NOT_FOUND, "Project not found")
         p.profile_config = profile_config
-        session.commit()
+        await session.commit()
+    await publish_invalidation(PROFILE_CONFIG_CACHE.name, project_id)
     return Promise.resolve(None)
 
 
 async def get_project_profile_config_string(
     project_id: str,
 ) -> Promise[ProfileConfigData]:
-    with Session() as session:
+    async with AsyncSession() as session:
         p = (
-            session.query(Project.profile_config)
-            .filter(Project.project_id == project_id)
-            .one_or_none()
-        )
+            await session.execute(
+                select(Project.profile_config).where(Project.project_id == project_id)
+            )
+        ).one_or_none()
         if not p:
             return Promise.reject(CODE.NOT_FOUND, "Project not found")
         return Promise.resolve(ProfileConfigData(profile_config=p.profile_config or ""))
@@ -72,11 +72,24 @@ class Config:
 
     system_prompt: str = None
     buffer_flush_interval: int = 60 * 60  # 1 hour
+    # flush buffers in `worker.py` instead of the insert request
+    use_buffer_flush_queue: bool = False
+    buffer_flush_worker_concurrency: int = 4
+    buffer_flush_job_ttl: int = 60 * 60 * 24  # 1 day
+    buffer_idle_flush_concurrency: int = 4
+    buffer_flush_lease_seconds: int = 60 * 10  # 10 minutes
     max_chat_blob_buffer_token_size: int = 1024
     max_profile_subtopics: int = 15
     max_pre_profile_token_size: int = 128
     llm_tab_separator: str = "::"
     cache_user_profiles_ttl: int = 60 * 20  # 20 minutes
+    # query the database with an async driver instead of blocking the event loop
+    use_async_database: bool = True
+    tokenizer_workers: int = 4
+    tokenizer_batch_size: int = 64
+    # in-process cache of project secret/status/profile config
+    local_cache_ttl: int = 60  # 1 minute
+    local_cache_max_size: int = 10000
 
     # LLM
     language: Literal["en", "zh"] = "en"
@@ -87,21 +100,68 @@ class Config:
     llm_openai_default_header: dict[str, str] = None
     best_llm_model: str = "gpt-4o-mini"
     summary_llm_model: str = None
+    # reuse completions of identical calls for these prompt ids, e.g.
+    # ["pick_related_profiles", "event_tagging"]
+    llm_response_cache_prompt_ids: list[str] = field(default_factory=list)
+    llm_response_cache_ttl: int = 60 * 60  # 1 hour
+    llm_response_cache_max_entries: int = 10000
+    # requests/tokens per minute of each model across all nodes, None is unlimited
+    llm_rpm_limit: Optional[int] = None
+    llm_tpm_limit: Optional[int] = None
+    # concurrent calls of each model on one node, adapted between the bounds
+    llm_min_concurrency: int = 1
+    llm_max_concurrency: int = 32
+    llm_latency_target_ms: int = 30 * 1000
+    llm_rate_limit_retries: int = 3
+    # share of the concurrency and rate limits that batch calls leave to
+    # interactive calls, e.g. picking profiles for `/users/context`
+    llm_interactive_reserved_ratio: float = 0.2
 
     enable_event_embedding: bool = True
+    # insert events without waiting for the embedding, the background embedder
+    # fills it. It also retries events whose embedding failed in either mode
+    defer_event_embedding: bool = False
+    event_embedding_batch_size: int = 32
+    event_embedding_max_attempts: int = 5
     embedding_provider: Literal["openai", "jina"] = "openai"
     embedding_api_key: str = None
     embedding_base_url: str = None
     embedding_dim: int = 1536
     embedding_model: str = "text-embedding-3-small"
     embedding_max_token_size: int = 8192
+    # concurrent embedding calls are sent as one request
+    embedding_batch_size: int = 64
+    embedding_batch_max_token_size: int = 300000
+    embedding_batch_wait_ms: int = 5
+    # cache embeddings in Redis by hash of model, phase and text
+    enable_embedding_cache: bool = True
+    embedding_cache_ttl: int = 60 * 60 * 24 * 7  # 7 days
+    # candidate list size of the HNSW index scan on `user_events.embedding`
+    # "hybrid" fuses full-text and vector search with reciprocal rank fusion
+    event_search_mode: Literal["vector", "hybrid"] = "vector"
+    event_search_ef_search: int = 40
+    # pgvector>=0.8 only, keep scanning the index until `topk` rows of the user
+    # are found, e.g. "relaxed_order". None scans the user's events exactly
+    event_search_iterative_scan: Optional[
+        Literal["strict_order", "relaxed_order"]
+    ] = None
 
     additional_user_profiles: list[dict] = field(default_factory=list)
     overwrite_user_profiles: Optional[list[dict]] = None
     profile_strict_mode: bool = False
     profile_validate_mode: bool = True
+    # "embedding" embeds profiles when they are written, and picks the profiles
+    # related to the chats by cosine similarity instead of asking the LLM
+    profile_filter_mode: Literal["llm", "embedding"] = "llm"
+    profile_filter_similarity_threshold: float = 0.3
+    # merge all the extracted facts of a flush in one LLM call, facts whose
+    # action can't be parsed fall back to one call each
+    batch_profile_merge: bool = False
 
     enable_event_summary: bool = True
+    # "fused" summarizes the chats and extracts the profiles in one LLM call,
+    # falls back to the two stages when its reply can't be parsed
+    extract_pipeline_mode: Literal["two_stage", "fused"] = "two_stage"
     minimum_chats_token_size_for_event_summary: int = 256
     event_tags: list[dict] = field(default_factory=list)
     # Telemetry
@@ -177,7 +237,7 @@ class Config:
 
     def __post_init__(self):
         assert self.llm_api_key is not None, "llm_api_key is required"
-        if self.enable_event_embedding:
+        if self.enable_event_embedding or self.enable_profile_embedding:
             if self.embedding_api_key is None and (
                 self.llm_style == self.embedding_provider == "openai"
             ):
@@ -186,7 +246,7 @@ class Config:
                 self.embedding_base_url = self.llm_base_url
             assert (
                 self.embedding_api_key is not None
-            ), "embedding_api_key is required for event embedding"
+            ), "embedding_api_key is required for event/profile embedding"
 
             if self.embedding_provider == "jina":
                 self.embedding_base_url = (
@@ -201,6 +261,10 @@ class Config:
         if self.overwrite_user_profiles:
             [UserProfileTopic(**up) for up in self.overwrite_user_profiles]
 
+    @property
+    def enable_profile_embedding(self) -> bool:
+        return self.profile_filter_mode == "embedding"
+
     @property
     def timezone(self) -> timezone:
         if self.use_timezone is None:
@@ -220,10 +284,13 @@ class ProfileConfig:
 
     enable_event_summary: bool = None
     event_tags: list[dict] = None
+    extract_pipeline_mode: Literal["two_stage", "fused"] | None = None
 
     def __post_init__(self):
         if self.language not in ["en", "zh"]:
             self.language = None
+        if self.extract_pipeline_mode not in ["two_stage", "fused"]:
+            self.extract_pipeline_mode = None
         if self.additional_user_profiles:
             [UserProfileTopic(**up) for up in self.additional_user_profiles]
         if self.overwrite_user_profiles:
@@ -1,6 +1,7 @@
 import time
+import asyncio
 from ..prompts.utils import convert_response_to_json
-from ..utils import get_encoded_tokens
+from ..tokenizer import count_tokens_batch
 from ..env import CONFIG, LOG
 from ..controllers.billing import project_cost_token_billing
 from ..models.utils import Promise
@@ -9,12 +10,18 @@ from ..telemetry import telemetry_manager, CounterMetricName, HistogramMetricNam
 
 from .openai_model_llm import openai_complete
 from .doubao_cache_llm import doubao_cache_complete
+from .limiter import LLM_LIMITER, LLMPriority, is_rate_limited
+from .cache import (
+    is_cacheable,
+    prompt_fingerprint,
+    get_cached_response,
+    set_cached_response,
+)
 
 FACTORIES = {"openai": openai_complete, "doubao_cache": doubao_cache_complete}
 assert CONFIG.llm_style in FACTORIES, f"Unsupported LLM style: {CONFIG.llm_style}"
 
 
-# TODO: add TPM/Rate limiter
 async def llm_complete(
     project_id,
     prompt,
@@ -22,44 +29,83 @@ async def llm_complete(
     history_messages=[],
     json_mode=False,
     model=None,
+    priority: LLMPriority = "batch",
     **kwargs,
 ) -> Promise[str | dict]:
     use_model = model or CONFIG.best_llm_model
     if json_mode:
         kwargs["response_format"] = {"type": "json_object"}
-    try:
-        start_time = time.time()
-        results = await FACTORIES[CONFIG.llm_style](
-            use_model,
-            prompt,
-            system_prompt=system_prompt,
-            history_messages=history_messages,
-            **kwargs,
+    prompt_id = kwargs.get("prompt_id")
+    cached = None
+    if is_cacheable(prompt_id):
+        fingerprint = prompt_fingerprint(
+            project_id, use_model, prompt, system_prompt, history_messages, kwargs
         )
-        latency = (time.time() - start_time) * 1000
-    except Exception as e:
-        LOG.error(f"Error in llm_complete: {e}")
-        return Promise.reject(CODE.SERVICE_UNAVAILABLE, f"Error in llm_complete: {e}")
-
-    in_tokens = len(
-        get_encoded_tokens(
-            prompt + system_prompt + "\n".join([m["content"] for m in history_messages])
+        cached = await get_cached_response(prompt_id, fingerprint)
+    if cached is not None:
+        return parse_llm_results(cached, json_mode)
+    input_text = (
+        prompt
+        + (system_prompt or "")
+        + "\n".join([m["content"] for m in history_messages])
+    )
+    estimated_tokens = 0
+    if CONFIG.llm_tpm_limit:
+        estimated_tokens = (await count_tokens_batch([input_text]))[0] + kwargs.get(
+            "max_tokens", 0
         )
+    for attempt in range(CONFIG.llm_rate_limit_retries + 1):
+        try:
+            async with LLM_LIMITER.acquire(use_model, estimated_tokens, priority):
+                start_time = time.time()
+                llm_result = await FACTORIES[CONFIG.llm_style](
+                    use_model,
+                    prompt,
+                    system_prompt=system_prompt,
+                    history_messages=history_messages,
+                    **kwargs,
+                )
+                latency = (time.time() - start_time) * 1000
+            break
+        except Exception as e:
+            if is_rate_limited(e) and attempt < CONFIG.llm_rate_limit_retries:
+                LOG.warning(f"LLM {use_model} is rate limited, retry {attempt + 1}")
+                await asyncio.sleep(2**attempt)
+                continue
+            LOG.error(f"Error in llm_complete: {e}")
+            return Promise.reject(
+                CODE.SERVICE_UNAVAILABLE, f"Error in llm_complete: {e}"
+            )
+
+    results = llm_result.content
+    in_tokens, out_tokens = llm_result.prompt_tokens, llm_result.completion_tokens
+    if in_tokens is None or out_tokens is None:
+        # provider didn't report usage, count it ourselves
+        in_tokens, out_tokens = await count_tokens_batch([input_text, results or ""])
+    await LLM_LIMITER.adjust_tokens(
+        use_model, in_tokens + out_tokens - estimated_tokens
     )
-    out_tokens = len(get_encoded_tokens(results))
 
     await project_cost_token_billing(project_id, in_tokens, out_tokens)
 
+    # per prompt, so pipelines that use different prompts can be compared
+    prompt_attributes = {"project_id": project_id, "prompt_id": prompt_id or ""}
     telemetry_manager.increment_counter_metric(
         CounterMetricName.LLM_TOKENS_INPUT,
         in_tokens,
-        {"project_id": project_id},
+        prompt_attributes,
     )
     telemetry_manager.increment_counter_metric(
         CounterMetricName.LLM_TOKENS_OUTPUT,
         out_tokens,
-        {"project_id": project_id},
+        prompt_attributes,
     )
+    if llm_result.cached_tokens:
+        telemetry_manager.increment_counter_metric(
+            CounterMetricName.LLM_TOKENS_CACHED,
+            llm_result.cached_tokens,
+            {"project_id": project_id},
+        )
     telemetry_manager.increment_counter_metric(
         CounterMetricName.LLM_INVOCATIONS,
         1,
@@ -68,9 +114,17 @@ async def llm_complete(
     telemetry_manager.record_histogram_metric(
         HistogramMetricName.LLM_LATENCY_MS,
         latency,
-        {"project_id": project_id},
+        {**prompt_attributes, "priority": priority},
     )
 
+    parsed = parse_llm_results(results, json_mode)
+    # don't cache a completion that can't be used
+    if is_cacheable(prompt_id) and results is not None and parsed.ok():
+        await set_cached_response(prompt_id, fingerprint, results)
+    return parsed
+
+
+def parse_llm_results(results: str, json_mode: bool) -> Promise[str | dict]:
     if not json_mode:
         return Promise.resolve(results)
     parse_dict = convert_response_to_json(results)
@@ -0,0 +1,99 @@
+"""
+Cache LLM completions of identical calls.
+
+Only prompt ids listed in `llm_response_cache_prompt_ids` are cached. Each
+prompt id keeps at most `llm_response_cache_max_entries` completions, the
+oldest ones are evicted first. Completions are never shared across projects.
+"""
+
+import json
+import time
+import hashlib
+import redis.exceptions
+from ..env import CONFIG, LOG
+from ..connectors import get_redis_client, PROJECT_ID
+from ..telemetry import telemetry_manager, CounterMetricName
+
+
+def normalize_text(text: str | None) -> str:
+    return (text or "").replace("\r\n", "\n").strip()
+
+
+def llm_cache_key(prompt_id: str, fingerprint: dict) -> str:
+    digest = hashlib.sha256(
+        json.dumps(fingerprint, sort_keys=True, ensure_ascii=False, default=str).encode()
+    ).hexdigest()
+    return f"powermemo::llm_response::{PROJECT_ID}::{prompt_id}::{digest}"
+
+
+def llm_cache_index_key(prompt_id: str) -> str:
+    return f"powermemo::llm_response_index::{PROJECT_ID}::{prompt_id}"
+
+
+def prompt_fingerprint(
+    project_id: str,
+    model: str,
+    prompt: str,
+    system_prompt: str | None,
+    history_messages: list[dict],
+    kwargs: dict,
+) -> dict:
+    return {
+        "project_id": project_id,
+        "model": model,
+        "prompt": normalize_text(prompt),
+        "system_prompt": normalize_text(system_prompt),
+        "history_messages": [
+            {**m, "content": normalize_text(m.get("content"))}
+            for m in history_messages
+        ],
+        "kwargs": kwargs,
+    }
+
+
+def is_cacheable(prompt_id: str | None) -> bool:
+    return prompt_id is not None and prompt_id in CONFIG.llm_response_cache_prompt_ids
+
+
+async def get_cached_response(prompt_id: str, fingerprint: dict) -> str | None:
+    try:
+        async with get_redis_client() as redis_client:
+            cached = await redis_client.get(llm_cache_key(prompt_id, fingerprint))
+    except redis.exceptions.RedisError as e:
+        LOG.warning(f"Failed to read LLM response cache: {e}")
+        cached = None
+    telemetry_manager.increment_counter_metric(
+        (
+            CounterMetricName.LLM_CACHE_HIT
+            if cached is not None
+            else CounterMetricName.LLM_CACHE_MISS
+        ),
+        1,
+        {"prompt_id": prompt_id},
+    )
+    return cached
+
+
+async def set_cached_response(prompt_id: str, fingerprint: dict, content: str) -> None:
+    try:
+        key = llm_cache_key(prompt_id, fingerprint)
+        index_key = llm_cache_index_key(prompt_id)
+        now = time.time()
+        async with get_redis_client() as redis_client:
+            async with redis_client.pipeline(transaction=True) as pipe:
+                pipe.set(key, content, ex=CONFIG.llm_response_cache_ttl)
+                pipe.zadd(index_key, {key: now})
+                # the completions of these entries already expired
+                pipe.zremrangebyscore(
+                    index_key, "-inf", now - CONFIG.llm_response_cache_ttl
+                )
+                pipe.expire(index_key, CONFIG.llm_response_cache_ttl)
+                pipe.zcard(index_key)
+                *_, size = await pipe.execute()
+            overflow = size - CONFIG.llm_response_cache_max_entries
+            if overflow > 0:
+                evicted = await redis_client.zpopmin(index_key, overflow)
+                if evicted:
+                    await redis_client.delete(*[k for k, _ in evicted])
+    except redis.exceptions.RedisError as e:
+        LOG.warning(f"Failed to write LLM response cache: {e}")
@@ -1,5 +1,9 @@
 import hashlib
-from .utils import get_doubao_async_client_instance, exclude_special_kwargs
+from .utils import (
+    get_doubao_async_client_instance,
+    exclude_special_kwargs,
+    LLMResult,
+)
 from ..connectors import get_redis_client
 from ..env import LOG
 
@@ -51,7 +55,7 @@ async def doubao_cache_create_context_and_save(
 
 async def doubao_cache_complete(
     model, prompt, system_prompt=None, history_messages=[], **kwargs
-) -> str:
+) -> LLMResult:
     sp_args, kwargs = exclude_special_kwargs(kwargs)
     prompt_id = sp_args.get("prompt_id", None)
     assert prompt_id is not None, "prompt_id is required"
@@ -73,12 +77,13 @@ async def doubao_cache_complete(
         response = await doubao_async_client.chat.completions.create(
             model=model, messages=messages, timeout=120, **kwargs
         )
-        return response.choices[0].message.content
+        return LLMResult.from_response(response)
     else:
         response = await doubao_async_client.context.completions.create(
             model=model, messages=messages, context_id=context_id, timeout=120, **kwargs
         )
+        result = LLMResult.from_response(response)
         LOG.info(
-            f"Cached {prompt_id} {model} {response.usage.prompt_tokens_details.cached_tokens}/{response.usage.prompt_tokens}"
+            f"Cached {prompt_id} {model} {result.cached_tokens}/{result.prompt_tokens}"
         )
-        return response.choices[0].message.content
+        return result
@@ -8,20 +8,30 @@ from ...models.response import CODE
 from ...models.database import DEFAULT_PROJECT_ID
 from .jina_embedding import jina_embedding
 from .openai_embedding import openai_embedding
+from .coalescer import EmbeddingCoalescer
+from .cache import get_cached_embeddings, set_cached_embeddings
 from ...telemetry import telemetry_manager, HistogramMetricName, CounterMetricName
-from ...utils import get_encoded_tokens
+from ...tokenizer import count_tokens_batch
 
 FACTORIES = {"openai": openai_embedding, "jina": jina_embedding}
 assert (
     CONFIG.embedding_provider in FACTORIES
 ), f"Unsupported embedding provider: {CONFIG.embedding_provider}"
 
+EMBEDDING_COALESCER = EmbeddingCoalescer(
+    FACTORIES[CONFIG.embedding_provider],
+    max_batch_size=CONFIG.embedding_batch_size,
+    max_token_size=CONFIG.embedding_max_token_size,
+    max_batch_token_size=CONFIG.embedding_batch_max_token_size,
+    max_wait_ms=CONFIG.embedding_batch_wait_ms,
+)
+
 
 async def check_embedding_sanity():
-    if not CONFIG.enable_event_embedding:
-        LOG.info("Event embedding is disabled, skipping sanity check.")
+    if not (CONFIG.enable_event_embedding or CONFIG.enable_profile_embedding):
+        LOG.info("Embedding is disabled, skipping sanity check.")
         return
-    r = await get_embedding(DEFAULT_PROJECT_ID, ["Hello, world!"])
+    r = await get_embedding(DEFAULT_PROJECT_ID, ["Hello, world!"], use_cache=False)
     if not r.ok():
         raise ValueError(
             "Embedding API check failed! Make sure the embedding API key is valid."
@@ -40,19 +50,39 @@ async def get_embedding(
     texts: list[str],
     phase: Literal["query", "document"] = "document",
     model: str = None,
+    use_cache: bool = True,
 ) -> Promise[np.ndarray]:
     model = model or CONFIG.embedding_model
+    start_time = time.time()
+    if use_cache:
+        results = await get_cached_embeddings(model, phase, texts)
+    else:
+        results = [None] * len(texts)
+    missing = [i for i, r in enumerate(results) if r is None]
+    if not missing:
+        return Promise.resolve(np.array(results))
+
+    missing_texts = [texts[i] for i in missing]
     try:
-        start_time = time.time()
-        results = await FACTORIES[CONFIG.embedding_provider](model, texts, phase)
+        # count what is sent, long texts are truncated
+        sent_texts, token_sizes = await EMBEDDING_COALESCER.truncate_batch(
+            missing_texts, await count_tokens_batch(missing_texts)
+        )
+        embeddings = await EMBEDDING_COALESCER.embed(
+            model, sent_texts, phase, token_sizes
+        )
         latency_ms = (time.time() - start_time) * 1000
     except Exception as e:
         LOG.error(f"Error in get_embedding: {e} {format_exc()}")
         return Promise.reject(CODE.SERVICE_UNAVAILABLE, f"Error in get_embedding: {e}")
-    embedding_tokens = len(get_encoded_tokens("\n".join(texts)))
+    await set_cached_embeddings(model, phase, missing_texts, embeddings)
+    for i, embedding in zip(missing, embeddings):
+        results[i] = embedding
+    results = np.array(results)
+
     telemetry_manager.increment_counter_metric(
         CounterMetricName.EMBEDDING_TOKENS,
-        embedding_tokens,
+        sum(token_sizes),
         {"project_id": project_id},
     )
     telemetry_manager.record_histogram_metric(
@@ -0,0 +1,66 @@
+"""
+Content-addressed embedding cache.
+
+Embeddings are stored in Redis as float32 bytes under a hash of the provider,
+model, dimension, phase and text, and expire after `embedding_cache_ttl`.
+"""
+
+import hashlib
+import numpy as np
+import redis.exceptions
+from ...env import CONFIG, LOG
+from ...connectors import get_redis_binary_client, PROJECT_ID
+from ...telemetry import telemetry_manager, CounterMetricName
+
+
+def embedding_cache_key(model: str, phase: str, text: str) -> str:
+    digest = hashlib.sha256(
+        "\0".join(
+            [CONFIG.embedding_provider, model, str(CONFIG.embedding_dim), phase, text]
+        ).encode()
+    ).hexdigest()
+    return f"powermemo::embedding::{PROJECT_ID}::{digest}"
+
+
+async def get_cached_embeddings(
+    model: str, phase: str, texts: list[str]
+) -> list[np.ndarray | None]:
+    if not CONFIG.enable_embedding_cache or not texts:
+        return [None] * len(texts)
+    keys = [embedding_cache_key(model, phase, t) for t in texts]
+    try:
+        async with get_redis_binary_client() as redis_client:
+            values = await redis_client.mget(keys)
+    except redis.exceptions.RedisError as e:
+        LOG.warning(f"Failed to read embedding cache: {e}")
+        values = [None] * len(texts)
+    results = [
+        np.frombuffer(v, dtype=np.float32) if v is not None else None for v in values
+    ]
+    hits = sum(r is not None for r in results)
+    telemetry_manager.increment_counter_metric(
+        CounterMetricName.EMBEDDING_CACHE_HIT, hits, {"phase": phase}
+    )
+    telemetry_manager.increment_counter_metric(
+        CounterMetricName.EMBEDDING_CACHE_MISS, len(texts) - hits, {"phase": phase}
+    )
+    return results
+
+
+async def set_cached_embeddings(
+    model: str, phase: str, texts: list[str], embeddings: np.ndarray
+) -> None:
+    if not CONFIG.enable_embedding_cache or not texts:
+        return
+    try:
+        async with get_redis_binary_client() as redis_client:
+            async with redis_client.pipeline(transaction=False) as pipe:
+                for text, embedding in zip(texts, embeddings):
+                    pipe.set(
+                        embedding_cache_key(model, phase, text),
+                        np.asarray(embedding, dtype=np.float32).tobytes(),
+                        ex=CONFIG.embedding_cache_ttl,
+                    )
+                await pipe.execute()
+    except redis.exceptions.RedisError as e:
+        LOG.warning(f"Failed to write embedding cache: {e}")
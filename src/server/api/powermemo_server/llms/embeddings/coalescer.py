@@ -0,0 +1,119 @@
+"""
+Coalesce concurrent embedding calls into batched provider requests.
+
+Texts with the same model and phase queued within `embedding_batch_wait_ms`
+are sent together, each request holds at most `embedding_batch_size` texts
+and `embedding_batch_max_token_size` tokens. Texts longer than
+`embedding_max_token_size` are truncated first.
+"""
+
+import asyncio
+import numpy as np
+from typing import Callable, Awaitable
+from ...env import CONFIG, LOG
+from ...tokenizer import truncate_tokens
+from ...telemetry import telemetry_manager, HistogramMetricName
+
+EmbeddingFactory = Callable[[str, list[str], str], Awaitable[np.ndarray]]
+PendingText = tuple[str, int, asyncio.Future]
+
+
+class EmbeddingCoalescer:
+    def __init__(
+        self,
+        factory: EmbeddingFactory,
+        max_batch_size: int,
+        max_token_size: int,
+        max_batch_token_size: int,
+        max_wait_ms: float,
+    ):
+        self.factory = factory
+        self.max_batch_size = max_batch_size
+        self.max_token_size = max_token_size
+        self.max_batch_token_size = max_batch_token_size
+        self.max_wait = max_wait_ms / 1000
+        self.pending: dict[tuple[str, str], list[PendingText]] = {}
+        # the loop only keeps weak references to tasks
+        self.running: set[asyncio.Task] = set()
+
+    async def truncate(self, text: str, token_size: int) -> tuple[str, int]:
+        if token_size <= self.max_token_size:
+            return text, token_size
+        LOG.warning(
+            f"Embedding text has {token_size} tokens, truncated to {self.max_token_size}"
+        )
+        return await truncate_tokens(text, self.max_token_size)
+
+    async def truncate_batch(
+        self, texts: list[str], token_sizes: list[int]
+    ) -> tuple[list[str], list[int]]:
+        if all(s <= self.max_token_size for s in token_sizes):
+            return texts, token_sizes
+        items = await asyncio.gather(
+            *[self.truncate(t, s) for t, s in zip(texts, token_sizes)]
+        )
+        return [t for t, _ in items], [s for _, s in items]
+
+    async def embed(
+        self, model: str, texts: list[str], phase: str, token_sizes: list[int]
+    ) -> np.ndarray:
+        if not texts:
+            return np.empty((0, CONFIG.embedding_dim))
+        # truncate before queueing, a batch may be flushed while this waits
+        texts, token_sizes = await self.truncate_batch(texts, token_sizes)
+        loop = asyncio.get_running_loop()
+        key = (model, phase)
+        if key not in self.pending:
+            self.pending[key] = []
+            loop.call_later(self.max_wait, self.flush, key)
+        queue = self.pending[key]
+        futures = []
+        for text, token_size in zip(texts, token_sizes):
+            future = loop.create_future()
+            queue.append((text, token_size, future))
+            futures.append(future)
+        return np.stack(await asyncio.gather(*futures))
+
+    def flush(self, key: tuple[str, str]):
+        pending = self.pending.pop(key, [])
+        batch, batch_tokens = [], 0
+        for item in pending:
+            if batch and (
+                len(batch) >= self.max_batch_size
+                or batch_tokens + item[1] > self.max_batch_token_size
+            ):
+                self.spawn_batch(key, batch)
+                batch, batch_tokens = [], 0
+            batch.append(item)
+            batch_tokens += item[1]
+        if batch:
+            self.spawn_batch(key, batch)
+
+    def spawn_batch(self, key: tuple[str, str], batch: list[PendingText]):
+        task = asyncio.ensure_future(self.run_batch(key, batch))
+        self.running.add(task)
+        task.add_done_callback(self.running.discard)
+
+    async def run_batch(self, key: tuple[str, str], batch: list[PendingText]):
+        # callers that were cancelled don't need their texts embedded
+        batch = [item for item in batch if not item[2].done()]
+        if not batch:
+            return
+        model, phase = key
+        telemetry_manager.record_histogram_metric(
+            HistogramMetricName.EMBEDDING_BATCH_SIZE, len(batch), {"phase": phase}
+        )
+        try:
+            results = await self.factory(model, [text for text, _, _ in batch], phase)
+            if len(results) != len(batch):
+                raise ValueError(
+                    f"Expected {len(batch)} embeddings, got {len(results)}"
+                )
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, _, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
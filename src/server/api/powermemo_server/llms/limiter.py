@@ -0,0 +1,228 @@
+"""
+Rate limit and adapt the concurrency of LLM calls.
+
+Requests and tokens per minute of each model are limited by token buckets in
+Redis shared by all nodes. Each node also adapts its own concurrency per model
+with AIMD: one more slot per window of calls that finish within the latency
+target, half of the slots after a 429 or a slow call.
+Callers wait in line instead of failing. Interactive calls go first, batch
+calls leave `llm_interactive_reserved_ratio` of the limits to them.
+"""
+
+import time
+import asyncio
+from typing import Literal
+from contextlib import asynccontextmanager
+import redis.exceptions
+from ..env import CONFIG, LOG
+from ..connectors import get_redis_client, PROJECT_ID
+from ..telemetry import telemetry_manager, HistogramMetricName
+
+LLMPriority = Literal["interactive", "batch"]
+
+# Take one request and `cost` tokens from the buckets of a model, or return how
+# many milliseconds to wait. A disabled limit has capacity 0, `reserved` is the
+# share of each bucket that must be left over
+TAKE_BUCKETS_SCRIPT = """
+local now_parts = redis.call('TIME')
+local now = tonumber(now_parts[1]) * 1000 + math.floor(tonumber(now_parts[2]) / 1000)
+local function refill(key, capacity)
+    if capacity <= 0 then
+        return nil
+    end
+    local state = redis.call('HMGET', key, 'level', 'ts')
+    local level = tonumber(state[1]) or capacity
+    local ts = tonumber(state[2]) or now
+    return math.min(capacity, level + (now - ts) * capacity / 60000)
+end
+local rpm = tonumber(ARGV[1])
+local tpm = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local reserved = tonumber(ARGV[4])
+local requests = refill(KEYS[1], rpm)
+local tokens = refill(KEYS[2], tpm)
+local wait = 0
+if requests ~= nil then
+    local need = math.min(1 + rpm * reserved, rpm)
+    if requests < need then
+        wait = math.max(wait, (need - requests) * 60000 / rpm)
+    end
+end
+-- a call larger than the whole bucket only waits for a full bucket
+if tokens ~= nil then
+    local need = math.min(cost + tpm * reserved, tpm)
+    if tokens < need then
+        wait = math.max(wait, (need - tokens) * 60000 / tpm)
+    end
+end
+if wait > 0 then
+    return math.ceil(wait)
+end
+if requests ~= nil then
+    redis.call('HSET', KEYS[1], 'level', requests - 1, 'ts', now)
+    redis.call('PEXPIRE', KEYS[1], 120000)
+end
+if tokens ~= nil then
+    redis.call('HSET', KEYS[2], 'level', tokens - cost, 'ts', now)
+    redis.call('PEXPIRE', KEYS[2], 120000)
+end
+return 0
+"""
+
+# Settle the difference between the estimated and the reported tokens
+ADJUST_TOKENS_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('HINCRBYFLOAT', KEYS[1], 'level', -tonumber(ARGV[1]))
+end
+return 1
+"""
+
+MAX_BUCKET_WAIT_SECONDS = 1
+
+
+def bucket_keys(model: str) -> tuple[str, str]:
+    prefix = f"powermemo::llm::rate_limit::{PROJECT_ID}::{model}"
+    return f"{prefix}::requests", f"{prefix}::tokens"
+
+
+def is_rate_limited(error: Exception) -> bool:
+    status_code = getattr(error, "status_code", None) or getattr(
+        getattr(error, "response", None), "status_code", None
+    )
+    return status_code == 429
+
+
+class AdaptiveConcurrency:
+    def __init__(
+        self,
+        min_limit: int,
+        max_limit: int,
+        latency_target_ms: float,
+        reserved_ratio: float = 0,
+    ):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target_ms = latency_target_ms
+        self.reserved_ratio = reserved_ratio
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self.interactive_waiting = 0
+        self.last_decrease = 0.0
+        self.condition = asyncio.Condition()
+
+    def batch_limit(self) -> int:
+        # batch calls always keep at least one slot
+        return max(1, int(self.limit) - int(self.limit * self.reserved_ratio))
+
+    async def acquire(self, priority: LLMPriority = "batch"):
+        async with self.condition:
+            if priority == "interactive":
+                self.interactive_waiting += 1
+                try:
+                    await self.condition.wait_for(
+                        lambda: self.in_flight < int(self.limit)
+                    )
+                finally:
+                    self.interactive_waiting -= 1
+                    # batch calls may have been held back by this call
+                    self.condition.notify_all()
+            else:
+                await self.condition.wait_for(
+                    lambda: not self.interactive_waiting
+                    and self.in_flight < self.batch_limit()
+                )
+            self.in_flight += 1
+
+    async def release(self, started_at: float, throttled: bool):
+        now = time.time()
+        async with self.condition:
+            self.in_flight -= 1
+            if throttled or (now - started_at) * 1000 > self.latency_target_ms:
+                # calls started before the last decrease saw the old limit
+                if started_at > self.last_decrease:
+                    self.limit = max(self.min_limit, self.limit / 2)
+                    self.last_decrease = now
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+
+class LLMLimiter:
+    def __init__(self):
+        self.concurrency: dict[str, AdaptiveConcurrency] = {}
+
+    @property
+    def rate_limited(self) -> bool:
+        return bool(CONFIG.llm_rpm_limit or CONFIG.llm_tpm_limit)
+
+    def get_concurrency(self, model: str) -> AdaptiveConcurrency:
+        if model not in self.concurrency:
+            self.concurrency[model] = AdaptiveConcurrency(
+                min_limit=CONFIG.llm_min_concurrency,
+                max_limit=CONFIG.llm_max_concurrency,
+                latency_target_ms=CONFIG.llm_latency_target_ms,
+                reserved_ratio=CONFIG.llm_interactive_reserved_ratio,
+            )
+        return self.concurrency[model]
+
+    async def take_buckets(self, model: str, tokens: int, priority: LLMPriority):
+        reserved = (
+            CONFIG.llm_interactive_reserved_ratio if priority == "batch" else 0
+        )
+        while True:
+            try:
+                async with get_redis_client() as redis_client:
+                    wait_ms = await redis_client.eval(
+                        TAKE_BUCKETS_SCRIPT,
+                        2,
+                        *bucket_keys(model),
+                        CONFIG.llm_rpm_limit or 0,
+                        CONFIG.llm_tpm_limit or 0,
+                        tokens,
+                        reserved,
+                    )
+            except redis.exceptions.RedisError as e:
+                # don't stop calling the LLM because Redis is unavailable
+                LOG.warning(f"Failed to take LLM rate limit buckets: {e}")
+                return
+            if not wait_ms:
+                return
+            await asyncio.sleep(min(int(wait_ms) / 1000, MAX_BUCKET_WAIT_SECONDS))
+
+    async def adjust_tokens(self, model: str, tokens: int):
+        if not CONFIG.llm_tpm_limit or not tokens:
+            return
+        try:
+            async with get_redis_client() as redis_client:
+                await redis_client.eval(
+                    ADJUST_TOKENS_SCRIPT, 1, bucket_keys(model)[1], tokens
+                )
+        except redis.exceptions.RedisError as e:
+            LOG.warning(f"Failed to adjust LLM token bucket: {e}")
+
+    @asynccontextmanager
+    async def acquire(
+        self, model: str, tokens: int, priority: LLMPriority = "batch"
+    ):
+        concurrency = self.get_concurrency(model)
+        queued_at = time.time()
+        if self.rate_limited:
+            await self.take_buckets(model, tokens, priority)
+        await concurrency.acquire(priority)
+        start_time = time.time()
+        telemetry_manager.record_histogram_metric(
+            HistogramMetricName.LLM_QUEUE_WAIT_MS,
+            (start_time - queued_at) * 1000,
+            {"model": model, "priority": priority},
+        )
+        throttled = False
+        try:
+            yield
+        except Exception as e:
+            throttled = is_rate_limited(e)
+            raise
+        finally:
+            await concurrency.release(start_time, throttled)
+
+
+LLM_LIMITER = LLMLimiter()
@@ -1,10 +1,14 @@
-from .utils import exclude_special_kwargs, get_openai_async_client_instance
+from .utils import (
+    exclude_special_kwargs,
+    get_openai_async_client_instance,
+    LLMResult,
+)
 from ..env import LOG
 
 
 async def openai_complete(
     model, prompt, system_prompt=None, history_messages=[], **kwargs
-) -> str:
+) -> LLMResult:
     sp_args, kwargs = exclude_special_kwargs(kwargs)
     prompt_id = sp_args.get("prompt_id", None)
 
@@ -18,8 +22,8 @@ async def openai_complete(
     response = await openai_async_client.chat.completions.create(
         model=model, messages=messages, timeout=120, **kwargs
     )
-    cached_tokens = getattr(response.usage.prompt_tokens_details, "cached_tokens", None)
+    result = LLMResult.from_response(response)
     LOG.info(
-        f"Cached {prompt_id} {model} {cached_tokens}/{response.usage.prompt_tokens}"
+        f"Cached {prompt_id} {model} {result.cached_tokens}/{result.prompt_tokens}"
     )
-    return response.choices[0].message.content
+    return result
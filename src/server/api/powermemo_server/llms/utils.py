@@ -1,3 +1,4 @@
+from dataclasses import dataclass
 from openai import AsyncOpenAI
 from volcenginesdkarkruntime import AsyncArk
 from ..env import CONFIG
@@ -6,6 +7,26 @@ _global_openai_async_client = None
 _global_doubao_async_client = None
 
 
+@dataclass
+class LLMResult:
+    content: str
+    # None when the provider doesn't report usage
+    prompt_tokens: int | None = None
+    completion_tokens: int | None = None
+    cached_tokens: int | None = None
+
+    @classmethod
+    def from_response(cls, response) -> "LLMResult":
+        usage = getattr(response, "usage", None)
+        details = getattr(usage, "prompt_tokens_details", None)
+        return cls(
+            content=response.choices[0].message.content,
+            prompt_tokens=getattr(usage, "prompt_tokens", None),
+            completion_tokens=getattr(usage, "completion_tokens", None),
+            cached_tokens=getattr(details, "cached_tokens", None),
+        )
+
+
 def get_openai_async_client_instance() -> AsyncOpenAI:
     global _global_openai_async_client
     if _global_openai_async_client is None:
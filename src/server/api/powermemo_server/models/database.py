@@ -13,11 +13,12 @@ from sqlalchemy import (
     Column,
     Index,
     Boolean,
+    Computed,
     PrimaryKeyConstraint,
     ForeignKeyConstraint,
 )
 from dataclasses import dataclass
-from sqlalchemy.dialects.postgresql import JSONB, UUID
+from sqlalchemy.dialects.postgresql import JSONB, UUID, TSVECTOR
 from sqlalchemy.orm import (
     relationship,
     Mapped,
@@ -303,6 +304,15 @@ class BufferZone(Base):
         VARCHAR(64),
         default=DEFAULT_PROJECT_ID,
     )
+
+    # Set when a flush claims this row, expired leases can be claimed again
+    flush_lease_id: Mapped[Optional[UUID]] = mapped_column(
+        UUID(as_uuid=True), nullable=True, default=None
+    )
+    flush_lease_expires_at: Mapped[Optional[datetime]] = mapped_column(
+        TIMESTAMP(timezone=True), nullable=True, default=None
+    )
+
     user: Mapped[User] = relationship(
         "User",
         back_populates="related_buffers",
@@ -323,6 +333,7 @@ class BufferZone(Base):
         Index(
             "idx_buffer_zones_user_id_blob_type", "user_id", "project_id", "blob_type"
         ),
+        Index("idx_buffer_zones_flush_lease_id", "flush_lease_id"),
         ForeignKeyConstraint(
             ["user_id", "project_id"],
             ["users.id", "users.project_id"],
@@ -360,6 +371,25 @@ class UserProfile(Base):
 
     attributes: Mapped[dict] = mapped_column(JSONB, nullable=True, default=None)
 
+    # tokens of `topic::sub_topic: content`, NULL for rows written before it existed
+    token_size: Mapped[Optional[int]] = mapped_column(
+        Integer, nullable=True, default=None
+    )
+
+    # generated from `attributes`, so topic filters can be pushed down to SQL
+    topic: Mapped[Optional[str]] = mapped_column(
+        TEXT, Computed("attributes->>'topic'", persisted=True), init=False
+    )
+    sub_topic: Mapped[Optional[str]] = mapped_column(
+        TEXT, Computed("attributes->>'sub_topic'", persisted=True), init=False
+    )
+
+    # only set when `profile_filter_mode` is "embedding", deferred so reading
+    # profiles doesn't load the vectors
+    embedding: Mapped[Vector] = mapped_column(
+        Vector(dim=CONFIG.embedding_dim), nullable=True, default=None, deferred=True
+    )
+
     project_id: Mapped[str] = mapped_column(
         VARCHAR(64),
         default=DEFAULT_PROJECT_ID,
@@ -372,10 +402,20 @@ class UserProfile(Base):
         foreign_keys=[user_id, project_id],
     )
 
+    # fetch created_at/updated_at with RETURNING, the profile cache needs them
+    __mapper_args__ = {"eager_defaults": True}
+
     __table_args__ = (
         PrimaryKeyConstraint("id", "project_id"),
         Index("idx_user_profiles_user_id_project_id", "user_id", "project_id"),
         Index("idx_user_profiles_user_id_id_project_id", "user_id", "project_id", "id"),
+        Index(
+            "idx_user_profiles_user_id_project_id_topic",
+            "user_id",
+            "project_id",
+            "topic",
+            "sub_topic",
+        ),
         ForeignKeyConstraint(
             ["user_id", "project_id"],
             ["users.id", "users.project_id"],
@@ -414,11 +454,54 @@ class UserEvent(Base):
     embedding: Mapped[Vector] = mapped_column(
         Vector(dim=CONFIG.embedding_dim), nullable=True, default=None
     )
+    # the event as it is written in the context and its tokens, NULL for rows
+    # written before they existed
+    event_str: Mapped[Optional[str]] = mapped_column(
+        TEXT, nullable=True, default=None
+    )
+    token_size: Mapped[Optional[int]] = mapped_column(
+        Integer, nullable=True, default=None
+    )
+    # events with a NULL embedding are pending, the background embedder gives
+    # up after `event_embedding_max_attempts` failures
+    embedding_attempts: Mapped[int] = mapped_column(
+        Integer, default=0, server_default="0"
+    )
+    # an embedder claimed the event until then, other embedders skip it
+    embedding_leased_until: Mapped[Optional[datetime]] = mapped_column(
+        TIMESTAMP(timezone=True), nullable=True, default=None
+    )
+    # string values of the event (tip, tags, profile deltas) for lexical search,
+    # "simple" keeps names and codes as they are in any language
+    search_vector: Mapped[Optional[str]] = mapped_column(
+        TSVECTOR,
+        Computed(
+            "jsonb_to_tsvector('simple'::regconfig, event_data, '[\"string\"]'::jsonb)",
+            persisted=True,
+        ),
+        init=False,
+        deferred=True,
+    )
 
     __table_args__ = (
         PrimaryKeyConstraint("id", "project_id"),
         Index("idx_user_events_user_id_project_id", "user_id", "project_id"),
+        Index(
+            "idx_user_events_search_vector", "search_vector", postgresql_using="gin"
+        ),
+        Index(
+            "idx_user_events_pending_embedding",
+            "created_at",
+            postgresql_where=text("embedding IS NULL"),
+        ),
         Index("idx_user_events_user_id_id_project_id", "user_id", "project_id", "id"),
+        Index(
+            "idx_user_events_embedding_hnsw",
+            "embedding",
+            postgresql_using="hnsw",
+            postgresql_with={"m": 16, "ef_construction": 64},
+            postgresql_ops={"embedding": "vector_cosine_ops"},
+        ),
         ForeignKeyConstraint(
             ["user_id", "project_id"],
             ["users.id", "users.project_id"],
@@ -1,6 +1,6 @@
 from datetime import datetime
 from enum import IntEnum
-from typing import Optional
+from typing import Optional, Literal
 from pydantic import BaseModel, UUID4, UUID5, Field
 from .blob import BlobData, OpenAICompatibleMessage
 from .claim import ClaimData
@@ -50,6 +50,16 @@ class IdsData(BaseModel):
     ids: list[UUID] = Field(..., description="List of UUID identifiers")
 
 
+class UserBlobData(BlobData):
+    user_id: UUID = Field(..., description="The ID of the user to insert the blob for")
+
+
+class BlobsData(BaseModel):
+    blobs: list[UserBlobData] = Field(
+        ..., min_length=1, description="List of blobs to insert"
+    )
+
+
 class ChatModalResponse(BaseModel):
     event_id: Optional[UUID] = Field(..., description="The event's unique identifier")
     add_profiles: Optional[list[UUID]] = Field(
@@ -63,6 +73,33 @@ class ChatModalResponse(BaseModel):
     )
 
 
+class BufferFlushData(BaseModel):
+    chat_results: Optional[list[ChatModalResponse]] = Field(
+        None, description="List of chat modal data"
+    )
+    flush_job_ids: Optional[list[str]] = Field(
+        None, description="List of queued buffer flush jobs' ids"
+    )
+
+
+class FlushJobData(BaseModel):
+    id: str = Field(..., description="The flush job's unique identifier")
+    status: Literal["pending", "processing", "done", "failed"] = Field(
+        ..., description="Status of the flush job"
+    )
+    blob_type: str = Field(..., description="The type of the flushed buffer")
+    result: Optional[ChatModalResponse] = Field(
+        None, description="Chat modal result when the job is done"
+    )
+    errmsg: Optional[str] = Field(None, description="Error message if the job failed")
+    created_at: Optional[datetime] = Field(
+        None, description="Timestamp when the job was queued"
+    )
+    updated_at: Optional[datetime] = Field(
+        None, description="Timestamp when the job status was last updated"
+    )
+
+
 class ProfileData(BaseModel):
     id: UUID = Field(..., description="The profile's unique identifier")
     content: str = Field(..., description="User profile content value")
@@ -76,6 +113,9 @@ class ProfileData(BaseModel):
         None,
         description="User profile attributes in JSON, containing 'topic', 'sub_topic'",
     )
+    token_size: Optional[int] = Field(
+        None, description="Token size of the profile in the context"
+    )
 
 
 class ProfileDelta(BaseModel):
@@ -109,6 +149,11 @@ class UserEventData(BaseModel):
         None, description="Timestamp when the event was last updated"
     )
     similarity: Optional[float] = Field(None, description="Similarity score")
+    token_size: Optional[int] = Field(
+        None, description="Token size of the event in the context"
+    )
+    # rendered when the event is written, only used to pack the context
+    event_str: Optional[str] = Field(None, exclude=True)
 
 
 class ContextData(BaseModel):
@@ -233,9 +278,23 @@ class ChatModalAPIResponse(BaseResponse):
     )
 
 
-class BlobInsertData(IdData):
-    chat_results: Optional[list[ChatModalResponse]] = Field(
-        None, description="List of chat modal data"
+class BlobInsertData(IdData, BufferFlushData):
+    pass
+
+
+class BlobsInsertData(IdsData, BufferFlushData):
+    pass
+
+
+class BlobsInsertResponse(BaseResponse):
+    data: Optional[BlobsInsertData] = Field(
+        None, description="Response containing blobs insert data"
+    )
+
+
+class FlushJobResponse(BaseResponse):
+    data: Optional[FlushJobData] = Field(
+        None, description="Response containing buffer flush job status"
     )
 
 
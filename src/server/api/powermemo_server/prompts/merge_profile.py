@@ -5,6 +5,9 @@ from ..env import CONFIG
 ADD_KWARGS = {
     "prompt_id": "merge_profile",
 }
+BATCH_ADD_KWARGS = {
+    "prompt_id": "merge_profile_batch",
+}
 EXAMPLES = {
     "replace": [
         {
@@ -208,12 +211,33 @@ That's all, now perform your job.
 """
 
 
+BATCH_MERGE_FACTS_PROMPT = """
+## Batch mode
+This time you will be given several memo pairs at once, each one starts with `# Memo [index]` and follows the input format above.
+Handle every memo pair on its own with the guidelines above.
+Think step by step about all the memo pairs first, then output one result line for each memo pair after `---`, starting with its index:
+<template>
+THOUGHT
+---
+- [index]{tab}UPDATE{tab}MEMO
+- [index]{tab}ABORT{tab}invalid
+</template>
+This output format replaces the single memo output format above, don't skip any index.
+"""
+
+
 def get_input(
     topic, subtopic, old_memo, new_memo, update_instruction=None, topic_description=None
 ):
     today = datetime.now().astimezone(CONFIG.timezone).strftime("%Y-%m-%d")
     return f"""Today is {today}.
-## Update Instruction
+{get_memo_sections(topic, subtopic, old_memo, new_memo, update_instruction, topic_description)}"""
+
+
+def get_memo_sections(
+    topic, subtopic, old_memo, new_memo, update_instruction=None, topic_description=None
+):
+    return f"""## Update Instruction
 {update_instruction or "NONE"}
 ### Topic Description
 {topic_description or "NONE"}
@@ -261,5 +285,25 @@ def get_kwargs() -> dict:
     return ADD_KWARGS
 
 
+def get_batch_input(items: list[dict]) -> str:
+    """items are the keyword arguments of `get_input`"""
+    today = datetime.now().astimezone(CONFIG.timezone).strftime("%Y-%m-%d")
+    memos = "\n".join(
+        f"# Memo {i}\n{get_memo_sections(**item)}" for i, item in enumerate(items)
+    )
+    return f"""Today is {today}.
+{memos}"""
+
+
+def get_batch_prompt() -> str:
+    return get_prompt() + BATCH_MERGE_FACTS_PROMPT.format(
+        tab=CONFIG.llm_tab_separator
+    )
+
+
+def get_batch_kwargs() -> dict:
+    return BATCH_ADD_KWARGS
+
+
 if __name__ == "__main__":
     print(get_prompt())
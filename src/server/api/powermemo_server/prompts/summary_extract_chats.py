@@ -0,0 +1,109 @@
+from . import user_profile_topics
+from .extract_profile import EXAMPLES
+from .utils import pack_profiles_into_string
+from ..env import CONFIG
+
+ADD_KWARGS = {
+    "prompt_id": "summary_extract_chats",
+}
+SUMMARY_EXTRACT_PROMPT = """You are a expert of logging personal info, schedule, events from chats, and a professional psychologist.
+You will be given a chats between a user and an assistant.
+You need to log the chats into a memo first, then extract the important profiles of user from your memo in structured format.
+
+## Step 1: Log the chats
+- You need to list all possible user info
+- You need to list all possible schedule
+- You need to list the user events with detailed datetime. Convert the event date info in the message based on [TIME] after your log. for example
+    Input: `[2024/04/30] user: I bought a new car yesterday!`
+    Output: `user bought a new car. [mention 2024/04/29, happen at 2024/04/30]`
+    Input: `[2024/04/30] user: I bought a car 4 years ago!`
+    Output: `user bought a car. [mention 2024/04/30, happen at 2020]`
+- Always add specific mention time of your log, and the event happen time if possible.
+- Log in Markdown unorder list format, under `## Events`, `## User Info` and `## Schedules`.
+
+Below is the important attributes you should log from the chats.
+<attributes>
+{attributes}
+</attributes>
+
+#### Input Chats
+The format of the conversation is:
+- [TIME] NAME: MESSAGE
+where NAME is ALIAS(ROLE) or just ROLE, when ALIAS is available, use ALIAS to refer user/assistant.
+TIME is the time of this message happened, so you need to convert the date info in the message based on TIME if necessary.
+
+## Step 2: Extract profiles from your memo
+Extract relevant and important facts, preferences about the user from your memo, one per line:
+- TOPIC{tab}SUB_TOPIC{tab}MEMO
+For example:
+- basic_info{tab}name{tab}melinda
+- work{tab}title{tab}software engineer
+You can create your own topics/sub_topics if you find it necessary, unless the user requests to not to create new topics/sub_topics.
+Consider use the same topic/subtopic in #### User Before Topics if it's mentioned again.
+Here are some few shot examples of memo and extracted profiles:
+{examples}
+
+Remember the following:
+- Use specific dates when possible, never use relative dates like "today" or "yesterday" etc.
+- You should infer what's implied from the conversation, not just what's explicitly stated.
+- Place all content related to this topic/sub_topic in one element, no repeat.
+- Only extract the attributes with actual values, leave the facts empty if there is nothing relevant.
+
+Below is the list of topics and subtopics that you should focus on logging and extracting:
+<topics>
+{topics}
+</topics>
+
+## Output Format
+<memo>
+YOUR MEMO OF THE CHATS
+</memo>
+<facts>
+- TOPIC{tab}SUB_TOPIC{tab}MEMO
+...
+</facts>
+
+The memo and facts should use the same language as the chats. English in, English out. Chinese in, Chinese out.
+Now perform your task.
+"""
+
+
+def pack_input(already_input, chat_strs, strict_mode: bool = False):
+    header = ""
+    if strict_mode:
+        header = "Don't extract topics/subtopics that are not mentioned in <topics>, otherwise your answer is invalid!"
+    return f"""{header}
+#### User Before Topics
+{already_input}
+#### Chats
+{chat_strs}
+"""
+
+
+def get_prompt(topic_examples: str, attribute_examples: str) -> str:
+    examples = "\n\n".join(
+        [
+            f"""<example>
+<input>{p[0]}</input>
+<output>
+{pack_profiles_into_string(p[1])}
+</output>
+</example>
+"""
+            for p in EXAMPLES
+        ]
+    )
+    return SUMMARY_EXTRACT_PROMPT.format(
+        topics=topic_examples,
+        attributes=attribute_examples,
+        examples=examples,
+        tab=CONFIG.llm_tab_separator,
+    )
+
+
+def get_kwargs() -> dict:
+    return ADD_KWARGS
+
+
+if __name__ == "__main__":
+    print(get_prompt(user_profile_topics.get_prompt(), ""))
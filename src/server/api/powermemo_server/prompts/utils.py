@@ -156,6 +156,26 @@ def parse_string_into_merge_action(results: str) -> dict | None:
     }
 
 
+def parse_string_into_merge_actions(results: str) -> dict[int, dict]:
+    """Parse `- [index]::ACTION::MEMO` lines of a batch merge, keyed by index"""
+    actions = {}
+    for line in results.split("\n"):
+        line = line.strip()
+        if not line.startswith("- "):
+            continue
+        parts = line[2:].split(CONFIG.llm_tab_separator)
+        if len(parts) != 3:
+            continue
+        index = parts[0].strip().strip("[]")
+        if not index.isdigit():
+            continue
+        actions[int(index)] = {
+            "action": parts[1].upper().strip(),
+            "memo": parts[2].strip(),
+        }
+    return actions
+
+
 def pack_profiles_into_string(profiles: AIUserProfiles) -> str:
     lines = [
         f"- {attribute_unify(p.topic)}{CONFIG.llm_tab_separator}{attribute_unify(p.sub_topic)}{CONFIG.llm_tab_separator}{p.memo.strip()}"
@@ -184,6 +204,19 @@ def parse_string_into_profiles(response: str) -> AIUserProfiles:
     return AIUserProfiles(facts=facts)
 
 
+def parse_string_into_memo_and_profiles(
+    response: str,
+) -> tuple[str, AIUserProfiles] | None:
+    """Parse the `<memo>` and `<facts>` sections of a fused summary and extraction"""
+    memo = re.search(r"<memo>(.*?)</memo>", response, re.DOTALL)
+    if memo is None or not memo.group(1).strip():
+        return None
+    # the facts may be left out when there is nothing to extract
+    facts = re.search(r"<facts>(.*?)(?:</facts>|$)", response, re.DOTALL)
+    profiles = parse_string_into_profiles(facts.group(1) if facts else "")
+    return memo.group(1).strip(), profiles
+
+
 def parse_line_into_profile(line: str) -> AIUserProfile | None:
     if not line.startswith("- "):
         return None
@@ -5,6 +5,9 @@ from ..env import CONFIG
 ADD_KWARGS = {
     "prompt_id": "zh_merge_profile",
 }
+BATCH_ADD_KWARGS = {
+    "prompt_id": "zh_merge_profile_batch",
+}
 EXAMPLES = {
     "replace": [
         {
@@ -207,12 +210,33 @@ THOUGHT
 """
 
 
+BATCH_MERGE_FACTS_PROMPT = """
+## 批量模式
+这次你会一次收到多组备忘录，每组以`# 备忘录 [index]`开头，并遵循上面的输入格式。
+请按照上面的指南独立处理每一组备忘录。
+先逐步思考所有组的备忘录，然后在`---`之后为每一组输出一行结果，以该组的序号开头：
+<template>
+THOUGHT
+---
+- [index]{tab}UPDATE{tab}MEMO
+- [index]{tab}ABORT{tab}invalid
+</template>
+这个输出格式替代上面单组备忘录的输出格式，不要遗漏任何序号。
+"""
+
+
 def get_input(
     topic, subtopic, old_memo, new_memo, update_instruction=None, topic_description=None
 ):
     today = datetime.now().astimezone(CONFIG.timezone).strftime("%Y-%m-%d")
     return f"""今天是{today}。
-## 更新说明
+{get_memo_sections(topic, subtopic, old_memo, new_memo, update_instruction, topic_description)}"""
+
+
+def get_memo_sections(
+    topic, subtopic, old_memo, new_memo, update_instruction=None, topic_description=None
+):
+    return f"""## 更新说明
 {update_instruction or "NONE"}
 ### 主题描述
 {topic_description or "NONE"}
@@ -260,5 +284,25 @@ def get_kwargs() -> dict:
     return ADD_KWARGS
 
 
+def get_batch_input(items: list[dict]) -> str:
+    """items are the keyword arguments of `get_input`"""
+    today = datetime.now().astimezone(CONFIG.timezone).strftime("%Y-%m-%d")
+    memos = "\n".join(
+        f"# 备忘录 {i}\n{get_memo_sections(**item)}" for i, item in enumerate(items)
+    )
+    return f"""今天是{today}。
+{memos}"""
+
+
+def get_batch_prompt() -> str:
+    return get_prompt() + BATCH_MERGE_FACTS_PROMPT.format(
+        tab=CONFIG.llm_tab_separator
+    )
+
+
+def get_batch_kwargs() -> dict:
+    return BATCH_ADD_KWARGS
+
+
 if __name__ == "__main__":
     print(get_prompt())
@@ -0,0 +1,109 @@
+from . import zh_user_profile_topics
+from .zh_extract_profile import EXAMPLES
+from .utils import pack_profiles_into_string
+from ..env import CONFIG
+
+ADD_KWARGS = {
+    "prompt_id": "zh_summary_extract_chats",
+}
+SUMMARY_EXTRACT_PROMPT = """你是一位从聊天记录中记录个人信息、日程安排和事件的专家，也是一位专业的心理学家。
+你将获得用户和助手之间的对话内容。
+你需要先把对话记录成一份备忘录，然后从你的备忘录中按结构化格式提取用户的重要画像。
+
+## 第一步：记录对话
+- 你需要列出所有可能的用户信息
+- 你需要列出所有可能的日程安排
+- 你需要列出用户事件及其详细时间。根据消息后的[TIME]转换消息中的事件日期信息。例如：
+    输入: `[2024/04/30] user: 我昨天买了一辆新车！`
+    输出: `用户买了一辆新车。[提及于 2024/04/29, 发生于 2024/04/30]`
+    输入: `[2024/04/30] user: 我4年前买了一辆车！`
+    输出: `用户买了一辆车。[提及于 2024/04/30, 发生于 2020]`
+- 始终添加你记录的具体提及时间，如果可能的话也要添加事件发生时间。
+- 使用Markdown无序列表格式记录，分为`## 事件`、`## 用户信息`和`## 日程安排`。
+
+以下是你应该从聊天中记录的重要属性。
+<attributes>
+{attributes}
+</attributes>
+
+#### 输入对话
+对话格式为：
+- [TIME] NAME: MESSAGE
+其中NAME是ALIAS(ROLE)或仅ROLE，当ALIAS可用时，使用ALIAS来指代用户/助手。
+TIME是此消息发生的时间，因此你需要根据TIME转换消息中的日期信息（如有必要）。
+
+## 第二步：从备忘录中提取画像
+从你的备忘录中提取关于用户的相关且重要的事实和偏好，每行一个：
+- TOPIC{tab}SUB_TOPIC{tab}MEMO
+例如：
+- 基本信息{tab}姓名{tab}melinda
+- 工作{tab}职称{tab}软件工程师
+如果你认为有必要，可以创建自己的主题/子主题，除非用户明确要求不要创建新的主题/子主题。
+如果再次提到#### 已有的主题中的主题/子主题，请考虑使用相同的主题/子主题。
+以下是一些备忘录和提取结果的示例：
+{examples}
+
+请记住以下几点：
+- 当可能时，请使用具体日期，而不是使用"今天"或"昨天"等相对时间。
+- 你应该推断对话中隐含的内容，而不仅仅是明确陈述的内容。
+- 将所有与该主题/子主题相关的内容放在一个元素中，不要重复。
+- 只提取有实际值的属性，如果没有相关内容，事实部分留空。
+
+以下是你应该重点记录和提取的主题和子主题列表：
+<topics>
+{topics}
+</topics>
+
+## 输出格式
+<memo>
+你对对话的备忘录
+</memo>
+<facts>
+- TOPIC{tab}SUB_TOPIC{tab}MEMO
+...
+</facts>
+
+备忘录和事实应使用与聊天相同的语言。英文输入则英文输出，中文输入则中文输出。
+现在请执行你的任务。
+"""
+
+
+def pack_input(already_input, chat_strs, strict_mode: bool = False):
+    header = ""
+    if strict_mode:
+        header = "不要提取<topics>中没出现的主题/子主题， 否则你的回答是无效的！"
+    return f"""{header}
+#### 已有的主题
+{already_input}
+#### 对话
+{chat_strs}
+"""
+
+
+def get_prompt(topic_examples: str, attribute_examples: str) -> str:
+    examples = "\n\n".join(
+        [
+            f"""<example>
+<input>{p[0]}</input>
+<output>
+{pack_profiles_into_string(p[1])}
+</output>
+</example>
+"""
+            for p in EXAMPLES
+        ]
+    )
+    return SUMMARY_EXTRACT_PROMPT.format(
+        topics=topic_examples,
+        attributes=attribute_examples,
+        examples=examples,
+        tab=CONFIG.llm_tab_separator,
+    )
+
+
+def get_kwargs() -> dict:
+    return ADD_KWARGS
+
+
+if __name__ == "__main__":
+    print(get_prompt(zh_user_profile_topics.get_prompt(), ""))
@@ -35,7 +35,12 @@ class CounterMetricName(Enum):
     LLM_INVOCATIONS = "llm_invocations_total"
     LLM_TOKENS_INPUT = "llm_input_tokens_total"
     LLM_TOKENS_OUTPUT = "llm_output_tokens_total"
+    LLM_TOKENS_CACHED = "llm_cached_input_tokens_total"
     EMBEDDING_TOKENS = "embedding_tokens_total"
+    EMBEDDING_CACHE_HIT = "embedding_cache_hit_total"
+    EMBEDDING_CACHE_MISS = "embedding_cache_miss_total"
+    LLM_CACHE_HIT = "llm_cache_hit_total"
+    LLM_CACHE_MISS = "llm_cache_miss_total"
 
     def get_description(self) -> str:
         """Get the description for this metric."""
@@ -45,7 +50,12 @@ class CounterMetricName(Enum):
             CounterMetricName.LLM_INVOCATIONS: "Total number of LLM invocations",
             CounterMetricName.LLM_TOKENS_INPUT: "Total number of input tokens",
             CounterMetricName.LLM_TOKENS_OUTPUT: "Total number of output tokens",
+            CounterMetricName.LLM_TOKENS_CACHED: "Total number of input tokens served from the provider's prompt cache",
             CounterMetricName.EMBEDDING_TOKENS: "Total number of embedding tokens",
+            CounterMetricName.EMBEDDING_CACHE_HIT: "Total number of texts whose embedding was found in the cache",
+            CounterMetricName.EMBEDDING_CACHE_MISS: "Total number of texts whose embedding was not in the cache",
+            CounterMetricName.LLM_CACHE_HIT: "Total number of LLM completions served from the response cache",
+            CounterMetricName.LLM_CACHE_MISS: "Total number of cacheable LLM completions not found in the response cache",
         }
         return descriptions[self]
 
@@ -60,6 +70,9 @@ class HistogramMetricName(Enum):
     LLM_LATENCY_MS = "llm_latency"
     EMBEDDING_LATENCY_MS = "embedding_latency"
     REQUEST_LATENCY_MS = "request_latency"
+    BUFFER_FLUSH_LAG_MS = "buffer_flush_lag"
+    EMBEDDING_BATCH_SIZE = "embedding_batch_size"
+    LLM_QUEUE_WAIT_MS = "llm_queue_wait"
 
     def get_description(self) -> str:
         """Get the description for this metric."""
@@ -67,6 +80,9 @@ class HistogramMetricName(Enum):
             HistogramMetricName.LLM_LATENCY_MS: "Latency of the LLM in milliseconds",
             HistogramMetricName.EMBEDDING_LATENCY_MS: "Latency of the embedding in milliseconds",
             HistogramMetricName.REQUEST_LATENCY_MS: "Latency of the request in milliseconds",
+            HistogramMetricName.BUFFER_FLUSH_LAG_MS: "Delay between a buffer's idle deadline and its flush in milliseconds",
+            HistogramMetricName.EMBEDDING_BATCH_SIZE: "Number of texts in one coalesced embedding request",
+            HistogramMetricName.LLM_QUEUE_WAIT_MS: "Time an LLM call waited for the rate limiter and a concurrency slot in milliseconds",
         }
         return descriptions[self]
 
@@ -0,0 +1,105 @@
+"""
+Count tokens off the event loop.
+
+Concurrent calls in the same loop tick are batched into one `encode_batch`
+call on a thread pool, tiktoken releases the GIL while encoding.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from .env import ENCODER, CONFIG
+
+# encoding short strings inline is cheaper than a round trip to the pool
+INLINE_TOKENIZE_MAX_CHARS = 256
+
+
+def _count_tokens_batch(contents: list[str]) -> list[int | Exception]:
+    try:
+        return [len(tokens) for tokens in ENCODER.encode_batch(contents)]
+    except Exception:
+        # don't fail the whole batch because of one caller's content
+        results = []
+        for content in contents:
+            try:
+                results.append(len(ENCODER.encode(content)))
+            except Exception as e:
+                results.append(e)
+        return results
+
+
+def _truncate_tokens(content: str, max_tokens: int) -> tuple[str, int]:
+    tokens = ENCODER.encode(content)[:max_tokens]
+    return ENCODER.decode(tokens), len(tokens)
+
+
+class TokenizerPool:
+    def __init__(self, max_workers: int, max_batch_size: int):
+        self.max_batch_size = max_batch_size
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="powermemo_tokenizer"
+        )
+        self.pending: list[tuple[str, asyncio.Future]] = []
+        self.flush_scheduled = False
+        # the loop only keeps weak references to tasks
+        self.running: set[asyncio.Task] = set()
+
+    async def count_tokens_batch(self, contents: list[str]) -> list[int]:
+        if sum(len(c) for c in contents) <= INLINE_TOKENIZE_MAX_CHARS:
+            return [len(ENCODER.encode(c)) for c in contents]
+        loop = asyncio.get_running_loop()
+        futures = [loop.create_future() for _ in contents]
+        self.pending.extend(zip(contents, futures))
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            loop.call_soon(self.flush)
+        return list(await asyncio.gather(*futures))
+
+    def flush(self):
+        pending, self.pending = self.pending, []
+        self.flush_scheduled = False
+        for i in range(0, len(pending), self.max_batch_size):
+            batch = pending[i : i + self.max_batch_size]
+            task = asyncio.ensure_future(self.run_batch(batch))
+            self.running.add(task)
+            task.add_done_callback(self.running.discard)
+
+    async def run_batch(self, batch: list[tuple[str, asyncio.Future]]):
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(
+                self.executor, _count_tokens_batch, [c for c, _ in batch]
+            )
+        except Exception as e:
+            results = [e] * len(batch)
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def truncate(self, content: str, max_tokens: int) -> tuple[str, int]:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, _truncate_tokens, content, max_tokens
+        )
+
+
+TOKENIZER_POOL = TokenizerPool(
+    max_workers=CONFIG.tokenizer_workers,
+    max_batch_size=CONFIG.tokenizer_batch_size,
+)
+
+
+async def count_tokens(content: str) -> int:
+    return (await TOKENIZER_POOL.count_tokens_batch([content]))[0]
+
+
+async def count_tokens_batch(contents: list[str]) -> list[int]:
+    return await TOKENIZER_POOL.count_tokens_batch(contents)
+
+
+async def truncate_tokens(content: str, max_tokens: int) -> tuple[str, int]:
+    """Cut the content to its first `max_tokens` tokens"""
+    return await TOKENIZER_POOL.truncate(content, max_tokens)
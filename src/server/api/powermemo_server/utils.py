@@ -4,6 +4,7 @@ import json
 from typing import cast
 from datetime import timezone, datetime
 from functools import wraps
+from contextlib import asynccontextmanager
 from pydantic import ValidationError
 from .env import ENCODER, LOG, CONFIG, ProfileConfig
 from .models.blob import Blob, BlobType, ChatBlob, DocBlob, OpenAICompatibleMessage
@@ -11,12 +12,23 @@ from .models.database import GeneralBlob
 from .models.response import UserEventData, EventData
 from .models.utils import Promise, CODE
 from .connectors import get_redis_client, PROJECT_ID
+from .tokenizer import count_tokens
 
 LIST_INT_REGEX = re.compile(r"\[\s*(?:\d+(?:\s*,\s*\d+)*\s*)?\]")
 
 
+def profile_str_repr(attributes: dict | None, content: str) -> str:
+    attributes = attributes or {}
+    return f"{attributes.get('topic')}::{attributes.get('sub_topic')}: {content}"
+
+
 def event_str_repr(event: UserEventData) -> str:
-    event_data = event.event_data
+    if event.event_str is not None:
+        return event.event_str
+    return event_data_str_repr(event.event_data)
+
+
+def event_data_str_repr(event_data: EventData) -> str:
     if event_data.event_tip is None:
         profile_deltas = [
             f"- {ed.attributes['topic']}::{ed.attributes['sub_topic']}: {ed.content}"
@@ -137,39 +149,52 @@ def get_blob_str(blob: Blob):
             raise ValueError(f"Unsupported Blob Type: {blob.type}")
 
 
-def get_blob_token_size(blob: Blob):
-    return len(get_encoded_tokens(get_blob_str(blob)))
+async def get_blob_token_size(blob: Blob) -> int:
+    return await count_tokens(get_blob_str(blob))
 
 
 def seconds_from_now(dt: datetime):
     return (datetime.now().astimezone() - dt.astimezone()).seconds
 
 
+@asynccontextmanager
+async def acquire_user_id_lock(
+    scope: str, user_id: str, lock_timeout=128, blocking_timeout=32
+):
+    lock_key = f"user_lock:{PROJECT_ID}:{scope}:{user_id}"
+    async with get_redis_client() as redis_client:
+        lock = redis_client.lock(
+            lock_key, timeout=lock_timeout, blocking_timeout=blocking_timeout
+        )
+        try:
+            if not await lock.acquire(blocking=True):
+                raise TimeoutError(
+                    f"Could not acquire lock for user {user_id} in scope {scope}"
+                )
+            yield
+        finally:
+            try:
+                if await lock.locked():
+                    await lock.release()
+            except Exception as e:
+                LOG.error(
+                    f"Error releasing lock for user {user_id} in scope {scope}: {e}"
+                )
+                # Consider forcing lock release or implementing a recovery mechanism
+                # raise RuntimeError(f"Lock release failed: {e}") from e
+
+
 def user_id_lock(scope, lock_timeout=128, blocking_timeout=32):
     def __user_id_lock(func):
         @wraps(func)
         async def wrapper(user_id, *args, **kwargs):
-            lock_key = f"user_lock:{PROJECT_ID}:{scope}:{user_id}"
-            async with get_redis_client() as redis_client:
-                lock = redis_client.lock(
-                    lock_key, timeout=lock_timeout, blocking_timeout=blocking_timeout
-                )
-                try:
-                    if not await lock.acquire(blocking=True):
-                        raise TimeoutError(
-                            f"Could not acquire lock for user {user_id} in scope {scope}"
-                        )
-                    return await func(user_id, *args, **kwargs)
-                finally:
-                    try:
-                        if await lock.locked():
-                            await lock.release()
-                    except Exception as e:
-                        LOG.error(
-                            f"Error releasing lock for user {user_id} in scope {scope}: {e}"
-                        )
-                        # Consider forcing lock release or implementing a recovery mechanism
-                        # raise RuntimeError(f"Lock release failed: {e}") from e
+            async with acquire_user_id_lock(
+                scope,
+                user_id,
+                lock_timeout=lock_timeout,
+                blocking_timeout=blocking_timeout,
+            ):
+                return await func(user_id, *args, **kwargs)
 
         return wrapper
 
@@ -1,7 +1,12 @@
 import pytest
 import asyncio
 from api import app
+from powermemo_server import controllers
 from powermemo_server.env import CONFIG
+from powermemo_server.connectors import redis_health_check
+from powermemo_server.models import response as res
+from powermemo_server.models.blob import BlobType
+from powermemo_server.models.database import DEFAULT_PROJECT_ID
 from fastapi.testclient import TestClient
 
 PREFIX = "/api/v1"
@@ -31,3 +36,29 @@ async def db_env():
         yield
     else:
         pytest.skip("Database not available")
+
+
+@pytest.fixture(scope="function")
+async def redis_env():
+    if await redis_health_check():
+        yield
+    else:
+        pytest.skip("Redis not available")
+
+
+@pytest.fixture(scope="function")
+async def user_id(db_env):
+    p = await controllers.user.create_user(res.UserData(), DEFAULT_PROJECT_ID)
+    assert p.ok()
+    u_id = str(p.data().id)
+    yield u_id
+    p = await controllers.user.delete_user(u_id, DEFAULT_PROJECT_ID)
+    assert p.ok()
+
+
+@pytest.fixture(scope="function")
+def chat_blob_data():
+    return res.BlobData(
+        blob_type=BlobType.chat,
+        blob_data={"messages": [{"role": "user", "content": "Hello world"}]},
+    )
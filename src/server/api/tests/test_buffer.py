@@ -0,0 +1,210 @@
+import pytest
+from uuid import uuid4
+from unittest.mock import patch
+from powermemo_server import controllers
+from powermemo_server.models import response as res
+from powermemo_server.models.blob import BlobType
+from powermemo_server.models.database import DEFAULT_PROJECT_ID
+from powermemo_server.connectors import get_redis_client
+from powermemo_server.controllers.buffer import (
+    BUFFER_STATE_TTL,
+    buffer_state_key,
+)
+from powermemo_server.controllers.buffer_queue import (
+    FLUSH_DEADLINES_KEY,
+    flush_deadline_member,
+)
+
+
+async def insert_chat_blobs(u_id: str, blob_data: res.BlobData, count: int):
+    for _ in range(count):
+        p = await controllers.blob.insert_blob(u_id, DEFAULT_PROJECT_ID, blob_data)
+        assert p.ok()
+        p = await controllers.buffer.insert_blob_to_buffer(
+            u_id, DEFAULT_PROJECT_ID, p.data().id, blob_data.to_blob()
+        )
+        assert p.ok()
+
+
+@pytest.mark.asyncio
+async def test_flush_job_queue(user_id):
+    p = await controllers.buffer_queue.enqueue_flush_job(
+        user_id, DEFAULT_PROJECT_ID, BlobType.chat
+    )
+    assert p.ok()
+    job_id = p.data()
+
+    # the same buffer shouldn't be queued twice
+    p = await controllers.buffer_queue.enqueue_flush_job(
+        user_id, DEFAULT_PROJECT_ID, BlobType.chat
+    )
+    assert p.ok() and p.data() == job_id
+
+    p = await controllers.buffer_queue.get_flush_job(
+        user_id, DEFAULT_PROJECT_ID, job_id
+    )
+    assert p.ok()
+    assert p.data().status == "pending"
+
+    await controllers.buffer_queue.process_flush_job(job_id)
+    p = await controllers.buffer_queue.get_flush_job(
+        user_id, DEFAULT_PROJECT_ID, job_id
+    )
+    assert p.ok()
+    assert p.data().status == "done"
+    assert p.data().result is None
+
+    p = await controllers.buffer_queue.get_flush_job(user_id, "other_project", job_id)
+    assert not p.ok()
+
+
+@pytest.mark.asyncio
+async def test_buffer_state_counters(user_id, chat_blob_data):
+    await insert_chat_blobs(user_id, chat_blob_data, 2)
+
+    state = await controllers.buffer.get_buffer_state(
+        user_id, DEFAULT_PROJECT_ID, BlobType.chat
+    )
+    assert state.blob_count == 2
+    assert state.token_size > 0
+
+    # a lost state is rebuilt from the buffer table
+    await controllers.buffer.reset_buffer_state(
+        user_id, DEFAULT_PROJECT_ID, BlobType.chat
+    )
+    rebuilt = await controllers.buffer.get_buffer_state(
+        user_id, DEFAULT_PROJECT_ID, BlobType.chat
+    )
+    assert rebuilt.blob_count == state.blob_count
+    assert rebuilt.token_size == state.token_size
+
+
+@pytest.mark.asyncio
+async def test_buffer_state_keeps_unflushed_deadline(user_id, chat_blob_data):
+    member = flush_deadline_member(user_id, DEFAULT_PROJECT_ID, BlobType.chat)
+    await insert_chat_blobs(user_id, chat_blob_data, 2)
+    state = await controllers.buffer.get_buffer_state(
+        user_id, DEFAULT_PROJECT_ID, BlobType.chat
+    )
+
+    # a flush that claimed one blob leaves the other one scheduled
+    await controllers.buffer.decr_buffer_state(
+        user_id, DEFAULT_PROJECT_ID, BlobType.chat, state.token_size // 2, 1
+    )
+    left = await controllers.buffer.get_buffer_state(
+        user_id, DEFAULT_PROJECT_ID, BlobType.chat
+    )
+    assert left.blob_count == 1
+    async with get_redis_client() as redis_client:
+        assert await redis_client.zscore(FLUSH_DEADLINES_KEY, member) is not None
+
+    await controllers.buffer.decr_buffer_state(
+        user_id, DEFAULT_PROJECT_ID, BlobType.chat, left.token_size, 1
+    )
+    async with get_redis_client() as redis_client:
+        assert await redis_client.zscore(FLUSH_DEADLINES_KEY, member) is None
+
+
+@pytest.mark.asyncio
+async def test_buffer_claim_is_exclusive(user_id, chat_blob_data):
+    await insert_chat_blobs(user_id, chat_blob_data, 1)
+
+    rows = await controllers.buffer.claim_buffer_rows(
+        user_id, DEFAULT_PROJECT_ID, BlobType.chat, uuid4()
+    )
+    assert len(rows) == 1
+    # leased rows can't be claimed by another flush
+    rows = await controllers.buffer.claim_buffer_rows(
+        user_id, DEFAULT_PROJECT_ID, BlobType.chat, uuid4()
+    )
+    assert len(rows) == 0
+    state = await controllers.buffer.get_buffer_state(
+        user_id, DEFAULT_PROJECT_ID, BlobType.chat
+    )
+    assert state.blob_count == 0
+
+
+@pytest.mark.asyncio
+async def test_insert_blobs_to_buffer(user_id, chat_blob_data):
+    p = await controllers.user.create_user(res.UserData(), DEFAULT_PROJECT_ID)
+    assert p.ok()
+    u_ids = [user_id, str(p.data().id)]
+
+    blob = chat_blob_data.to_blob()
+    user_blobs = [(u_ids[0], blob), (u_ids[1], blob), (u_ids[0], blob)]
+    p = await controllers.buffer.insert_blobs_to_buffer(DEFAULT_PROJECT_ID, user_blobs)
+    assert p.ok()
+    assert len(p.data().ids) == 3
+
+    state = await controllers.buffer.get_buffer_state(
+        u_ids[0], DEFAULT_PROJECT_ID, BlobType.chat
+    )
+    assert state.blob_count == 2
+    state = await controllers.buffer.get_buffer_state(
+        u_ids[1], DEFAULT_PROJECT_ID, BlobType.chat
+    )
+    assert state.blob_count == 1
+
+    p = await controllers.user.delete_user(u_ids[1], DEFAULT_PROJECT_ID)
+    assert p.ok()
+
+
+@pytest.mark.asyncio
+async def test_buffer_state_scripts(redis_env):
+    # only the counters in Redis are touched, no user is needed
+    u_id = str(uuid4())
+    key = buffer_state_key(u_id, DEFAULT_PROJECT_ID, BlobType.chat)
+    member = flush_deadline_member(u_id, DEFAULT_PROJECT_ID, BlobType.chat)
+    async with get_redis_client() as redis_client:
+        await redis_client.hset(key, mapping={"token_size": 0, "blob_count": 0})
+        await redis_client.expire(key, BUFFER_STATE_TTL)
+
+    for _ in range(3):
+        await controllers.buffer.incr_buffer_state(
+            u_id, DEFAULT_PROJECT_ID, BlobType.chat, 10
+        )
+    async with get_redis_client() as redis_client:
+        state = await redis_client.hgetall(key)
+        assert state["token_size"] == "30" and state["blob_count"] == "3"
+        assert await redis_client.zscore(FLUSH_DEADLINES_KEY, member) is not None
+
+    # the token size never goes negative while blobs are left
+    await controllers.buffer.decr_buffer_state(
+        u_id, DEFAULT_PROJECT_ID, BlobType.chat, 50, 2
+    )
+    async with get_redis_client() as redis_client:
+        state = await redis_client.hgetall(key)
+        assert state["token_size"] == "0" and state["blob_count"] == "1"
+        assert await redis_client.zscore(FLUSH_DEADLINES_KEY, member) is not None
+
+    await controllers.buffer.decr_buffer_state(
+        u_id, DEFAULT_PROJECT_ID, BlobType.chat, 0, 1
+    )
+    async with get_redis_client() as redis_client:
+        assert not await redis_client.exists(key)
+        assert await redis_client.zscore(FLUSH_DEADLINES_KEY, member) is None
+
+    # a missing state is left for the rebuild
+    await controllers.buffer.decr_buffer_state(
+        u_id, DEFAULT_PROJECT_ID, BlobType.chat, 10, 1
+    )
+    async with get_redis_client() as redis_client:
+        assert not await redis_client.exists(key)
+
+
+@pytest.mark.asyncio
+async def test_claim_expired_deadlines(redis_env):
+    deadlines_key = f"{FLUSH_DEADLINES_KEY}::test::{uuid4()}"
+    async with get_redis_client() as redis_client:
+        await redis_client.zadd(deadlines_key, {"expired": 1, "future": 2**40})
+    with patch(
+        "powermemo_server.controllers.buffer_queue.FLUSH_DEADLINES_KEY",
+        deadlines_key,
+    ):
+        claimed = await controllers.buffer_queue.claim_expired_deadlines()
+        assert claimed == [("expired", 1.0)]
+        # each deadline is claimed once
+        assert await controllers.buffer_queue.claim_expired_deadlines() == []
+    async with get_redis_client() as redis_client:
+        assert await redis_client.zrange(deadlines_key, 0, -1) == ["future"]
+        await redis_client.delete(deadlines_key)
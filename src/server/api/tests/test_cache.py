@@ -0,0 +1,28 @@
+import time
+from powermemo_server.cache import (
+    LocalCache,
+    MISSING,
+    LOCAL_CACHES,
+    apply_invalidation,
+)
+
+
+def test_local_cache_ttl_and_lru():
+    cache = LocalCache("test", max_size=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    # "b" is the least recently used one
+    cache.set("c", 3)
+    assert cache.get("b") is MISSING
+    assert cache.get("a") == 1 and cache.get("c") == 3
+
+    LOCAL_CACHES["test"] = cache
+    apply_invalidation('["test", "a"]')
+    assert cache.get("a") is MISSING
+    LOCAL_CACHES.pop("test")
+
+    cache = LocalCache("test", max_size=2, ttl=0.01)
+    cache.set("a", 1)
+    time.sleep(0.02)
+    assert cache.get("a") is MISSING
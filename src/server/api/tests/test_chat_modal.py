@@ -1,11 +1,16 @@
 import pytest
+from datetime import datetime
 from unittest.mock import AsyncMock, Mock, patch
 from powermemo_server import controllers
 from powermemo_server.models import response as res
 from powermemo_server.models.database import DEFAULT_PROJECT_ID
-from powermemo_server.models.blob import BlobType
+from powermemo_server.models.blob import BlobType, ChatBlob
 from powermemo_server.models.utils import Promise
-from powermemo_server.env import CONFIG
+from powermemo_server.env import CONFIG, ProfileConfig
+from powermemo_server.controllers.modal.chat.merge import merge_or_valid_new_memos
+from powermemo_server.controllers.modal.chat.summary_extract import (
+    summary_and_extract,
+)
 import numpy as np
 
 
@@ -376,3 +381,110 @@ async def test_chat_organize_modal(
     assert mock_extract_llm_complete.await_count == 1
     assert mock_merge_llm_complete.await_count == 4
     assert mock_organize_llm_complete.await_count == 1
+
+
+@pytest.mark.asyncio
+async def test_batch_profile_merge():
+    old_profile = res.ProfileData(
+        id="00000000-0000-4000-8000-000000000001",
+        content="user likes basketball",
+        attributes={"topic": "interest", "sub_topic": "sports"},
+        created_at=datetime.now(),
+        updated_at=datetime.now(),
+    )
+    prompt_ids = []
+
+    async def fake_complete(project_id, prompt, prompt_id=None, **kwargs):
+        prompt_ids.append(prompt_id)
+        if prompt_id == "merge_profile_batch":
+            # the action of the last fact is malformed
+            return Promise.resolve(
+                "THOUGHT\n---\n"
+                "- [0]::UPDATE::user likes basketball and tennis\n"
+                "- [1]::ABORT::invalid\n"
+                "- [2]::UPDATE"
+            )
+        return Promise.resolve("---\n- UPDATE::user's name is Tom")
+
+    with patch(
+        "powermemo_server.controllers.modal.chat.merge.llm_complete",
+        side_effect=fake_complete,
+    ), patch.object(CONFIG, "batch_profile_merge", True):
+        p = await merge_or_valid_new_memos(
+            DEFAULT_PROJECT_ID,
+            ["user likes tennis", "user is a robot", "user's name is Tom"],
+            [
+                {"topic": "interest", "sub_topic": "sports"},
+                {"topic": "basic_info", "sub_topic": "species"},
+                {"topic": "basic_info", "sub_topic": "name"},
+            ],
+            [old_profile],
+            ProfileConfig(language="en"),
+            [],
+        )
+    assert p.ok()
+    results = p.data()
+    # one call for all the facts, one more for the fact that failed to parse
+    assert prompt_ids == ["merge_profile_batch", "merge_profile"]
+    assert [u["content"] for u in results["update"]] == [
+        "user likes basketball and tennis"
+    ]
+    assert [a["content"] for a in results["add"]] == ["user's name is Tom"]
+    assert results["delete"] == []
+
+
+@pytest.mark.asyncio
+async def test_fused_summary_extract(user_id):
+    blobs = [
+        ChatBlob(
+            messages=[res.OpenAICompatibleMessage(role="user", content="I'm Tom")]
+        )
+    ]
+    prompt_ids = []
+    fused_reply = (
+        "<memo>\n## User Info\n- User's name is Tom\n</memo>\n"
+        "<facts>\n- basic_info::name::Tom\n</facts>"
+    )
+
+    async def fake_complete(project_id, prompt, prompt_id=None, **kwargs):
+        prompt_ids.append(prompt_id)
+        if prompt_id == "summary_extract_chats":
+            return Promise.resolve(fused_reply)
+        if prompt_id == "summary_entry_chats":
+            return Promise.resolve("- User's name is Tom")
+        return Promise.resolve("- basic_info::name::Tom")
+
+    with patch(
+        "powermemo_server.controllers.modal.chat.summary_extract.llm_complete",
+        side_effect=fake_complete,
+    ), patch(
+        "powermemo_server.controllers.modal.chat.entry_summary.llm_complete",
+        side_effect=fake_complete,
+    ), patch(
+        "powermemo_server.controllers.modal.chat.extract.llm_complete",
+        side_effect=fake_complete,
+    ), patch.object(
+        CONFIG, "extract_pipeline_mode", "fused"
+    ), patch.object(
+        CONFIG, "language", "en"
+    ):
+        p = await summary_and_extract(user_id, DEFAULT_PROJECT_ID, blobs)
+        assert p.ok()
+        memo, extracted = p.data()
+        assert memo == "## User Info\n- User's name is Tom"
+        assert extracted["fact_contents"] == ["Tom"]
+        assert prompt_ids == ["summary_extract_chats"]
+
+        # a reply without the memo falls back to the two stages
+        fused_reply = "- basic_info::name::Tom"
+        prompt_ids.clear()
+        p = await summary_and_extract(user_id, DEFAULT_PROJECT_ID, blobs)
+        assert p.ok()
+        memo, extracted = p.data()
+        assert memo == "- User's name is Tom"
+        assert extracted["fact_contents"] == ["Tom"]
+        assert prompt_ids == [
+            "summary_extract_chats",
+            "summary_entry_chats",
+            "extract_profile",
+        ]
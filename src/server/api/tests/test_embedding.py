@@ -0,0 +1,104 @@
+import pytest
+import asyncio
+import numpy as np
+from uuid import uuid4
+from unittest.mock import patch, AsyncMock
+from powermemo_server.models.database import DEFAULT_PROJECT_ID
+from powermemo_server.llms.embeddings import get_embedding, EMBEDDING_COALESCER
+from powermemo_server.llms.embeddings.coalescer import EmbeddingCoalescer
+
+
+def fake_coalescer(calls: list, **limits) -> EmbeddingCoalescer:
+    async def fake_factory(model, texts, phase):
+        calls.append(texts)
+        return np.array([[float(len(t)), 0.0] for t in texts])
+
+    return EmbeddingCoalescer(fake_factory, max_wait_ms=1, **limits)
+
+
+@pytest.mark.asyncio
+async def test_embedding_coalescer():
+    calls = []
+    coalescer = fake_coalescer(
+        calls, max_batch_size=3, max_token_size=10, max_batch_token_size=10
+    )
+    texts = ["a", "bb", "ccc", "dddd"]
+    results = await asyncio.gather(
+        *[coalescer.embed("m", [t], "document", [2]) for t in texts]
+    )
+    assert [r[0][0] for r in results] == [1.0, 2.0, 3.0, 4.0]
+    # split by the batch size
+    assert calls == [["a", "bb", "ccc"], ["dddd"]]
+
+    calls.clear()
+    results = await coalescer.embed("m", texts, "document", [4, 4, 4, 4])
+    assert results.shape == (4, 2)
+    # split by the token budget
+    assert calls == [["a", "bb"], ["ccc", "dddd"]]
+
+    calls.clear()
+    await asyncio.gather(
+        coalescer.embed("m", ["a"], "document", [1]),
+        coalescer.embed("m", ["a"], "query", [1]),
+    )
+    # texts of different phases are never sent together
+    assert calls == [["a"], ["a"]]
+
+
+@pytest.mark.asyncio
+async def test_embedding_coalescer_truncates():
+    calls = []
+    coalescer = fake_coalescer(
+        calls, max_batch_size=8, max_token_size=3, max_batch_token_size=100
+    )
+    text = "one two three four five six"
+    results = await coalescer.embed("m", [text, "hi"], "document", [6, 1])
+    assert results.shape == (2, 2)
+    # the long text is cut to the per-text limit on the tokenizer pool, the
+    # batch is bounded by its own budget
+    assert calls == [["one two three", "hi"]]
+
+    texts, token_sizes = await coalescer.truncate_batch([text, "hi"], [6, 1])
+    assert texts == ["one two three", "hi"] and token_sizes == [3, 1]
+
+
+@pytest.mark.asyncio
+async def test_embedding_coalescer_errors():
+    async def failing_factory(model, texts, phase):
+        raise ValueError("provider is down")
+
+    coalescer = EmbeddingCoalescer(
+        failing_factory,
+        max_batch_size=8,
+        max_token_size=10,
+        max_batch_token_size=10,
+        max_wait_ms=1,
+    )
+    results = await asyncio.gather(
+        coalescer.embed("m", ["a"], "document", [1]),
+        coalescer.embed("m", ["b"], "document", [1]),
+        return_exceptions=True,
+    )
+    # every caller of the failed batch gets the error
+    assert all(isinstance(r, ValueError) for r in results)
+
+
+@pytest.mark.asyncio
+async def test_embedding_cache(redis_env):
+    text = f"embedding cache {uuid4()}"
+    with patch.object(
+        EMBEDDING_COALESCER,
+        "embed",
+        AsyncMock(return_value=np.array([[0.5, 0.25]])),
+    ) as mock_embed:
+        p = await get_embedding(DEFAULT_PROJECT_ID, [text], phase="query")
+        assert p.ok()
+        p = await get_embedding(DEFAULT_PROJECT_ID, [text], phase="query")
+        assert p.ok()
+        # served from the cache as float32 the second time
+        assert mock_embed.await_count == 1
+        assert p.data().tolist() == [[0.5, 0.25]]
+
+        # the phase is part of the key
+        p = await get_embedding(DEFAULT_PROJECT_ID, [text], phase="document")
+        assert mock_embed.await_count == 2
@@ -0,0 +1,114 @@
+import pytest
+import numpy as np
+from unittest.mock import patch
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql
+from powermemo_server import controllers
+from powermemo_server.env import CONFIG
+from powermemo_server.models.utils import Promise
+from powermemo_server.models.database import DEFAULT_PROJECT_ID, UserEvent
+from powermemo_server.connectors import AsyncSession
+from powermemo_server.utils import event_str_repr, get_encoded_tokens
+from powermemo_server.controllers.event import (
+    lexical_or_query,
+    vector_search_source,
+    hybrid_search_stmt,
+)
+
+
+async def fake_embedding(project_id, texts, phase="document", model=None):
+    # every event is equally similar
+    return Promise.resolve(np.ones((len(texts), CONFIG.embedding_dim)))
+
+
+async def get_event_embedding(event_id):
+    async with AsyncSession() as session:
+        return await session.scalar(
+            select(UserEvent.embedding).where(UserEvent.id == event_id)
+        )
+
+
+@pytest.mark.asyncio
+async def test_deferred_event_embedding(user_id):
+    with patch.object(CONFIG, "defer_event_embedding", True):
+        p = await controllers.event.append_user_event(
+            user_id, DEFAULT_PROJECT_ID, {"event_tip": "user went hiking"}
+        )
+    assert p.ok()
+    event_id = p.data()
+
+    assert await get_event_embedding(event_id) is None
+
+    with patch(
+        "powermemo_server.controllers.event.get_embedding", side_effect=fake_embedding
+    ):
+        # other tests may have left pending events too
+        while await controllers.event.embed_pending_events(32):
+            if await get_event_embedding(event_id) is not None:
+                break
+    assert await get_event_embedding(event_id) is not None
+
+
+@pytest.mark.asyncio
+async def test_hybrid_search_user_events(user_id):
+    with patch(
+        "powermemo_server.controllers.event.get_embedding", side_effect=fake_embedding
+    ):
+        for tip in ["user ordered a new phone", "user ordered the XJ9000 drone"]:
+            p = await controllers.event.append_user_event(
+                user_id, DEFAULT_PROJECT_ID, {"event_tip": tip}
+            )
+            assert p.ok()
+        # only the words can tell the events apart
+        p = await controllers.event.search_user_events(
+            user_id, DEFAULT_PROJECT_ID, "where is my XJ9000", search_mode="hybrid"
+        )
+    assert p.ok()
+    events = p.data().events
+    assert len(events) == 2
+    assert "XJ9000" in events[0].event_data.event_tip
+
+
+@pytest.mark.asyncio
+async def test_event_token_size_stored(user_id):
+    with patch.object(CONFIG, "defer_event_embedding", True):
+        for tip in ["user went hiking", "user bought a bike"]:
+            p = await controllers.event.append_user_event(
+                user_id, DEFAULT_PROJECT_ID, {"event_tip": tip}
+            )
+            assert p.ok()
+
+    p = await controllers.event.get_user_events(user_id, DEFAULT_PROJECT_ID)
+    events = p.data()
+    for e in events.events:
+        assert e.token_size == len(get_encoded_tokens(event_str_repr(e)))
+        # only used to pack the context
+        assert "event_str" not in e.model_dump()
+
+    p = await controllers.event.truncate_events(events, events.events[0].token_size)
+    assert len(p.data().events) == 1
+
+
+def test_vector_search_source():
+    conditions = (UserEvent.user_id == "u",)
+    with patch.object(CONFIG, "event_search_iterative_scan", None):
+        events, left = vector_search_source(conditions)
+        hybrid = hybrid_search_stmt(conditions, [0.0, 1.0], "cake", 5, 0.5)
+    # without iterative scan the user's events are read before ranking
+    assert left == ()
+    sql = str(select(events.id).compile(dialect=postgresql.dialect()))
+    assert "MATERIALIZED" in sql and "user_id" in sql
+    # the lexical arm still reads the table, not the candidates
+    sql = str(hybrid.compile(dialect=postgresql.dialect()))
+    assert "WITH user_event_candidates AS MATERIALIZED" in sql
+    assert "FROM user_events" in sql
+
+    with patch.object(CONFIG, "event_search_iterative_scan", "relaxed_order"):
+        events, left = vector_search_source(conditions)
+    assert events is UserEvent and left == conditions
+
+
+def test_lexical_or_query():
+    # any of the words matches, punctuation can't break the tsquery
+    assert lexical_or_query("Where is my XJ9000?") == "'where' | 'is' | 'my' | 'xj9000'"
+    assert lexical_or_query("?!") == ""
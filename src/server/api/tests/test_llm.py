@@ -0,0 +1,157 @@
+import pytest
+import time
+import asyncio
+from uuid import uuid4
+from unittest.mock import patch, AsyncMock
+from powermemo_server.env import CONFIG
+from powermemo_server.connectors import get_redis_client
+from powermemo_server.models.database import DEFAULT_PROJECT_ID
+from powermemo_server.llms import llm_complete, FACTORIES
+from powermemo_server.llms.utils import LLMResult
+from powermemo_server.llms.limiter import (
+    TAKE_BUCKETS_SCRIPT,
+    AdaptiveConcurrency,
+    bucket_keys,
+    is_rate_limited,
+)
+
+
+@pytest.mark.asyncio
+async def test_llm_response_cache(redis_env):
+    fake_complete = AsyncMock(
+        return_value=LLMResult(
+            content="cached answer",
+            prompt_tokens=10,
+            completion_tokens=2,
+            cached_tokens=None,
+        )
+    )
+    prompt = f"What is the answer? {uuid4()}"
+    with patch.dict(FACTORIES, {CONFIG.llm_style: fake_complete}), patch.object(
+        CONFIG, "llm_response_cache_prompt_ids", ["test_cache"]
+    ):
+        for _ in range(2):
+            p = await llm_complete(DEFAULT_PROJECT_ID, prompt, prompt_id="test_cache")
+            assert p.data() == "cached answer"
+        assert fake_complete.await_count == 1
+
+        # prompt ids that are not opted in always call the provider
+        for _ in range(2):
+            p = await llm_complete(DEFAULT_PROJECT_ID, prompt, prompt_id="no_cache")
+        assert fake_complete.await_count == 3
+
+        # another project doesn't read this project's completions
+        p = await llm_complete(str(uuid4()), prompt, prompt_id="test_cache")
+        assert fake_complete.await_count == 4
+
+    # the oldest completions of a prompt id are evicted
+    with patch.dict(FACTORIES, {CONFIG.llm_style: fake_complete}), patch.object(
+        CONFIG, "llm_response_cache_prompt_ids", ["test_cache_evict"]
+    ), patch.object(CONFIG, "llm_response_cache_max_entries", 1):
+        first, second = f"first {uuid4()}", f"second {uuid4()}"
+        for prompt in [first, second, second, first]:
+            await llm_complete(DEFAULT_PROJECT_ID, prompt, prompt_id="test_cache_evict")
+        assert fake_complete.await_count == 7
+
+
+@pytest.mark.asyncio
+async def test_llm_token_buckets(redis_env):
+    requests_key, tokens_key = bucket_keys(f"test-model-{uuid4()}")
+
+    async def take(rpm, tpm, cost, reserved=0):
+        async with get_redis_client() as redis_client:
+            return await redis_client.eval(
+                TAKE_BUCKETS_SCRIPT,
+                2,
+                requests_key,
+                tokens_key,
+                rpm,
+                tpm,
+                cost,
+                reserved,
+            )
+
+    assert await take(2, 0, 0) == 0
+    # half of the requests are reserved for interactive calls
+    assert await take(2, 0, 0, reserved=0.5) > 0
+    assert await take(2, 0, 0) == 0
+    # the bucket is empty, wait about 30s for the next request
+    assert 0 < await take(2, 0, 0) <= 30000
+
+    # a call larger than the token bucket waits for a full bucket only
+    assert await take(0, 100, 1000) == 0
+    assert await take(0, 100, 1) > 0
+
+    async with get_redis_client() as redis_client:
+        await redis_client.delete(requests_key, tokens_key)
+
+
+@pytest.mark.asyncio
+async def test_adaptive_llm_concurrency():
+    concurrency = AdaptiveConcurrency(min_limit=1, max_limit=4, latency_target_ms=1000)
+    for _ in range(4):
+        await concurrency.acquire()
+    # the fifth caller waits for a free slot instead of failing
+    waiter = asyncio.create_task(concurrency.acquire())
+    await asyncio.sleep(0.01)
+    assert not waiter.done()
+
+    started_at = time.time()
+    await concurrency.release(started_at, throttled=True)
+    await concurrency.release(started_at, throttled=True)
+    # one decrease for calls that started under the same limit
+    assert concurrency.limit == 2
+    await asyncio.sleep(0.01)
+    assert not waiter.done()
+
+    await concurrency.release(time.time(), throttled=False)
+    await asyncio.wait_for(waiter, 1)
+    assert concurrency.limit == 2.5
+
+
+@pytest.mark.asyncio
+async def test_adaptive_llm_concurrency_bounds():
+    concurrency = AdaptiveConcurrency(min_limit=2, max_limit=3, latency_target_ms=1)
+    for _ in range(3):
+        await concurrency.acquire()
+        # every call is too slow
+        await concurrency.release(time.time() - 1, throttled=False)
+    assert concurrency.limit == 2
+
+    concurrency.latency_target_ms = 1000
+    for _ in range(20):
+        await concurrency.acquire()
+        await concurrency.release(time.time(), throttled=False)
+    assert concurrency.limit == 3
+
+
+@pytest.mark.asyncio
+async def test_llm_priority_lanes():
+    concurrency = AdaptiveConcurrency(
+        min_limit=1, max_limit=5, latency_target_ms=1000, reserved_ratio=0.2
+    )
+    for _ in range(4):
+        await concurrency.acquire("batch")
+    # the last slot is reserved for interactive calls
+    batch = asyncio.create_task(concurrency.acquire("batch"))
+    await asyncio.sleep(0.01)
+    assert not batch.done()
+    await asyncio.wait_for(concurrency.acquire("interactive"), 1)
+
+    # a freed slot goes to the waiting interactive call first
+    interactive = asyncio.create_task(concurrency.acquire("interactive"))
+    await asyncio.sleep(0.01)
+    await concurrency.release(time.time(), throttled=False)
+    await asyncio.wait_for(interactive, 1)
+    assert not batch.done()
+    batch.cancel()
+
+
+def test_is_rate_limited():
+    class ProviderError(Exception):
+        def __init__(self, status_code):
+            self.status_code = status_code
+
+    assert is_rate_limited(ProviderError(429))
+    assert not is_rate_limited(ProviderError(500))
+    assert not is_rate_limited(ValueError("bad reply"))
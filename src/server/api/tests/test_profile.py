@@ -0,0 +1,194 @@
+import pytest
+import numpy as np
+from uuid import uuid4
+from datetime import datetime, timedelta
+from unittest.mock import patch
+from powermemo_server import controllers
+from powermemo_server.env import CONFIG
+from powermemo_server.models import response as res
+from powermemo_server.models.utils import Promise
+from powermemo_server.models.database import DEFAULT_PROJECT_ID
+from powermemo_server.controllers.post_process.profile import (
+    filter_profiles_with_embedding,
+)
+
+
+@pytest.mark.asyncio
+async def test_profile_cache_write_through(user_id):
+    p = await controllers.profile.add_user_profiles(
+        user_id,
+        DEFAULT_PROJECT_ID,
+        ["user likes to play basketball"],
+        [{"topic": "interest", "sub_topic": "sports"}],
+    )
+    assert p.ok()
+    # first read fills the cache
+    p = await controllers.profile.get_user_profiles(user_id, DEFAULT_PROJECT_ID)
+    assert p.ok() and len(p.data().profiles) == 1
+
+    p = await controllers.profile.add_user_profiles(
+        user_id,
+        DEFAULT_PROJECT_ID,
+        ["user is a junior school student"],
+        [{"topic": "education", "sub_topic": "level"}],
+    )
+    assert p.ok()
+    new_id = p.data().ids[0]
+    p = await controllers.profile.update_user_profiles(
+        user_id,
+        DEFAULT_PROJECT_ID,
+        [new_id],
+        ["user is a high school student"],
+        [None],
+    )
+    assert p.ok()
+
+    cached = await controllers.profile.get_cached_profiles(user_id, DEFAULT_PROJECT_ID)
+    assert cached is not None
+    assert len(cached.profiles) == 2
+    assert cached.profiles[0].content == "user is a high school student"
+
+    p = await controllers.profile.delete_user_profile(
+        user_id, DEFAULT_PROJECT_ID, new_id
+    )
+    assert p.ok()
+    cached = await controllers.profile.get_cached_profiles(user_id, DEFAULT_PROJECT_ID)
+    assert [p.content for p in cached.profiles] == ["user likes to play basketball"]
+
+
+@pytest.mark.asyncio
+async def test_truncate_profiles_with_token_size():
+    now = datetime.now()
+    profiles = res.UserProfilesData(
+        profiles=[
+            res.ProfileData(
+                id=uuid4(),
+                content=f"memo {i}",
+                attributes={"topic": "interest", "sub_topic": f"sub {i}"},
+                created_at=now,
+                updated_at=now - timedelta(minutes=i),
+                token_size=10,
+            )
+            for i in range(5)
+        ]
+    )
+    p = await controllers.profile.truncate_profiles(profiles, max_token_size=35)
+    assert p.ok()
+    assert [p.content for p in p.data().profiles] == ["memo 0", "memo 1", "memo 2"]
+
+    # always keep the first profile
+    p = await controllers.profile.truncate_profiles(p.data(), max_token_size=5)
+    assert len(p.data().profiles) == 1
+
+
+@pytest.mark.asyncio
+async def test_bulk_update_profiles(user_id):
+    p = await controllers.profile.add_user_profiles(
+        user_id,
+        DEFAULT_PROJECT_ID,
+        ["user likes to play basketball", "user is a junior school student"],
+        [
+            {"topic": "interest", "sub_topic": "sports"},
+            {"topic": "education", "sub_topic": "level"},
+        ],
+    )
+    assert p.ok()
+    ids = p.data().ids
+
+    p = await controllers.profile.update_user_profiles(
+        user_id,
+        DEFAULT_PROJECT_ID,
+        [ids[0], ids[1], str(uuid4())],
+        ["user likes to play football", "user is a high school student", "missing"],
+        [{"topic": "interest", "sub_topic": "sports"}, None, None],
+    )
+    assert p.ok()
+    # the unknown id is not matched
+    assert sorted(map(str, p.data().ids)) == sorted(map(str, ids))
+
+    p = await controllers.profile.get_user_profiles(user_id, DEFAULT_PROJECT_ID)
+    profiles = {str(p.id): p for p in p.data().profiles}
+    assert profiles[str(ids[0])].content == "user likes to play football"
+    assert profiles[str(ids[1])].attributes["topic"] == "education"
+    assert all(p.token_size for p in profiles.values())
+
+
+@pytest.mark.asyncio
+async def test_get_user_profiles_topic_filters(user_id):
+    p = await controllers.profile.add_user_profiles(
+        user_id,
+        DEFAULT_PROJECT_ID,
+        ["user likes basketball", "user likes football", "user likes chess", "Tom"],
+        [
+            {"topic": "interest", "sub_topic": "sports"},
+            {"topic": "interest", "sub_topic": "team sports"},
+            {"topic": "interest", "sub_topic": "games"},
+            {"topic": "basic_info", "sub_topic": "name"},
+        ],
+    )
+    assert p.ok()
+
+    # filtered on the database, before the cache is filled
+    p = await controllers.profile.get_user_profiles(
+        user_id, DEFAULT_PROJECT_ID, only_topics=["interest"], max_subtopic_size=2
+    )
+    assert p.ok()
+    profiles = p.data().profiles
+    assert len(profiles) == 2
+    assert all(p.attributes["topic"] == "interest" for p in profiles)
+
+    p = await controllers.profile.get_user_profiles(
+        user_id,
+        DEFAULT_PROJECT_ID,
+        max_subtopic_size=1,
+        topic_limits={"interest": -1},
+    )
+    assert p.ok()
+    assert len(p.data().profiles) == 4
+
+
+@pytest.mark.asyncio
+async def test_filter_profiles_with_embedding(user_id):
+    p = await controllers.profile.add_user_profiles(
+        user_id,
+        DEFAULT_PROJECT_ID,
+        ["user likes to play basketball", "user's name is Tom"],
+        [
+            {"topic": "interest", "sub_topic": "sports"},
+            {"topic": "basic_info", "sub_topic": "name"},
+        ],
+    )
+    assert p.ok()
+    p = await controllers.profile.get_user_profiles(user_id, DEFAULT_PROJECT_ID)
+    profiles = p.data()
+    chats = [res.OpenAICompatibleMessage(role="user", content="Any games tonight?")]
+
+    phases = []
+
+    async def fake_embedding(project_id, texts, phase="document", model=None):
+        phases.append(phase)
+        # "sports" profiles point to the query direction
+        embeddings = np.zeros((len(texts), CONFIG.embedding_dim))
+        for i, t in enumerate(texts):
+            embeddings[i, 0 if phase == "query" or "sports" in t else 1] = 1.0
+        return Promise.resolve(embeddings)
+
+    with patch(
+        "powermemo_server.controllers.post_process.profile.get_embedding",
+        side_effect=fake_embedding,
+    ):
+        for _ in range(2):
+            p = await filter_profiles_with_embedding(
+                DEFAULT_PROJECT_ID, profiles, chats, max_filter_num=1
+            )
+            assert p.ok()
+            assert [p.attributes["sub_topic"] for p in p.data()] == ["sports"]
+        # the profiles are embedded on the first filter and stored
+        assert phases.count("document") <= 1
+
+        # the unrelated profile is below the similarity threshold
+        p = await filter_profiles_with_embedding(
+            DEFAULT_PROJECT_ID, profiles, chats, max_filter_num=2
+        )
+    assert p.ok()
+    assert [p.attributes["sub_topic"] for p in p.data()] == ["sports"]
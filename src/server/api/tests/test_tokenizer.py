@@ -0,0 +1,23 @@
+import pytest
+import asyncio
+from powermemo_server.utils import get_encoded_tokens
+from powermemo_server.tokenizer import count_tokens, count_tokens_batch, truncate_tokens
+
+
+@pytest.mark.asyncio
+async def test_count_tokens_off_loop():
+    contents = ["Hello world", "你好" * 200, "x " * 1000, ""]
+    counts = await count_tokens_batch(contents)
+    assert counts == [len(get_encoded_tokens(c)) for c in contents]
+    # concurrent callers are batched together, each gets its own count
+    counts = await asyncio.gather(*[count_tokens(c) for c in contents])
+    assert counts == [len(get_encoded_tokens(c)) for c in contents]
+
+
+@pytest.mark.asyncio
+async def test_truncate_tokens():
+    text, token_size = await truncate_tokens("one two three four", 2)
+    assert text == "one two" and token_size == 2
+    # shorter texts are kept
+    text, token_size = await truncate_tokens("one", 2)
+    assert text == "one" and token_size == 1
@@ -0,0 +1,34 @@
+import powermemo_server.env
+import os
+import socket
+
+# Done setting up env
+
+import asyncio
+from powermemo_server.connectors import close_connection, init_redis_pool
+from powermemo_server.controllers.buffer_queue import (
+    run_flush_worker,
+    run_idle_flush_sweeper,
+)
+from powermemo_server.env import LOG
+from powermemo_server.cache import run_invalidation_listener
+from powermemo_server.controllers.event import run_event_embedder
+
+
+async def main():
+    init_redis_pool()
+    consumer_name = os.getenv("WORKER_NAME") or f"{socket.gethostname()}-{os.getpid()}"
+    LOG.info(f"Start Powermemo Worker {powermemo_server.__version__} 🛠️")
+    try:
+        await asyncio.gather(
+            run_flush_worker(consumer_name),
+            run_idle_flush_sweeper(),
+            run_invalidation_listener(),
+            run_event_embedder(),
+        )
+    finally:
+        await close_connection()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())